@@ -0,0 +1,83 @@
+-- Decoders for monthly tables in the compact layout (ais_data_processor.py --layout compact), where
+-- time_offsets holds the seconds since start_dt and speed_over_ground_q, course_over_ground_q and heading_q
+-- the values in tenths (knots, degrees) as SMALLINT[]. Python equivalents are in src/trajectory_encoding.py.
+
+-- Tenths back to the FLOAT[] of the linestring layout, NULL elements stay NULL
+CREATE OR REPLACE FUNCTION decode_tenths(quantized smallint[])
+RETURNS FLOAT[] AS $$
+    SELECT ARRAY(
+        SELECT q / 10.0::float8
+        FROM unnest(quantized) WITH ORDINALITY AS u(q, i)
+        ORDER BY i
+    );
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+
+-- Point times as the naive local timestamps of the linestring layout. start_dt is local time in the
+-- session TimeZone it was written in, tz only needs to be given for a session in another time zone.
+-- The offsets are elapsed seconds, so they are added to the absolute start time (DST aware).
+CREATE OR REPLACE FUNCTION decode_time_offsets(
+    start_dt TIMESTAMP WITHOUT TIME ZONE,
+    time_offsets integer[],
+    tz text DEFAULT NULL
+)
+RETURNS TIMESTAMP WITHOUT TIME ZONE[] AS $$
+    -- Not STRICT because of the tz default, NULL inputs give NULL like the other decoders
+    SELECT CASE WHEN start_dt IS NOT NULL AND time_offsets IS NOT NULL THEN ARRAY(
+        SELECT (start_dt AT TIME ZONE zone.name + o * interval '1 second') AT TIME ZONE zone.name
+        FROM (SELECT COALESCE(tz, current_setting('TimeZone')) AS name) AS zone,
+             unnest(time_offsets) WITH ORDINALITY AS u(o, i)
+        ORDER BY i
+    ) END;
+$$ LANGUAGE sql STABLE PARALLEL SAFE;
+
+
+-- <table>_decoded view with the columns of the linestring layout, so the other query functions
+-- (get_trajectories_in_bbox, ...) can be pointed at compact tables through their view names
+CREATE OR REPLACE FUNCTION create_decoded_view(tbl text)
+RETURNS void AS $$
+BEGIN
+    EXECUTE format('
+        CREATE OR REPLACE VIEW %I AS
+        SELECT
+            id,
+            mmsi,
+            route_id,
+            start_dt,
+            end_dt,
+            origin,
+            destination,
+            count,
+            duration,
+            missing_data,
+            missing_data_info,
+            coordinates,
+            decode_time_offsets(start_dt, time_offsets) AS timestamps,
+            decode_tenths(speed_over_ground_q) AS speed_over_ground,
+            navigational_status::int[] AS navigational_status,
+            decode_tenths(course_over_ground_q) AS course_over_ground,
+            decode_tenths(heading_q) AS heading,
+            compression_tolerance,
+            sog_min,
+            sog_max,
+            sog_mean,
+            dominant_nav_status,
+            path_length_m,
+            ship_type
+        FROM %I
+    ', tbl || '_decoded', tbl);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Example usage:
+SELECT create_decoded_view('trajectories_2023_02');
+
+SELECT * FROM get_trajectories_in_bbox(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    ARRAY['trajectories_2023_02_decoded']
+);
+
+-- Filters on the quantized values work without decoding, e.g. trajectories that were faster than 2 knots
+SELECT id, mmsi FROM trajectories_2023_02
+WHERE EXISTS (SELECT 1 FROM unnest(speed_over_ground_q) AS s WHERE s >= 20);
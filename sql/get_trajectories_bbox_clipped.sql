@@ -0,0 +1,103 @@
+-- Clipped variants of get_trajectories_in_bbox for the linestring layout (and the <table>_decoded views of
+-- sql/compact_layout.sql): instead of the whole trajectory only the points inside bbox (and the time window)
+-- are returned, with the timestamps, speed_over_ground, ... arrays sliced to the same points. A trajectory
+-- that enters bbox several times gives one row per part (runs of consecutive points inside). A part of a
+-- single point has a POINT as coordinates. For the measured layout see sql/get_trajectories_bbox_time.sql.
+
+-- Parts of the trajectories in table_list inside bbox, and between time_start and time_end (local time like
+-- the timestamps column) when they are given. first_index is the position of the first point of the part
+-- in the arrays of the whole trajectory (1 based).
+CREATE OR REPLACE FUNCTION get_trajectories_in_bbox_clipped(
+    bbox geometry,
+    table_list text[],
+    time_start TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+    time_end TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL
+)
+RETURNS TABLE (
+    id integer,
+    mmsi VARCHAR,
+    route_id VARCHAR,
+    part integer,
+    start_dt TIMESTAMP WITHOUT TIME ZONE,
+    end_dt TIMESTAMP WITHOUT TIME ZONE,
+    count integer,
+    first_index integer,
+    coordinates geometry,
+    timestamps TIMESTAMP WITHOUT TIME ZONE[],
+    speed_over_ground FLOAT[],
+    navigational_status int[],
+    course_over_ground FLOAT[],
+    heading FLOAT[]
+) AS $$
+DECLARE
+    tbl text;
+BEGIN
+    FOREACH tbl IN ARRAY table_list
+    LOOP
+        RETURN QUERY EXECUTE format('
+            WITH candidates AS (
+                SELECT t.id, t.mmsi, t.route_id, t.coordinates, t.timestamps, t.speed_over_ground,
+                       t.navigational_status, t.course_over_ground, t.heading
+                FROM %I AS t
+                WHERE ST_Intersects(t.coordinates, $1)
+                  AND ($2 IS NULL OR t.end_dt >= $2)
+                  AND ($3 IS NULL OR t.start_dt <= $3)
+            ),
+            inside AS (
+                SELECT c.id, dp.path[1] AS i, dp.geom
+                FROM candidates AS c, ST_DumpPoints(c.coordinates) AS dp
+                WHERE dp.geom && $1 AND ST_Intersects(dp.geom, $1)
+                  AND ($2 IS NULL OR c.timestamps[dp.path[1]] >= $2)
+                  AND ($3 IS NULL OR c.timestamps[dp.path[1]] <= $3)
+            ),
+            parts AS (
+                -- consecutive indices have the same i - row_number()
+                SELECT runs.id, min(runs.i) AS first, max(runs.i) AS last,
+                       CASE WHEN count(*) > 1 THEN ST_MakeLine(runs.geom ORDER BY runs.i)
+                            ELSE (array_agg(runs.geom))[1] END AS geom
+                FROM (
+                    SELECT inside.*, inside.i - row_number() OVER (PARTITION BY inside.id ORDER BY inside.i) AS run
+                    FROM inside
+                ) AS runs
+                GROUP BY runs.id, runs.run
+            )
+            SELECT
+                c.id,
+                c.mmsi,
+                c.route_id,
+                (row_number() OVER (PARTITION BY c.id ORDER BY p.first))::integer AS part,
+                c.timestamps[p.first] AS start_dt,
+                c.timestamps[p.last] AS end_dt,
+                (p.last - p.first + 1)::integer AS count,
+                p.first::integer AS first_index,
+                p.geom AS coordinates,
+                c.timestamps[p.first:p.last],
+                c.speed_over_ground[p.first:p.last],
+                c.navigational_status[p.first:p.last],
+                c.course_over_ground[p.first:p.last],
+                c.heading[p.first:p.last]
+            FROM parts AS p JOIN candidates AS c ON c.id = p.id
+        ', tbl)
+        USING bbox, time_start, time_end;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Example usage:
+SELECT * FROM get_trajectories_in_bbox_clipped(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    ARRAY['trajectories_2023_02', 'trajectories_2023_03']
+);
+
+-- Only the points inside the box between 06:00 and 18:00
+SELECT id, mmsi, part, count, start_dt, end_dt FROM get_trajectories_in_bbox_clipped(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    ARRAY['trajectories_2023_02'],
+    '2023-02-01 06:00', '2023-02-01 18:00'
+);
+
+-- Bytes transferred, whole trajectories against the clipped parts
+SELECT
+    (SELECT sum(pg_column_size(t.*)) FROM get_trajectories_in_bbox(ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326), ARRAY['trajectories_2023_02']) AS t) AS whole,
+    (SELECT sum(pg_column_size(t.*)) FROM get_trajectories_in_bbox_clipped(ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326), ARRAY['trajectories_2023_02']) AS t) AS clipped;
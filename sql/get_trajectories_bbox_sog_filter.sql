@@ -1,3 +1,8 @@
+-- Speed and ship type filters on the summary columns of the monthly tables (sog_min, sog_max, ship_type,
+-- see sql/trajectory_summaries.sql), which are btree indexed, instead of unnest() on every row in the bbox.
+-- NaN speeds are left out of the summaries, rows without any speed have NULL and don't match.
+
+-- Trajectories in bbox that reached speed at some point
 CREATE OR REPLACE FUNCTION get_trajectories_in_bbox_filter(
     bbox geometry,
     table_list text[],
@@ -48,10 +53,7 @@ BEGIN
                 heading
             FROM %I
             WHERE ST_Intersects(coordinates, $1)
-              AND EXISTS (
-                  SELECT 1 FROM unnest(speed_over_ground) AS s
-                  WHERE s >= $2
-              )
+              AND sog_max >= $2
         ', tbl)
         USING bbox, speed;
     END LOOP;
@@ -59,7 +61,7 @@ END;
 $$ LANGUAGE plpgsql;
 
 -- Example usage:
-SELECT * FROM get_trajectories_in_bbox(
+SELECT * FROM get_trajectories_in_bbox_filter(
     ST_MakeEnvelope(11.7, 57.5, 11.8, 57.5, 4326),
     ARRAY['trajectories_2023_02', 'trajectories_2023_03', 'trajectories_2023_04', 'trajectories_2023_08'],
     2.0 
@@ -68,6 +70,7 @@ SELECT * FROM get_trajectories_in_bbox(
 
 
 
+-- Trajectories in bbox that never went slower than min_speed
 CREATE OR REPLACE FUNCTION get_trajectories_in_bbox_min_speed(
     bbox geometry,
     table_list text[],
@@ -118,10 +121,7 @@ BEGIN
                 heading
             FROM %I
             WHERE ST_Intersects(coordinates, $1)
-              AND NOT EXISTS (
-                  SELECT 1 FROM unnest(speed_over_ground) AS s
-                  WHERE s < $2
-              )
+              AND sog_min >= $2
         ', tbl)
         USING bbox, min_speed;
     END LOOP;
@@ -129,8 +129,79 @@ END;
 $$ LANGUAGE plpgsql;
 
 -- Example usage:
-SELECT * FROM get_trajectories_in_bbox(
+SELECT * FROM get_trajectories_in_bbox_min_speed(
     ST_MakeEnvelope(11.7, 57.5, 11.8, 57.5, 4326),
     ARRAY['trajectories_2023_02', 'trajectories_2023_03', 'trajectories_2023_04', 'trajectories_2023_08'],
     2.0
 );
+
+
+
+
+-- Trajectories in bbox of ships of the given types (type_of_ship_and_cargo) that reached speed at some point
+CREATE OR REPLACE FUNCTION get_trajectories_in_bbox_ship_type(
+    bbox geometry,
+    table_list text[],
+    ship_types integer[],
+    speed float DEFAULT 0
+)
+RETURNS TABLE (
+    id integer,
+    mmsi VARCHAR,
+    route_id VARCHAR,
+    start_dt TIMESTAMP WITHOUT TIME ZONE,
+    end_dt TIMESTAMP WITHOUT TIME ZONE,
+    origin geometry,
+    destination geometry,
+    count integer,
+    duration interval,
+    missing_data boolean,
+    missing_data_info VARCHAR,
+    coordinates geometry,
+    timestamps TIMESTAMP WITHOUT TIME ZONE[],
+    speed_over_ground FLOAT[],
+    navigational_status int[],
+    course_over_ground FLOAT[],
+    heading FLOAT[]
+) AS $$
+DECLARE
+    tbl text;
+BEGIN
+    FOREACH tbl IN ARRAY table_list
+    LOOP
+        RETURN QUERY EXECUTE format('
+            SELECT 
+                id,
+                mmsi,
+                route_id,
+                start_dt,
+                end_dt,
+                origin,
+                destination,
+                count,
+                duration,
+                missing_data,
+                missing_data_info,
+                coordinates,
+                timestamps,
+                speed_over_ground,
+                navigational_status,
+                course_over_ground,
+                heading
+            FROM %I
+            WHERE ST_Intersects(coordinates, $1)
+              AND ship_type = ANY($2)
+              AND sog_max >= $3
+        ', tbl)
+        USING bbox, ship_types, speed;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Example usage, cargo ships (70-79) faster than 10 knots:
+SELECT * FROM get_trajectories_in_bbox_ship_type(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    ARRAY['trajectories_2023_02', 'trajectories_2023_03'],
+    ARRAY[70, 71, 72, 73, 74, 75, 76, 77, 78, 79],
+    10.0
+);
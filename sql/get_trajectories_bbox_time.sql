@@ -0,0 +1,118 @@
+-- Bbox + time window queries for monthly tables in the measured layout (ais_data_processor.py --layout measured),
+-- where coordinates is a LINESTRINGM with the UTC epoch seconds of every point as M.
+
+-- Point times of a measured trajectory, replaces the timestamps column of the linestring layout
+CREATE OR REPLACE FUNCTION trajectory_timestamps(coordinates geometry)
+RETURNS TIMESTAMP WITH TIME ZONE[] AS $$
+    SELECT ARRAY(
+        SELECT to_timestamp(ST_M(dp.geom))
+        FROM ST_DumpPoints(coordinates) AS dp
+        ORDER BY dp.path
+    );
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+
+-- Trajectories that are inside bbox between time_start and time_end, coordinates clipped to the time window.
+-- The && on x, y and M uses the n-D index (idx_<table>_coordinates_nd), ST_LocateBetween cuts the window out
+-- of the line and ST_Intersects checks that the ship was inside bbox during the window.
+CREATE OR REPLACE FUNCTION get_trajectories_in_bbox_time(
+    bbox geometry,
+    time_start TIMESTAMP WITH TIME ZONE,
+    time_end TIMESTAMP WITH TIME ZONE,
+    table_list text[]
+)
+RETURNS TABLE (
+    id integer,
+    mmsi VARCHAR,
+    route_id VARCHAR,
+    start_dt TIMESTAMP WITHOUT TIME ZONE,
+    end_dt TIMESTAMP WITHOUT TIME ZONE,
+    count integer,
+    missing_data boolean,
+    missing_data_info VARCHAR,
+    coordinates geometry,
+    timestamps TIMESTAMP WITH TIME ZONE[]
+) AS $$
+DECLARE
+    tbl text;
+    window_box geometry;
+BEGIN
+    window_box := ST_SetSRID(ST_MakeLine(
+        ST_MakePointM(ST_XMin(bbox), ST_YMin(bbox), extract(epoch FROM time_start)),
+        ST_MakePointM(ST_XMax(bbox), ST_YMax(bbox), extract(epoch FROM time_end))
+    ), ST_SRID(bbox));
+
+    FOREACH tbl IN ARRAY table_list
+    LOOP
+        RETURN QUERY EXECUTE format('
+            SELECT
+                id,
+                mmsi,
+                route_id,
+                start_dt,
+                end_dt,
+                ST_NPoints(clipped) AS count,
+                missing_data,
+                missing_data_info,
+                clipped AS coordinates,
+                trajectory_timestamps(clipped) AS timestamps
+            FROM (
+                SELECT *, ST_LocateBetween(coordinates, extract(epoch FROM $2), extract(epoch FROM $3)) AS clipped
+                FROM %I
+                WHERE coordinates &&& $4
+            ) AS windowed
+            WHERE NOT ST_IsEmpty(clipped)
+              AND ST_Intersects(clipped, $1)
+        ', tbl)
+        USING bbox, time_start, time_end, window_box;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Like get_trajectories_in_bbox_time with one row per part of a trajectory inside the window, the parts
+-- of the clipped line (ST_GeometryN) that don't touch bbox are dropped
+CREATE OR REPLACE FUNCTION get_trajectory_parts_in_bbox_time(
+    bbox geometry,
+    time_start TIMESTAMP WITH TIME ZONE,
+    time_end TIMESTAMP WITH TIME ZONE,
+    table_list text[]
+)
+RETURNS TABLE (
+    id integer,
+    mmsi VARCHAR,
+    route_id VARCHAR,
+    part integer,
+    part_start TIMESTAMP WITH TIME ZONE,
+    part_end TIMESTAMP WITH TIME ZONE,
+    coordinates geometry
+) AS $$
+BEGIN
+    RETURN QUERY
+    SELECT
+        t.id,
+        t.mmsi,
+        t.route_id,
+        n AS part,
+        to_timestamp(ST_M(ST_StartPoint(ST_GeometryN(t.coordinates, n)))) AS part_start,
+        to_timestamp(ST_M(ST_EndPoint(ST_GeometryN(t.coordinates, n)))) AS part_end,
+        ST_GeometryN(t.coordinates, n) AS coordinates
+    FROM get_trajectories_in_bbox_time(bbox, time_start, time_end, table_list) AS t,
+         generate_series(1, ST_NumGeometries(t.coordinates)) AS n
+    WHERE ST_Intersects(ST_GeometryN(t.coordinates, n), bbox);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Example usage:
+SELECT * FROM get_trajectories_in_bbox_time(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    '2023-02-01 06:00+00', '2023-02-01 18:00+00',
+    ARRAY['trajectories_2023_02']
+);
+
+SELECT * FROM get_trajectory_parts_in_bbox_time(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    '2023-02-01 06:00+00', '2023-02-01 18:00+00',
+    ARRAY['trajectories_2023_02']
+);
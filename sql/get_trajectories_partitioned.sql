@@ -0,0 +1,32 @@
+-- Queries on the partitioned trajectories table (ais_data_processor.py --partitioned), where every month
+-- trajectories_YYYY_MM is a partition for the start_dt range of the month. A filter on start_dt lets the
+-- planner skip the other months, so no table_list is needed.
+
+-- Trajectories inside bbox that overlap the window from_dt to to_dt (local time like start_dt).
+-- A trajectory that overlaps the window started at most max_duration before it, which bounds the
+-- partitions to scan; trajectories longer than max_duration that started earlier are missed.
+CREATE OR REPLACE FUNCTION get_trajectories_partitioned(
+    bbox geometry,
+    from_dt TIMESTAMP WITHOUT TIME ZONE,
+    to_dt TIMESTAMP WITHOUT TIME ZONE,
+    max_duration interval DEFAULT '31 days'
+)
+RETURNS SETOF trajectories AS $$
+    SELECT *
+    FROM trajectories
+    WHERE start_dt < to_dt
+      AND start_dt >= from_dt - max_duration
+      AND end_dt >= from_dt
+      AND ST_Intersects(coordinates, bbox);
+$$ LANGUAGE sql STABLE;
+
+
+-- Example usage:
+SELECT * FROM get_trajectories_partitioned(
+    ST_MakeEnvelope(11.7, 57.5, 11.8, 57.6, 4326),
+    '2023-02-01', '2023-03-01'
+);
+
+-- The partitions scanned, only trajectories_2023_01 to trajectories_2023_02 should show up
+EXPLAIN SELECT id FROM trajectories
+WHERE start_dt >= '2023-02-01'::timestamp - interval '31 days' AND start_dt < '2023-03-01';
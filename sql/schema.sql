@@ -1,4 +1,18 @@
 
+CREATE TABLE "default".ingestion_manifest (
+	file_path VARCHAR NOT NULL, 
+	fingerprint VARCHAR, 
+	status VARCHAR, 
+	rows_read BIGINT, 
+	year_month VARCHAR, 
+	state BYTEA, 
+	updated_at TIMESTAMP WITHOUT TIME ZONE, 
+	PRIMARY KEY (file_path)
+)
+
+;
+
+
 CREATE TABLE "default".missing_data (
 	id SERIAL NOT NULL, 
 	mmsi VARCHAR, 
@@ -45,24 +59,12 @@ CREATE TABLE "default".ships (
 ;
 
 
-CREATE TABLE "default".trajectories (
-	id SERIAL NOT NULL, 
-	mmsi VARCHAR NOT NULL, 
-	route_id VARCHAR, 
-	start_dt TIMESTAMP WITHOUT TIME ZONE, 
-	end_dt TIMESTAMP WITHOUT TIME ZONE, 
-	origin geometry(POINT,-1), 
-	destination geometry(POINT,-1), 
-	count INTEGER, 
-	duration INTERVAL, 
-	coordinates geometry(LINESTRING,-1), 
-	timestamps TIMESTAMP WITHOUT TIME ZONE[], 
-	speed_over_ground FLOAT[], 
-	navigational_status INTEGER[], 
-	course_over_ground FLOAT[], 
-	heading FLOAT[], 
-	PRIMARY KEY (id, mmsi), 
-	CONSTRAINT uix_mmsi_start_dt UNIQUE (mmsi, start_dt)
+CREATE TABLE "default".table_versions (
+	table_name VARCHAR NOT NULL, 
+	version BIGINT, 
+	updated_at TIMESTAMP WITHOUT TIME ZONE, 
+	max_duration INTERVAL, 
+	PRIMARY KEY (table_name)
 )
 
 ;
@@ -143,3 +145,35 @@ CREATE TABLE "default".voyage_segments (
 
 ;
 
+
+CREATE TABLE "default".trajectories (
+	id INTEGER DEFAULT nextval('"default".trajectories_id_seq') NOT NULL, 
+	mmsi VARCHAR, 
+	route_id VARCHAR, 
+	start_dt TIMESTAMP WITHOUT TIME ZONE, 
+	end_dt TIMESTAMP WITHOUT TIME ZONE, 
+	origin geometry(POINT,4326), 
+	destination geometry(POINT,4326), 
+	count INTEGER, 
+	duration INTERVAL, 
+	missing_data BOOLEAN, 
+	missing_data_info VARCHAR, 
+	coordinates geometry(LINESTRING,4326), 
+	timestamps TIMESTAMP WITHOUT TIME ZONE[], 
+	speed_over_ground FLOAT[], 
+	navigational_status INTEGER[], 
+	course_over_ground FLOAT[], 
+	heading FLOAT[], 
+	compression_tolerance FLOAT, 
+	sog_min FLOAT, 
+	sog_max FLOAT, 
+	sog_mean FLOAT, 
+	dominant_nav_status INTEGER, 
+	path_length_m FLOAT, 
+	ship_type INTEGER, 
+	CONSTRAINT uix_trajectories_mmsi_start_dt UNIQUE (mmsi, start_dt)
+)
+ PARTITION BY RANGE (start_dt)
+
+;
+
@@ -0,0 +1,65 @@
+-- Summary columns of the monthly tables (sog_min, sog_max, sog_mean, dominant_nav_status, path_length_m,
+-- ship_type). New rows get them at ingest (src/trajectory_segment.py segment_summaries), the rows of tables
+-- created before the columns existed are filled in here. ais_data_processor.py adds the columns to an older
+-- table the first time it writes to it, ALTER TABLE ... ADD COLUMN them by hand for tables it doesn't touch.
+
+-- Fill the summary columns of the rows of tbl that don't have them yet (path_length_m IS NULL), committing
+-- every batch_size rows so an interrupted backfill keeps its progress and the row locks are short. Works for
+-- the linestring, measured and compact layouts, the compact one needs decode_tenths (sql/compact_layout.sql).
+CREATE OR REPLACE PROCEDURE backfill_trajectory_summaries(tbl text, batch_size integer DEFAULT 10000)
+AS $$
+DECLARE
+    sog text := 't.speed_over_ground';
+    updated bigint := 0;
+    batch bigint;
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = tbl AND column_name = 'speed_over_ground_q'
+    ) THEN
+        sog := 'decode_tenths(t.speed_over_ground_q)';
+    END IF;
+
+    LOOP
+        EXECUTE format('
+            UPDATE %1$I AS t SET
+                sog_min = (SELECT min(v) FROM unnest(%2$s) AS v WHERE v <> ''NaN''),
+                sog_max = (SELECT max(v) FROM unnest(%2$s) AS v WHERE v <> ''NaN''),
+                sog_mean = (SELECT avg(v) FROM unnest(%2$s) AS v WHERE v <> ''NaN''),
+                dominant_nav_status = (
+                    SELECT n FROM unnest(t.navigational_status) AS n
+                    WHERE n IS NOT NULL
+                    GROUP BY n ORDER BY count(*) DESC, n LIMIT 1
+                ),
+                path_length_m = COALESCE(ST_Length(ST_Force2D(t.coordinates)::geography, false), 0),
+                ship_type = (SELECT s.type_of_ship_and_cargo FROM ships AS s WHERE s.mmsi = t.mmsi)
+            WHERE t.id IN (SELECT id FROM %1$I WHERE path_length_m IS NULL LIMIT $1)
+        ', tbl, sog)
+        USING batch_size;
+        GET DIAGNOSTICS batch = ROW_COUNT;
+        updated := updated + batch;
+        COMMIT;
+        EXIT WHEN batch < batch_size;
+    END LOOP;
+    RAISE NOTICE '% rows of % backfilled', updated, tbl;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Example usage:
+CALL backfill_trajectory_summaries('trajectories_2023_02');
+
+-- All monthly tables (run outside of a transaction block, the procedure commits)
+DO $$
+DECLARE
+    tbl text;
+BEGIN
+    FOR tbl IN
+        SELECT relname FROM pg_class
+        WHERE relkind IN ('r', 'p') AND relname ~ '^trajectories_[0-9]{4}_[0-9]{2}$'
+        ORDER BY relname
+    LOOP
+        CALL backfill_trajectory_summaries(tbl);
+    END LOOP;
+END;
+$$;
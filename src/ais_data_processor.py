@@ -1,33 +1,36 @@
 import pandas as pd
-from sqlalchemy.orm import Session
-from sqlalchemy import select, create_engine, text
+from sqlalchemy import text
 from datetime import datetime
-import csv, traceback
 from tqdm import tqdm
-import argparse, os, json, time, re, threading, gc, uuid
+import argparse, os, json, re, threading, uuid
 from dateutil.parser import parse
 from collections import defaultdict, OrderedDict, deque
-from geoalchemy2 import Geometry, WKTElement
-from shapely.geometry import Point, LineString
+from geoalchemy2 import WKTElement
+from shapely.geometry import LineString
 import numpy as np
 from itertools import chain
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import queue, dotenv
 from pathlib import Path
-from database_schema import ClearAIS_DB, Ships, AIS_Data, Nav_Status, Trajectories, MissingData, MissingDataTable
-from sqlalchemy.schema import UniqueConstraint, MetaData
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Enum, Boolean, DateTime, Float, BigInteger, ARRAY, Interval, JSON, Table, MetaData
-
-from utils import find_files_in_folder, try_except
+from database_schema import ClearAIS_DB, POSTGRES_SCHEMA, TRAJECTORY_LAYOUTS
+
+from utils import find_files_in_folder, try_except, FilePrefetcher
+from track_buffer import TrackBuffer, TrackStore, frame_columns, prune_snapshot_files
+from segmentation import find_segment_ends, group_offsets
+from ais_timestamps import parse_ais_timestamps, parse_unix_timestamps
+from csv_reader import read_csv_chunks
+from trajectory_queue import TrajectoryQueue, TrajectoryWriteError, DEFAULT_QUEUE_SIZE, FLUSH, LIVENESS_INTERVAL
+from trajectory_segment import TrajectorySegment, segment_rows, segment_summaries, start_months
+from trajectory_compression import compress_segments
+from checkpoint import file_fingerprint, dump_state, load_state, snapshot_directory, SNAPSHOT_ROOT
+from external_sort import sorted_month_chunks
+from index_builder import IndexBuilder
 from logger import getLogger, TqdmToLogger
-from multiprocessing import Process, Queue
+import multiprocessing as mp
 import signal
 import sys
 
 logger = getLogger(__file__,log_file_name='progress.log')
 
-csv_to_db_mapping = json.load(open("src/csv_to_db_mapping.json",'r'))
-
 from datetime import datetime
 dateparse = lambda x: datetime.strptime(x, "%d %b %Y %H:%M:%S %Z")
 
@@ -42,58 +45,18 @@ monthly_tables = {}
 route_id_tracker = {}
 missing_data = []
 
-temp_tracking_storage = defaultdict(list)
+temp_tracking_storage = TrackStore()  # open tracks by mmsi, spilled to disk over the --memory_budget
+snapshot_root = SNAPSHOT_ROOT  # spilled tracks of the checkpoints, <spill_dir>/checkpoints with --spill_dir
 complete_trajectories = defaultdict(list)
 nav_status_set = {}
+# Nav statuses the trajectory workers already have, per shard, chunks only carry the new ones
+shard_nav_statuses = []
+# Trajectory worker process of every shard, checked while the reader waits on a full shard queue
+shard_workers = []
+# Last ship of the previous chunk of a (mmsi, timestamp) sorted stream, the only one whose rows can continue
+sorted_stream_last = None
 ships_data_df = pd.DataFrame([])
 
-def create_monthly_table(session, year_month):
-    """Create a monthly table for trajectories if it doesn't exist"""
-    table_name = f"trajectories_{year_month}"
-    schema_name = POSTGRES_SCHEMA
-
-    print(table_name, )
-    
-    # Check if table exists
-    exists = session.execute(
-        text("""
-            SELECT 1
-            FROM information_schema.tables
-            WHERE table_name = :table_name
-              AND table_schema = :schema_name
-            LIMIT 1
-        """),
-        {"table_name": table_name, "schema_name": schema_name}
-    ).first()
-    
-    if not exists:
-        # Create table with same schema as Trajectories
-        metadata = MetaData(schema=POSTGRES_SCHEMA)
-        monthly_table = Table(
-            table_name, metadata,
-            Column('id', Integer, primary_key=True, autoincrement=True),
-            Column('mmsi', String),
-            Column('route_id', String),
-            Column('start_dt', DateTime),
-            Column('end_dt', DateTime),
-            Column('origin', Geometry('POINT', 4326)),
-            Column('destination', Geometry('POINT', 4326)),
-            Column('count', Integer),
-            Column('duration', Interval),
-            Column('missing_data', Boolean),
-            Column('missing_data_info', String,nullable=True),
-            Column('coordinates', Geometry('LINESTRING', 4326)),
-            Column('timestamps', ARRAY(DateTime)),
-            Column('speed_over_ground', ARRAY(Float),nullable=True),
-            Column('navigational_status', ARRAY(Integer),nullable=True),
-            Column('course_over_ground', ARRAY(Float),nullable=True),
-            Column('heading', ARRAY(Float),nullable=True),
-            UniqueConstraint('mmsi', 'start_dt', name=f'uix_mmsi_start_dt_{year_month}')
-        )
-        monthly_table.create(session.get_bind(), checkfirst=True)
-    
-    return table_name
-
 def create_geom_from_latlon(lat, lon):
     point_wkt = f'POINT({lon} {lat})'
     geom = WKTElement(point_wkt, srid=4326)
@@ -106,210 +69,509 @@ def signal_handler(signum, frame):
     print("Received signal to terminate. Cleaning up...")
     sys.exit(0)
 
-def insert_complete_trajectories_to_db(trajectory_queue:deque, database_url, completed_files):
-    
-    bulk_inserter = ClearAIS_DB(database_url)
+def build_trajectory_row(mmsi, traj, route_id, missing_data_bool, missing_data_info):
+    """
+    Trajectory row for the monthly tables from a segment DataFrame, the writers use the
+    vectorised segment_rows on TrajectorySegments, this is kept as the reference.
+    """
+    first = traj.iloc[0]
+    last = traj.iloc[-1]
+    coordinates = LineString(list(zip(traj['longitude'], traj['latitude']))).wkt
+    return {
+        "mmsi": mmsi,
+        'route_id': route_id,
+        "start_dt": first.timestamp,
+        "end_dt": last.timestamp,
+        "origin": create_geom_from_latlon(first.latitude, first.longitude),
+        "destination": create_geom_from_latlon(last.latitude, last.longitude),
+        "count": traj.shape[0],
+        "duration": last.timestamp - first.timestamp,
+        "missing_data": missing_data_bool,
+        "missing_data_info": json.dumps(missing_data_info),
+        "coordinates": coordinates,
+        "timestamps": traj.timestamp,
+        "speed_over_ground": traj.get("speed_over_ground"),
+        "navigational_status": traj.get("navigational_status"),
+        "course_over_ground": traj.get("course_over_ground"),
+        "heading": traj.get("heading")
+    }
+
+def write_trajectories(bulk_inserter:ClearAIS_DB, trajectories_list, writer="insert", compress_tolerance=None,
+                       layout="linestring"):
+    """
+    Insert TrajectorySegments into their monthly tables with the insert or copy writer,
+    simplified first to compress_tolerance metres (SED) when it is given. New monthly tables are
+    created in the given layout, rows are built in the layout of the table they go to.
+
+    Segments go to the table of the month of their csv file, or of their start_dt when the monthly
+    tables are partitions of the trajectories table (range partitioned by start_dt).
+    The summary columns are computed before the compression, from all the fixes.
+    """
+    summaries = segment_summaries(trajectories_list, bulk_inserter.ship_types({segment.mmsi for segment in trajectories_list}))
+    segments = compress_segments(trajectories_list, compress_tolerance)
+    if bulk_inserter.partitioning() is not None:
+        # start_dt is stored as local time in the session time zone, the partition bounds are in it too
+        months = start_months(segments, bulk_inserter.session_timezone())
+    else:
+        months = [segment.year_month for segment in segments]
+
+    # Group trajectories by month
+    monthly_trajectories = defaultdict(list)
+    for segment, summary, year_month in zip(segments, summaries, months):
+        monthly_trajectories[year_month].append((segment, summary))
+
+    # Insert into respective monthly tables
+    for year_month, month_trajectories in monthly_trajectories.items():
+        table_name = bulk_inserter.create_monthly_table(year_month, layout)
+        month_segments, month_summaries = zip(*month_trajectories)
+        month_data = segment_rows(list(month_segments), layout=bulk_inserter.table_layout(table_name),
+                                  summaries=list(month_summaries))
+        if writer == "copy":
+            bulk_inserter.copy_insert(table_name, month_data)
+        else:
+            bulk_inserter.bulk_insert(table_name, month_data)
+
+def insert_complete_trajectories_to_db(trajectory_queue:TrajectoryQueue, database_url, writer="insert", compress_tolerance=None,
+                                       layout="linestring"):
+    """Writer loop: takes segments off the queue until its None sentinel and writes them in batches"""
+    bulk_inserter = ClearAIS_DB.shared(database_url)
     trajectories_list = []
     
     try:
         while True:
+            # Blocks until the reader hands over a segment or the sentinel
+            data = trajectory_queue.get()
+            if data is None:  # Stop the writer
+                break
+            if data == FLUSH:  # Checkpoint barrier, write the pending batch now
+                try:
+                    if len(trajectories_list) > 0:
+                        write_trajectories(bulk_inserter, trajectories_list, writer, compress_tolerance, layout)
+                except Exception as e:
+                    logger.error(f"Error in insert_complete_trajectories_to_db: {str(e)}")
+                    logger.exception("Full traceback:")
+                    trajectory_queue.record_failure()
+                finally:
+                    trajectories_list = []
+                    trajectory_queue.flushed()
+                continue
+
+            # A failed batch is logged, dropped and recorded so no checkpoint moves past it,
+            # the writer keeps draining so the reader can't block on a full queue
             try:
-                # Get data from queue with timeout
-                data = trajectory_queue.popleft()
-                if data is None:  # Stop the process
-                    break
-                    
-                mmsi, ais_data = data
-                complete_trajectories[mmsi] = []
-                ais_data_len = len(ais_data)
-                
-                if ais_data_len > 0:
-                    for _ in range(ais_data_len):
-                        (traj, route_id, year_month, missing_data_bool, missing_data_info ) = ais_data.pop()
-                        first = traj.iloc[0]
-                        last = traj.iloc[-1]
-                        coordinates = LineString(list(zip(traj['longitude'], traj['latitude']))).wkt
-                        row = {
-                            "mmsi": mmsi,
-                            'route_id': route_id,
-                            "start_dt": first.timestamp,
-                            "end_dt": last.timestamp,
-                            "origin": create_geom_from_latlon(first.latitude, first.longitude),
-                            "destination": create_geom_from_latlon(last.latitude, last.longitude),
-                            "count": traj.shape[0],
-                            "duration": last.timestamp - first.timestamp,
-                            "missing_data": missing_data_bool,
-                            "missing_data_info": json.dumps(missing_data_info),
-                            "coordinates": coordinates,
-                            "timestamps": traj.timestamp,
-                            "speed_over_ground": traj.get("speed_over_ground"),
-                            "navigational_status": traj.get("navigational_status"),
-                            "course_over_ground": traj.get("course_over_ground"),
-                            "heading": traj.get("heading")
-                        }
-                        trajectories_list.append((row, year_month))
+                trajectories_list.append(data)
 
                 if len(trajectories_list) > 100:
-                    # Group trajectories by month
-                    monthly_trajectories = defaultdict(list)
-                    for row, year_month in trajectories_list:
-                        monthly_trajectories[year_month].append(row)
-                    
-                    # Insert into respective monthly tables
-                    with bulk_inserter.Session() as session:
-                        for year_month, month_data in monthly_trajectories.items():
-                            table_name = create_monthly_table(session, year_month)
-                            bulk_inserter.bulk_insert(table_name, month_data)
+                    write_trajectories(bulk_inserter, trajectories_list, writer, compress_tolerance, layout)
                     
                     # logger.info(f"Inserted {len(trajectories_list)} Trajectories")
                     trajectories_list = []
 
-
-            except IndexError:
-                # Queue is empty, check if we should continue
-                if len(completed_files) > 0:
-                    break
-                time.sleep(1)
-                continue
+            except Exception as e:
+                logger.error(f"Error in insert_complete_trajectories_to_db: {str(e)}")
+                logger.exception("Full traceback:")
+                trajectory_queue.record_failure()
+                trajectories_list = []
                 
-    except Exception as e:
-        logger.error(f"Error in insert_complete_trajectories_to_db: {str(e)}")
-        logger.exception("Full traceback:")
     finally:
         # Insert any remaining trajectories
         if len(trajectories_list)>0:
-            monthly_trajectories = defaultdict(list)
-            for row, year_month in trajectories_list:
-                monthly_trajectories[year_month].append(row)
-            
-            with bulk_inserter.Session() as session:
-                for year_month, month_data in monthly_trajectories.items():
-                    table_name = create_monthly_table(session, year_month)
-                    bulk_inserter.bulk_insert(table_name, month_data)
+            write_trajectories(bulk_inserter, trajectories_list, writer, compress_tolerance, layout)
             
             logger.info(f"Inserted final batch of {len(trajectories_list)} Trajectories")
 
-def process_file(file_path, year_month, trajectory_queue,completed_files:deque, chunk_size = 100000):
-    """Process a single CSV file and extract year-month from filename"""
+def trajectory_writer_process(writer_id, trajectory_queue, database_url, writer="insert", pool_options=None,
+                              compress_tolerance=None, layout="linestring"):
+    """Writer process with its own connection pool"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ClearAIS_DB.configure_pool(**(pool_options or {}))
+    ClearAIS_DB.configure_pool(application_name=f"clear_ais_writer_{writer_id}")
+    insert_complete_trajectories_to_db(trajectory_queue, database_url, writer, compress_tolerance, layout)
+
+def start_trajectory_writers(num_writers, database_url, writer="insert", kind="thread", pool_options=None,
+                             queue_size=DEFAULT_QUEUE_SIZE, compress_tolerance=None, layout="linestring"):
+    """
+    Bounded trajectory queue and the writer threads or processes taking segments off it,
+    each writer checks out its own connection.
+    """
+    if kind == "process":
+        ctx = mp.get_context("spawn")
+        trajectory_queue = TrajectoryQueue(queue_size, ctx=ctx, writers=num_writers)
+        writers = [ctx.Process(target=trajectory_writer_process, args=(writer_id, trajectory_queue, database_url, writer, pool_options, compress_tolerance, layout),
+                               name=f"trajectory_writer_{writer_id}")
+                   for writer_id in range(num_writers)]
+    else:
+        trajectory_queue = TrajectoryQueue(queue_size, writers=num_writers)
+        writers = [threading.Thread(target=insert_complete_trajectories_to_db, args=(trajectory_queue, database_url, writer, compress_tolerance, layout),
+                                    name=f"trajectory_writer_{writer_id}")
+                   for writer_id in range(num_writers)]
+    for writer_worker in writers:
+        writer_worker.start()
+    # A put or flush that waits on a dead writer raises instead of hanging the ingest
+    trajectory_queue.watch(writers)
+    return trajectory_queue, writers
+
+def stop_trajectory_writers(trajectory_queue:TrajectoryQueue, writers):
+    """Send one sentinel per writer and wait until the queued segments are written"""
+    trajectory_queue.close()
+    for writer_worker in writers:
+        writer_worker.join()
+    failed = [writer_worker.name for writer_worker in writers if getattr(writer_worker, "exitcode", 0)]
+    if failed:
+        raise RuntimeError(f"Trajectory writers failed: {', '.join(failed)}")
+
+def shard_of_mmsi(mmsi, num_shards):
+    """Stable shard index for each mmsi, the same in every process and run"""
+    return pd.util.hash_array(np.asarray(mmsi, dtype=object)) % num_shards
+
+def check_trajectory_workers():
+    """Raise if a trajectory worker is gone, nothing takes the chunks of its shard anymore"""
+    dead = [worker.name for worker in shard_workers if not worker.is_alive()]
+    if dead:
+        raise RuntimeError(f"Trajectory workers stopped unexpectedly: {', '.join(dead)}")
+
+def put_to_shard(shard_queue, worker, item):
+    """Put on a shard queue, waiting for a free slot while the shard's worker is alive"""
+    while True:
+        try:
+            shard_queue.put(item, timeout=LIVENESS_INTERVAL)
+            return
+        except queue.Full:
+            if worker is not None and not worker.is_alive():
+                raise RuntimeError(f"Trajectory worker stopped unexpectedly: {worker.name}")
+
+def dispatch_to_shards(ais_data, year_month, filename, shard_queues, sorted_input=False):
+    """Fan out the rows of a chunk to the trajectory workers by hashing the mmsi, keeping their order"""
+    shards = shard_of_mmsi(ais_data['mmsi'].values, len(shard_queues))
+    for shard, group in ais_data.groupby(shards):
+        known = shard_nav_statuses[shard]
+        nav_statuses = {code: text for code, text in nav_status_set.items() if known.get(code) != text}
+        known.update(nav_statuses)
+        worker = shard_workers[shard] if shard_workers else None
+        put_to_shard(shard_queues[shard], worker, (group, year_month, filename, nav_statuses or None, sorted_input))
+
+def trajectory_worker(worker_id, shard_queue, database_url, writer="insert", pool_options=None, num_writers=1,
+                      queue_size=DEFAULT_QUEUE_SIZE, memory_budget=None, spill_dir=None, compress_tolerance=None,
+                      layout="linestring", writer_kind="thread", nav_statuses=None):
+    """
+    Worker process owning the split_trajectories state (temp_tracking_storage, route_id_tracker)
+    for the ships of one mmsi shard, so segments and route_ids stay continuous across files.
+    nav_statuses are the ones known at startup, the chunks carry the ones seen later.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    nav_status_set.update(nav_statuses or {})
+    ClearAIS_DB.configure_pool(**(pool_options or {}))
+    ClearAIS_DB.configure_pool(application_name=f"clear_ais_worker_{worker_id}")
+    temp_tracking_storage.configure(memory_budget, spill_dir)
+
+    trajectory_queue, writers = start_trajectory_writers(num_writers, database_url, writer, writer_kind, pool_options,
+                                                         queue_size, compress_tolerance, layout)
+
     try:
-        # Get total number of lines in file for progress bar
-        total_lines = sum(1 for _ in open(file_path, 'r')) - 1  # Subtract header line
-        chunk_size = chunk_size
-        total_chunks = (total_lines + chunk_size - 1) // chunk_size
-        
-        # Create progress bar for this file
-        with tqdm(total=total_chunks, desc=f"Processing {os.path.basename(file_path)}", 
-                 unit="chunk", leave=False) as pbar:
-            read_and_transform_csv_chunk(
+        while True:
+            data = shard_queue.get()
+            if data is None:  # Stop the worker
+                break
+
+            chunk, year_month, filename, nav_statuses, sorted_input = data
+            if nav_statuses:
+                nav_status_set.update(nav_statuses)
+            try:
+                split_trajectories(chunk, year_month, filename, trajectory_queue, sorted_input)
+            except Exception as e:
+                logger.error(f"Error processing chunk from {filename} in trajectory worker {worker_id}: {str(e)}")
+                logger.exception("Full traceback:")
+                # Without its writers the worker can't go on
+                trajectory_queue.check_writers()
+    except Exception as e:
+        logger.error(f"Error in trajectory worker {worker_id}: {str(e)}")
+        logger.exception("Full traceback:")
+        raise
+    finally:
+        stop_trajectory_writers(trajectory_queue, writers)
+        logger.info(f"Trajectory worker {worker_id} finished, queue: {trajectory_queue.stats()}, "
+                    f"tracks: {temp_tracking_storage.stats()}, pool: {ClearAIS_DB.shared(database_url).pool_stats()}")
+        temp_tracking_storage.close()
+
+def start_trajectory_workers(num_workers, database_url, writer="insert", pool_options=None, queue_size=4,
+                             num_writers=1, trajectory_queue_size=DEFAULT_QUEUE_SIZE, memory_budget=None, spill_dir=None,
+                             compress_tolerance=None, layout="linestring", writer_kind="thread"):
+    """Start one trajectory worker process per mmsi shard, the memory budget is split between them"""
+    worker_budget = memory_budget // num_workers if memory_budget else None
+    ctx = mp.get_context("spawn")
+    shard_queues = [ctx.Queue(maxsize=queue_size) for _ in range(num_workers)]
+    shard_nav_statuses[:] = [dict(nav_status_set) for _ in range(num_workers)]
+    workers = []
+    for worker_id, shard_queue in enumerate(shard_queues):
+        worker = ctx.Process(target=trajectory_worker, args=(worker_id, shard_queue, database_url, writer, pool_options,
+                                                             num_writers, trajectory_queue_size, worker_budget, spill_dir,
+                                                             compress_tolerance, layout, writer_kind, dict(nav_status_set)),
+                             name=f"trajectory_worker_{worker_id}")
+        worker.start()
+        workers.append(worker)
+    shard_workers[:] = workers
+    return shard_queues, workers
+
+def stop_trajectory_workers(shard_queues, workers):
+    # Send poison pills to stop the workers, the dead ones can't take theirs
+    for shard_queue, worker in zip(shard_queues, workers):
+        try:
+            put_to_shard(shard_queue, worker, None)
+        except RuntimeError:
+            pass
+    for worker in workers:
+        worker.join()
+    shard_workers.clear()
+    failed = [worker.name for worker in workers if getattr(worker, "exitcode", 0)]
+    if failed:
+        raise RuntimeError(f"Trajectory workers failed: {', '.join(failed)}")
+
+def snapshot_tracking_state(directory):
+    """
+    Snapshot of the split_trajectories state: open tracks, route ids and nav statuses. The spilled
+    tracks stay on disk, their files are linked into directory (TrackStore.snapshot)
+    """
+    return {"track_store": temp_tracking_storage.snapshot(directory), "route_ids": dict(route_id_tracker),
+            "nav_statuses": dict(nav_status_set)}
+
+def restore_tracking_state(blob):
+    state = load_state(blob)
+    if "track_store" in state:
+        temp_tracking_storage.restore(state["track_store"])
+    else:
+        # Checkpoints saved before the spilled tracks were kept as files
+        temp_tracking_storage.clear()
+        temp_tracking_storage.update(state["tracks"])
+    route_id_tracker.clear()
+    route_id_tracker.update(state["route_ids"])
+    nav_status_set.clear()
+    nav_status_set.update(state["nav_statuses"])
+
+def save_checkpoint(file_path, fingerprint, status, rows_read, year_month, trajectory_queue:TrajectoryQueue):
+    """
+    Record the progress of a file in the ingestion manifest. The writers are flushed first, so
+    every segment split off before rows_read is in the database when the checkpoint is committed.
+    Returns False without saving when a batch failed to write, resume then reads those rows again.
+    """
+    try:
+        trajectory_queue.flush()
+    except TrajectoryWriteError as e:
+        logger.error(f"Checkpoint of {file_path} at row {rows_read} not saved: {str(e)}")
+        return False
+    directory = snapshot_directory(snapshot_root, file_path)
+    state = snapshot_tracking_state(directory)
+    ClearAIS_DB.shared(database_url).save_checkpoint(file_path, fingerprint=fingerprint, status=status, rows_read=rows_read,
+                                                     year_month=year_month, state=dump_state(state))
+    # The files only the replaced checkpoint of the file used
+    prune_snapshot_files(directory, state["track_store"])
+    return True
+
+def process_file(file_path, year_month, trajectory_queue,completed_files:deque, chunk_size = 100000, shard_queues=None,
+                 checkpoint_every=0, start_row=0):
+    """
+    Process a single CSV file and extract year-month from filename.
+    With checkpoint_every the progress is saved to the ingestion manifest every checkpoint_every chunks
+    and when the file is done, start_row resumes a file from its checkpoint.
+    """
+    try:
+        on_chunk = None
+        if checkpoint_every:
+            fingerprint = file_fingerprint(file_path)
+            chunks_read = 0
+
+            def on_chunk(rows_read, chunk_year_month):
+                nonlocal chunks_read
+                chunks_read += 1
+                if chunks_read % checkpoint_every == 0:
+                    save_checkpoint(file_path, fingerprint, "partial", rows_read, chunk_year_month, trajectory_queue)
+
+        # Progress in bytes consumed by the csv reader, no extra pass to count the lines
+        with tqdm(total=os.path.getsize(file_path), desc=f"Processing {os.path.basename(file_path)}", 
+                 unit="B", unit_scale=True, leave=False) as pbar:
+            result = read_and_transform_csv_chunk(
                 file_path=file_path,
                 chunk_size=chunk_size,
                 year_month=year_month,
                 filename=file_path,
                 trajectory_queue=trajectory_queue,
-                progress_bar=pbar
+                progress_bar=pbar,
+                shard_queues=shard_queues,
+                start_row=start_row,
+                on_chunk=on_chunk
             )
+        if result is False:  # logged by try_except, the last checkpoint stays
+            return
+        if checkpoint_every:
+            rows_read, year_month = result
+            if not save_checkpoint(file_path, fingerprint, "completed", rows_read, year_month, trajectory_queue):
+                return  # not completed, the previous file keeps the snapshot to resume from
         completed_files.append(file_path)
     except Exception as e:
         logger.error(f"Error processing file {file_path}: {str(e)}")
 
-def split_trajectories(chunk, year_month, filename, trajectory_queue:deque):
+def process_sorted_month(csv_files, year_month, trajectory_queue, completed_files:deque, chunk_size = 100000, shard_queues=None,
+                         sort_dir=None, processes=None, num_partitions=None):
+    """Process the csv files of a month as one stream sorted by (mmsi, timestamp), see external_sort"""
+    try:
+        chunks = sorted_month_chunks(csv_files, sort_dir, processes, num_partitions, chunk_size)
+        result = read_and_transform_csv_chunk(
+            file_path=f"{year_month} (sorted)",
+            chunk_size=chunk_size,
+            year_month=year_month,
+            filename=year_month,
+            trajectory_queue=trajectory_queue,
+            shard_queues=shard_queues,
+            chunks=chunks,
+            sorted_input=True
+        )
+        if result is not False:
+            completed_files.extend(csv_files)
+    except Exception as e:
+        logger.error(f"Error processing the sorted files of {year_month}: {str(e)}")
+
+def resume_point(bulk_inserter:ClearAIS_DB, file_path):
+    """
+    Checkpoint of a file in the ingestion manifest if its content is unchanged, else None.
+    Returns (completed, rows_read, year_month, state).
+    """
+    checkpoint = bulk_inserter.get_checkpoint(file_path)
+    if checkpoint is None or checkpoint.fingerprint != file_fingerprint(file_path):
+        return None
+    return checkpoint.status == "completed", checkpoint.rows_read, checkpoint.year_month, checkpoint.state
+
+def is_stationary_status(codes):
+    """Boolean array, True where the navigational status code is a stationary status"""
+    uniques, inverse = np.unique(codes, return_inverse=True)
+    stationary = np.array([nav_status_set.get(code) in NAV_STATUS_STATIONARY for code in uniques.tolist()], dtype=bool)
+    return stationary[inverse]
+
+def finished_sorted_tracks(mmsis, last_mmsi, ready):
+    """
+    Ships whose rows ended in a stream sorted by (mmsi, timestamp): the ships of the chunk and the last
+    one of the previous chunk, except the last ship of this chunk, which can continue in the next one
+    """
+    global sorted_stream_last
+    candidates = dict.fromkeys(chain([sorted_stream_last], mmsis))
+    sorted_stream_last = last_mmsi
+    ready = set(ready)
+    finished = []
+    for mmsi in candidates:
+        if mmsi is None or mmsi == last_mmsi or mmsi in ready or mmsi not in temp_tracking_storage:
+            continue
+        if len(temp_tracking_storage[mmsi]) > 1:
+            finished.append(mmsi)
+        else:
+            # A single fix makes no LINESTRING
+            del temp_tracking_storage[mmsi]
+    return finished
+
+def split_trajectories(chunk, year_month, filename, trajectory_queue:TrajectoryQueue, sorted_input=False):
+    """
+    Append the rows of a chunk to the open tracks and hand the tracks over 500 rows to the writers.
+    With sorted_input (a stream sorted by (mmsi, timestamp), --sort_prepass) the tracks of the ships
+    whose rows ended are handed over too, so only the ships of the current chunk stay buffered.
+    """
     global temp_tracking_storage
 
-    for mmsi, group in chunk.groupby('mmsi'):
-        voyage_segment_end = False
+    # Spill the tracks of the ships that haven't reported for the longest time if over the memory budget
+    temp_tracking_storage.enforce_budget()
+
+    # Order the chunk by mmsi once and append each ship's rows as array slices
+    mmsi_codes, mmsis = pd.factorize(chunk['mmsi'], sort=True)
+    order = np.argsort(mmsi_codes, kind="stable")
+    bounds = group_offsets(np.bincount(mmsi_codes[mmsi_codes >= 0], minlength=len(mmsis)))
+    columns, tz = frame_columns(chunk.iloc[order])
+
+    ready = []
+    for i, mmsi in enumerate(mmsis):
+        rows = {name: values[bounds[i]:bounds[i + 1]] for name, values in columns.items()}
         if mmsi in temp_tracking_storage:
-            temp_tracking_storage[mmsi] = pd.concat([temp_tracking_storage[mmsi], group], ignore_index=True).sort_values(['timestamp'], ascending=[True])
+            temp_tracking_storage[mmsi].append_columns(rows, tz)
         else:
             if mmsi not in route_id_tracker:
                 route_id_tracker[mmsi] = generate_route_id()
-            temp_tracking_storage[mmsi] = group
+            temp_tracking_storage[mmsi] = TrackBuffer(capacity=max(64, 2 * (bounds[i + 1] - bounds[i])))
+            temp_tracking_storage[mmsi].append_columns(rows, tz)
 
         # TODO: check the limit and also deal with shorter segments
-        if temp_tracking_storage[mmsi].shape[0] > 500:
-            traj_data = temp_tracking_storage[mmsi]
-            diff = traj_data['timestamp'].diff()
-
-            gap_threshold_days = pd.Timedelta('1 day')
-            gap_threshold_months = pd.Timedelta(days=27)
-
-            large_gaps_days = diff > gap_threshold_days
-            large_gaps_months = diff > gap_threshold_months
-
-            missing_data_bool = any(large_gaps_days) or any(large_gaps_months)
-
-            # if not any(large_gaps_months):
-            middle_index = len(traj_data) // 2
-            middle_df = traj_data.iloc[middle_index-10:middle_index+10]
-            middle_avg_speed = middle_df['speed_over_ground'].mean()
-            middle_nav_status = middle_df['navigational_status'].mode()[0]
-
-            last_rows = traj_data.tail(20)
-            mean_speed = last_rows['speed_over_ground'].mean()
-            median_nav_status = last_rows['navigational_status'].mode()[0]
-
-            if nav_status_set[middle_nav_status] not in NAV_STATUS_STATIONARY and middle_avg_speed > UPPER_SOG_THRESHOLD:
-                if nav_status_set[median_nav_status] in NAV_STATUS_STATIONARY and mean_speed < SOG_THRESHOLD:
-                    voyage_segment_end = True
-
-            route_id = route_id_tracker[mmsi]
-            if voyage_segment_end:
-                del route_id_tracker[mmsi]
-
-            
-            missing_data_info = {}
-            if missing_data_bool:
-                if any(large_gaps_months):
-                    gap_duration = 'more than 27 day' 
-                else:
-                    gap_duration = 'more than a day'
-
-                index1 = np.where(large_gaps_months==True)
-                index2 = np.where(large_gaps_days==True)
-                missing_data_indices = list(chain.from_iterable(index1)) + list(chain.from_iterable(index2))
-                missing_data_indices  = [val.item() for val in missing_data_indices]
-
-                missing_data_info = {'indices': missing_data_indices, "gap_duration":gap_duration}
-
-            # Put trajectory data in queue
-            trajectory_queue.append((mmsi, [(traj_data, route_id, year_month,missing_data_bool, missing_data_info )]))
-            
-            del temp_tracking_storage[mmsi]
+        if len(temp_tracking_storage[mmsi]) > 500:
+            ready.append(mmsi)
+
+    if sorted_input and len(chunk):
+        ready += finished_sorted_tracks(mmsis, chunk['mmsi'].iloc[-1], ready)
+
+    if not ready:
+        return
+
+    # Voyage end and missing data tests for all complete tracks of the chunk at once
+    buffers = [temp_tracking_storage[mmsi] for mmsi in ready]
+    segment_ends = find_segment_ends(
+        np.concatenate([buffer.sorted_column('timestamp') for buffer in buffers]),
+        np.concatenate([buffer.sorted_column('speed_over_ground') for buffer in buffers]),
+        np.concatenate([buffer.sorted_column('navigational_status') for buffer in buffers]),
+        [len(buffer) for buffer in buffers],
+        is_stationary_status, SOG_THRESHOLD, UPPER_SOG_THRESHOLD)
+    offsets = segment_ends['offsets']
+
+    for i, mmsi in enumerate(ready):
+        voyage_segment_end = segment_ends['voyage_end'][i]
+        missing_data_bool = bool(segment_ends['gap_days'][i] or segment_ends['gap_months'][i])
+
+        route_id = route_id_tracker[mmsi]
+        if voyage_segment_end:
+            del route_id_tracker[mmsi]
+
+        missing_data_info = {}
+        if missing_data_bool:
+            if segment_ends['gap_months'][i]:
+                gap_duration = 'more than 27 day' 
+            else:
+                gap_duration = 'more than a day'
+
+            large_gaps_months = segment_ends['large_gaps_months'][offsets[i]:offsets[i + 1]]
+            large_gaps_days = segment_ends['large_gaps_days'][offsets[i]:offsets[i + 1]]
+            missing_data_indices = np.flatnonzero(large_gaps_months).tolist() + np.flatnonzero(large_gaps_days).tolist()
+
+            missing_data_info = {'indices': missing_data_indices, "gap_duration":gap_duration}
+
+        # Put trajectory data in queue
+        trajectory_queue.put(TrajectorySegment.from_buffer(mmsi, temp_tracking_storage[mmsi], route_id, year_month,
+                                                           missing_data_bool, missing_data_info))
+        
+        del temp_tracking_storage[mmsi]
 
 
 @try_except(logger=logger)
 def read_and_transform_csv_chunk(file_path, chunk_size=10000, year_month=None, filename=None, 
-                               trajectory_queue=None, progress_bar=None):
+                               trajectory_queue=None, progress_bar=None, shard_queues=None,
+                               start_row=0, on_chunk=None, chunks=None, sorted_input=False):
     """
     Generator to read and transform CSV data in chunks and collect unique navigational statuses.
+    With shard_queues the AIS rows are fanned out to the trajectory workers instead of split here.
+    Reading starts at data row start_row, on_chunk(rows_read, year_month) is called after every chunk.
+    chunks replaces the csv reader with another source of read_csv_chunks style chunks (sort pre-pass),
+    sorted_input tells split_trajectories they are sorted by (mmsi, timestamp).
+    Returns the rows read and the year_month.
     """
     global ships_data_df
     global nav_status_set
 
-    bulk_inserter = ClearAIS_DB(database_url)
+    bulk_inserter = ClearAIS_DB.shared(database_url)
 
-    for chunk in pd.read_csv(file_path, chunksize=chunk_size):
+    rows_read = start_row
+    if chunks is None:
+        chunks = read_csv_chunks(file_path, chunk_size, progress_bar, skip_rows=start_row)
+    for chunk in chunks:
+        rows_read += len(chunk)
         try:
-            chunk.drop(chunk.columns[chunk.columns.str.contains('unnamed', case=False)], axis=1, inplace=True)
-            chunk = chunk.rename(columns=csv_to_db_mapping)
             chunk.dropna(subset=['type_of_ship_and_cargo','type_of_ship', 'type_of_cargo','draught'], inplace=True)
             chunk = chunk.astype({'mmsi':str, 'imo':str, 'type_of_ship':int, 'type_of_cargo':int, 'type_of_ship_and_cargo':int})
             
-            ts = chunk['timestamp'].str.replace(r'\.\d{1,6}|\s+[A-Za-z]+$', '', regex=True)
-            month_map = {
-                r'\bmaj\b': 'May', r'\bokt\b': 'Oct',
-                r'\bMaj\b': 'May', r'\bOkt\b': 'Oct'
-            }
-            # Replace month names to english
-            ts = ts.replace(month_map, regex=True)
-
-            chunk['timestamp'] = pd.to_datetime(ts, format='%d %b %Y %H:%M:%S')
-
-
-            chunk['timestamp'] = chunk['timestamp'].dt.tz_localize(
-                'Europe/Berlin',
-                ambiguous=False,       # or use False (standard time), True (DST), or 'NaT' to mark ambiguous
-                nonexistent='shift_forward'  # or 'NaT', 'shift_forward', 'shift_backward'
-            )
+            # Decode the time stamps, from the UNIX time stamp column when the file has one
+            if 'unix_time_stamp' in chunk.columns and chunk['unix_time_stamp'].notna().all():
+                chunk['timestamp'] = parse_unix_timestamps(chunk['unix_time_stamp'])
+            else:
+                chunk['timestamp'] = parse_ais_timestamps(chunk['timestamp'])
 
             if year_month is None:
                 date_obj = chunk['timestamp'].iloc[:-1][0]
@@ -333,16 +595,22 @@ def read_and_transform_csv_chunk(file_path, chunk_size=10000, year_month=None, f
             ais_data_cols = ['timestamp', 'mmsi', 'latitude', 'longitude', 'navigational_status', 'navigational_status_text', 'speed_over_ground', 'heading','course_over_ground','country_ais', 'destination']
             ais_data = chunk.filter(items=ais_data_cols).copy()
             
-            split_trajectories(ais_data, year_month, filename, trajectory_queue)
-            
-            # Update progress bar
-            if progress_bar:
-                progress_bar.update(1)
+            if shard_queues:
+                dispatch_to_shards(ais_data, year_month, filename, shard_queues, sorted_input)
+            else:
+                split_trajectories(ais_data, year_month, filename, trajectory_queue, sorted_input)
             
         except Exception as e:
             logger.error(f"Error processing chunk from {file_path}: {str(e)}")
             logger.exception("Full traceback:")
-            continue
+            if shard_queues:
+                # A dead worker fails the ingest instead of every following chunk
+                check_trajectory_workers()
+
+        if on_chunk:
+            on_chunk(rows_read, year_month)
+
+    return rows_read, year_month
 
 def sort_filenames_unixstyle(filenames:list):
     def natural_sort_key(filename):
@@ -406,30 +674,94 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--datapath', type=str, default=file_path, help='csv files directory')
     parser.add_argument('--db_url', type=str, default=database_url, help="Postgres database url")
+    parser.add_argument('--workers', type=int, default=1, help="number of trajectory worker processes, rows are sharded by mmsi")
+    parser.add_argument('--writer', type=str, default="insert", choices=["insert", "copy"], help="trajectory writer: sqlalchemy insert or COPY through a staging table")
+    parser.add_argument('--pool_size', type=int, default=5, help="db connection pool size per process")
+    parser.add_argument('--statement_timeout', type=int, default=None, help="db statement timeout in milliseconds")
+    parser.add_argument('--prefetch', action='store_true', help="read the next csv file in the background while the current one is processed")
+    parser.add_argument('--writers', type=int, default=1, help="number of trajectory writers (per worker process with --workers), one db connection each")
+    parser.add_argument('--writer_kind', type=str, default="thread", choices=["thread", "process"], help="run the trajectory writers as threads or processes")
+    parser.add_argument('--queue_size', type=int, default=DEFAULT_QUEUE_SIZE, help="completed trajectories buffered for the writers before the reader waits")
+    parser.add_argument('--checkpoint_every', type=int, default=0, help="save the progress to the ingestion manifest every N chunks and at the end of each file for --resume, flushing the writers first; 0 (default) disables checkpoints")
+    parser.add_argument('--memory_budget', type=int, default=None, help="MB of open tracks kept in memory, the tracks of the ships that haven't reported for the longest time are spilled to disk beyond it")
+    parser.add_argument('--spill_dir', type=str, default=None, help="directory for the spilled tracks, a temporary directory by default")
+    parser.add_argument('--sort_prepass', action='store_true', help="sort each month of csv files by (mmsi, timestamp) on local disk before building the trajectories")
+    parser.add_argument('--sort_dir', type=str, default=None, help="local directory for the sort runs, the system temporary directory by default")
+    parser.add_argument('--sort_processes', type=int, default=None, help="processes of the sort pre-pass, all cores by default")
+    parser.add_argument('--sort_partitions', type=int, default=None, help="mmsi partitions of the sort pre-pass, one per 256 MB of csv by default")
+    parser.add_argument('--compress_tolerance', type=float, default=None, help="simplify the trajectories before writing them, dropping fixes within this many metres (synchronized euclidean distance) of the time interpolated track")
+    parser.add_argument('--layout', type=str, default="linestring", choices=TRAJECTORY_LAYOUTS, help="storage layout of new monthly tables: timestamps array next to a LINESTRING, or the times as the M coordinate of a LINESTRINGM")
+    parser.add_argument('--partitioned', action='store_true', help="create the monthly tables as partitions of a trajectories table range partitioned by start_dt (see src/migrate_partitions.py for existing tables)")
+    parser.add_argument('--mmsi_partitions', type=int, default=0, help="with --partitioned, split every month into this many mmsi hash partitions")
+    parser.add_argument('--index_workers', type=int, default=2, help="indexes of the monthly tables built at the same time once a month is read, 0 leaves them to src/index_builder.py")
+    parser.add_argument('--resume', action='store_true', help="skip the files the ingestion manifest lists as completed and resume partial files from their checkpoint")
     args = parser.parse_args()
 
     path = args.datapath
     database_url = args.db_url
+    pool_options = {"pool_size": args.pool_size, "statement_timeout": args.statement_timeout}
+    ClearAIS_DB.configure_pool(application_name="clear_ais_reader", **pool_options)
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    temp_tracking_storage.configure(memory_budget, args.spill_dir)
+    if args.spill_dir:
+        snapshot_root = os.path.join(args.spill_dir, "checkpoints")
     if os.path.exists(path):
-        bulk_inserter = ClearAIS_DB(database_url)
+        bulk_inserter = ClearAIS_DB.shared(database_url)
         bulk_inserter.create_tables(drop_existing=False)
         bulk_inserter.save_schema(file_path="sql/schema.sql")
+        if args.partitioned:
+            bulk_inserter.create_partitioned_table(args.layout, args.mmsi_partitions)
+        # The indexes of a month are built in the background once the reader is past it
+        index_builder = IndexBuilder(bulk_inserter, args.index_workers) if args.index_workers > 0 else None
 
-        # Create queues for inter-process communication
-        trajectory_queue = deque()
         completed_files = deque()
 
-         # Start the trajectory insertion process
-        p1 = threading.Thread(target=insert_complete_trajectories_to_db, 
-                    args=(trajectory_queue, database_url,completed_files))
-        p1.start()
+        shard_queues, workers = None, []
+        if args.workers > 1:
+            # Each worker owns the trajectory state and the db writers for its mmsi shard
+            shard_queues, workers = start_trajectory_workers(args.workers, database_url, args.writer, pool_options,
+                                                             num_writers=args.writers, trajectory_queue_size=args.queue_size,
+                                                             memory_budget=memory_budget, spill_dir=args.spill_dir,
+                                                             compress_tolerance=args.compress_tolerance, layout=args.layout,
+                                                             writer_kind=args.writer_kind)
+
+        # Start the trajectory writers, the workers have their own
+        trajectory_queue, writers = start_trajectory_writers(0 if workers else args.writers, database_url, args.writer,
+                                                             args.writer_kind, pool_options, args.queue_size,
+                                                             args.compress_tolerance, args.layout)
+
+        checkpoint_every = args.checkpoint_every
+        if workers and (checkpoint_every or args.resume):
+            logger.warning("Checkpoints and --resume need --workers 1, the open tracks live in the worker processes")
+            checkpoint_every, args.resume = 0, False
+        if args.sort_prepass and os.path.isdir(path) and (checkpoint_every or args.resume):
+            logger.warning("Checkpoints and --resume are per csv file, they are off with --sort_prepass")
+            checkpoint_every, args.resume = 0, False
 
         if os.path.isfile(path):
-            year_month = None
-
-            process_file(path, year_month, trajectory_queue,completed_files, chunk_size=100000, )
-
-            trajectory_queue.append(None)
+            year_month, start_row = None, 0
+            checkpoint = resume_point(bulk_inserter, path) if args.resume else None
+            if checkpoint is not None:
+                completed, start_row, year_month, state = checkpoint
+                if completed:
+                    logger.info(f"skipped, already ingested: {path}")
+                else:
+                    restore_tracking_state(state)
+                    logger.info(f"resuming {path} at row {start_row}")
+
+            if checkpoint is None or not completed:
+                process_file(path, year_month, trajectory_queue,completed_files, chunk_size=100000, shard_queues=shard_queues,
+                             checkpoint_every=checkpoint_every, start_row=start_row)
+        elif args.sort_prepass:
+            # Every month is sorted by (mmsi, timestamp) first, so each ship's rows arrive in one time ordered run
+            sorted_csv_files = sort_file_names_by_year_month(find_files_in_folder(path, extension=('.csv')))
+            for year_month, month_files in sorted_csv_files.items():
+                process_sorted_month(month_files, year_month, trajectory_queue, completed_files, shard_queues=shard_queues,
+                                     sort_dir=args.sort_dir, processes=args.sort_processes, num_partitions=args.sort_partitions)
+                check_trajectory_workers()
+                logger.info(f"completed: {year_month} ({len(month_files)} files sorted), trajectory queue: {trajectory_queue.stats()}")
+                if index_builder:
+                    index_builder.month_loaded(year_month)
         else:
             csv_files = find_files_in_folder(path, extension=('.csv'))
             sorted_csv_files = sort_file_names_by_year_month(csv_files)
@@ -440,16 +772,51 @@ if __name__=='__main__':
 
             # Create overall progress bar for all files
             total_files = sum(len(files) for files in sorted_csv_files.values())
+            file_list = [(year_month, file_path) for year_month, file_paths in sorted_csv_files.items() for file_path in file_paths]
+            prefetcher = FilePrefetcher() if args.prefetch else None
+            resume_state = None
             with tqdm(total=total_files, file=tqdm_logger, desc="Overall Progress", unit="file") as pbar:
-                for year_month, file_paths in sorted_csv_files.items():
-                    for file_path in file_paths:
-                        process_file(file_path, year_month, trajectory_queue, completed_files)
-                        pbar.update(1)
-                        logger.info("completed: " + str(file_path))
-              
-
-            # Send poison pills to stop the processes
-            trajectory_queue.append(None)
-
-        # Wait for the processes to finish
-        p1.join()
\ No newline at end of file
+                for i, (year_month, file_path) in enumerate(file_list):
+                    if index_builder and i > 0 and file_list[i - 1][0] != year_month:
+                        index_builder.month_loaded(file_list[i - 1][0])
+                    if prefetcher:
+                        prefetcher.prefetch(file_list[i + 1][1] if i + 1 < len(file_list) else None)
+
+                    # Skip the ingested files, the open tracks continue from the snapshot of the last one
+                    start_row = 0
+                    checkpoint = resume_point(bulk_inserter, file_path) if args.resume else None
+                    if checkpoint is not None:
+                        completed, start_row, _, resume_state = checkpoint
+                        if completed:
+                            pbar.update(1)
+                            logger.info(f"skipped, already ingested: {file_path}")
+                            continue
+                    if resume_state is not None:
+                        restore_tracking_state(resume_state)
+                        logger.info(f"resuming {file_path} at row {start_row}")
+                        resume_state = None
+
+                    process_file(file_path, year_month, trajectory_queue, completed_files, shard_queues=shard_queues,
+                                 checkpoint_every=checkpoint_every, start_row=start_row)
+                    check_trajectory_workers()
+                    if checkpoint_every and i > 0 and file_path in completed_files:
+                        # Only the snapshot of the last completed file is needed to resume
+                        bulk_inserter.save_checkpoint(file_list[i - 1][1], state=None)
+                        prune_snapshot_files(snapshot_directory(snapshot_root, file_list[i - 1][1]))
+                    pbar.update(1)
+                    logger.info(f"completed: {file_path}, trajectory queue: {trajectory_queue.stats()}")
+            if prefetcher:
+                prefetcher.stop()
+
+        if workers:
+            stop_trajectory_workers(shard_queues, workers)
+
+        # Send the sentinels and wait for the writers to finish
+        stop_trajectory_writers(trajectory_queue, writers)
+        logger.info(f"Trajectory queue: {trajectory_queue.stats()}")
+        if index_builder:
+            index_builder.all_loaded()
+            index_builder.close()
+        logger.info(f"Open tracks: {temp_tracking_storage.stats()}")
+        temp_tracking_storage.close()
+        logger.info(f"Connection pool: {bulk_inserter.pool_stats()}")
\ No newline at end of file
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+# English and Swedish month tokens of the "01 jan 2018 00:00:00.000 UTC" base station time stamps
+MONTHS = {
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "maj": 5, "jun": 6, "jul": 7,
+    "aug": 8, "sep": 9, "oct": 10, "okt": 10, "nov": 11, "dec": 12,
+}
+# Month tokens packed into integers (three code points), sorted for np.searchsorted
+MONTH_TABLE = sorted(((ord(m[0]) << 16) | (ord(m[1]) << 8) | ord(m[2]), number) for m, number in MONTHS.items())
+MONTH_KEYS = np.array([key for key, _ in MONTH_TABLE], dtype=np.int64)
+MONTH_VALUES = np.array([number for _, number in MONTH_TABLE], dtype=np.int64)
+
+# Character positions in "DD mon YYYY HH:MM:SS"
+FIXED_WIDTH = 20
+DIGITS = {"day": (0, 2), "year": (7, 11), "hour": (12, 14), "minute": (15, 17), "second": (18, 20)}
+SEPARATORS = {2: " ", 6: " ", 11: " ", 14: ":", 17: ":"}
+MONTH_POSITION = 3
+
+LOCAL_TIMEZONE = "Europe/Berlin"
+
+
+def days_from_civil(year, month, day):
+    """Days since 1970-01-01 for arrays of proleptic Gregorian dates"""
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+def decode_fixed_width(values):
+    """
+    Decode "DD mon YYYY HH:MM:SS[.fff] [zone]" strings into int64 nanoseconds since the epoch.
+    Fractional seconds and the zone are ignored. Returns the values and a mask of the strings
+    that didn't match the format.
+    """
+    n = len(values)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+
+    # Code points of the first FIXED_WIDTH characters as an (n, FIXED_WIDTH) matrix
+    chars = np.asarray(values, dtype=f"U{FIXED_WIDTH}").view(np.uint32).reshape(n, FIXED_WIDTH).astype(np.int64)
+
+    valid = np.ones(n, dtype=bool)
+    for position, separator in SEPARATORS.items():
+        valid &= chars[:, position] == ord(separator)
+
+    fields = {}
+    for name, (start, end) in DIGITS.items():
+        digits = chars[:, start:end] - ord("0")
+        valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+        fields[name] = (digits * (10 ** np.arange(end - start - 1, -1, -1))).sum(axis=1)
+
+    # Month token through the lookup table, upper case letters are folded to lower case
+    letters = chars[:, MONTH_POSITION:MONTH_POSITION + 3]
+    letters = np.where((letters >= ord("A")) & (letters <= ord("Z")), letters | 0x20, letters)
+    keys = (letters[:, 0] << 16) | (letters[:, 1] << 8) | letters[:, 2]
+    index = np.clip(np.searchsorted(MONTH_KEYS, keys), 0, len(MONTH_KEYS) - 1)
+    valid &= MONTH_KEYS[index] == keys
+    month = MONTH_VALUES[index]
+
+    valid &= (fields["day"] >= 1) & (fields["day"] <= 31) & (fields["hour"] < 24) & (fields["minute"] < 60) & (fields["second"] < 60)
+
+    days = days_from_civil(fields["year"], month, fields["day"])
+    # Reject days past the end of the month (e.g. 31 feb), they would roll over into the next month
+    next_month_days = days_from_civil(fields["year"] + (month == 12), month % 12 + 1, np.ones(n, dtype=np.int64))
+    valid &= days < next_month_days
+
+    seconds = days * 86400 + fields["hour"] * 3600 + fields["minute"] * 60 + fields["second"]
+    return np.where(valid, seconds * 1_000_000_000, 0), ~valid
+
+def parse_text_timestamps(values):
+    """Regex and pd.to_datetime parsing of the time stamp strings, used for the strings decode_fixed_width rejects"""
+    ts = pd.Series(values, dtype=object).str.replace(r'\.\d{1,6}|\s+[A-Za-z]+$', '', regex=True)
+    month_map = {
+        r'\bmaj\b': 'May', r'\bokt\b': 'Oct',
+        r'\bMaj\b': 'May', r'\bOkt\b': 'Oct'
+    }
+    # Replace month names to english
+    ts = ts.replace(month_map, regex=True)
+    return pd.to_datetime(ts, format='%d %b %Y %H:%M:%S').to_numpy(dtype="datetime64[ns]")
+
+def localize(naive, tz=LOCAL_TIMEZONE):
+    """Localize naive wall clock times the way the ingestion always has"""
+    return pd.DatetimeIndex(naive).tz_localize(
+        tz,
+        ambiguous=False,       # or use False (standard time), True (DST), or 'NaT' to mark ambiguous
+        nonexistent='shift_forward'  # or 'NaT', 'shift_forward', 'shift_backward'
+    )
+
+def parse_ais_timestamps(values, tz=LOCAL_TIMEZONE):
+    """
+    Parse base station time stamps ("01 jan 2018 00:00:00.000 UTC") into a tz aware Series.
+
+    Every distinct string is decoded and localized once, so the repeated second level
+    time stamps of busy areas cost a lookup.
+    """
+    index = values.index if isinstance(values, pd.Series) else None
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+
+    nanoseconds, failed = decode_fixed_width(uniques)
+    naive = nanoseconds.view("datetime64[ns]")
+    if failed.any():
+        naive[failed] = parse_text_timestamps(uniques[failed])
+
+    localized = localize(naive, tz)
+    return pd.Series(localized.take(codes, allow_fill=True, fill_value=pd.NaT), index=index, name="timestamp")
+
+def parse_unix_timestamps(values, tz=LOCAL_TIMEZONE):
+    """
+    Parse the UNIX time stamp column into the same tz aware values parse_ais_timestamps gives for
+    the matching base station time stamp (the UTC wall clock localized to tz).
+    """
+    index = values.index if isinstance(values, pd.Series) else None
+    codes, uniques = pd.factorize(np.asarray(values, dtype=np.int64))
+    localized = localize(pd.to_datetime(uniques, unit="s").to_numpy(dtype="datetime64[ns]"), tz)
+    return pd.Series(localized.take(codes), index=index, name="timestamp")
@@ -0,0 +1,249 @@
+"""
+Bulk read path for exports: COPY (SELECT ...) TO STDOUT WITH (FORMAT binary) parsed into NumPy.
+
+Going through psycopg2 builds a Python float or datetime for every element of the array columns.
+Here the rows are only walked to find where each field starts. The array elements and the EWKB
+coordinates of all rows are then read straight from the COPY buffer, one vectorized pass per
+column, into a flat array plus per row offsets (ListColumn, like an Arrow list array).
+
+    from binary_copy import copy_table
+    columns = copy_table(db, "trajectories_2023_02", ["mmsi", "coordinates", "timestamps", "speed_over_ground"])
+    columns["speed_over_ground"][0]  # NumPy array of the first row
+"""
+import io, struct
+from dataclasses import dataclass
+import numpy as np
+
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# 2000-01-01, the epoch of the binary timestamp format, in unix microseconds
+POSTGRES_EPOCH_US = 946684800 * 10**6
+
+# Fixed width types: oid -> big endian NumPy dtype of the binary format
+FIXED_TYPES = {16: "?", 20: ">i8", 21: ">i2", 23: ">i4", 700: ">f4", 701: ">f8", 1114: ">i8", 1184: ">i8"}
+TIMESTAMP_TYPES = {1114, 1184}
+TEXT_TYPES = {19, 25, 1042, 1043}
+INTERVAL_TYPE = 1186
+BYTEA_TYPE = 17
+# Array oid -> element oid
+ARRAY_TYPES = {1000: 16, 1005: 21, 1007: 23, 1016: 20, 1021: 700, 1022: 701, 1115: 1114, 1185: 1184}
+
+EWKB_SRID, EWKB_M, EWKB_Z = 0x20000000, 0x40000000, 0x80000000
+EWKB_POINT, EWKB_LINESTRING = 1, 2
+
+
+@dataclass
+class ListColumn:
+    """
+    Variable length values of all rows in one flat array, row i is values[offsets[i]:offsets[i + 1]].
+    valid is False for NULL rows. Geometries have (points, dimensions) values.
+    """
+    values: np.ndarray
+    offsets: np.ndarray
+    valid: np.ndarray
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]] if self.valid[i] else None
+
+    def to_arrow(self):
+        """pyarrow LargeListArray sharing the buffers where the dtype allows it"""
+        import pyarrow as pa
+        if self.values.ndim > 1:
+            values = pa.FixedSizeListArray.from_arrays(pa.array(self.values.ravel()), self.values.shape[1])
+        else:
+            values = pa.array(self.values)
+        return pa.LargeListArray.from_arrays(pa.array(self.offsets), values, mask=pa.array(~self.valid))
+
+
+def gather(data, positions, dtype):
+    """
+    Values of dtype at arbitrary byte positions of the buffer data. Positions are grouped by their
+    alignment to the item size, each group is read through one strided view of the buffer.
+    """
+    dtype = np.dtype(dtype)
+    positions = np.asarray(positions, dtype=np.int64)
+    values = np.empty(len(positions), dtype=dtype)
+    residues = positions % dtype.itemsize
+    for residue in np.flatnonzero(np.bincount(residues, minlength=dtype.itemsize)):
+        selected = residues == residue
+        view = np.frombuffer(data, dtype=dtype, count=(len(data) - residue) // dtype.itemsize, offset=residue)
+        values[selected] = view[(positions[selected] - residue) // dtype.itemsize]
+    return values
+
+def element_positions(starts, counts, stride):
+    """Byte positions of counts[i] items every stride bytes from starts[i], for all rows, and the row offsets"""
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    within = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], counts)
+    return np.repeat(starts, counts) + within * stride, offsets
+
+def split_fields(data, num_columns):
+    """Start and length (-1 for NULL) of every field of a binary COPY stream, as (rows, columns) arrays"""
+    if bytes(data[:len(PGCOPY_SIGNATURE)]) != PGCOPY_SIGNATURE:
+        raise ValueError("Not a binary COPY stream")
+    (extension,) = struct.unpack_from(">I", data, len(PGCOPY_SIGNATURE) + 4)
+    position = len(PGCOPY_SIGNATURE) + 8 + extension
+
+    unpack_count, unpack_length = struct.Struct(">h").unpack_from, struct.Struct(">i").unpack_from
+    starts, lengths = [], []
+    while True:
+        (count,) = unpack_count(data, position)
+        position += 2
+        if count == -1:
+            break
+        if count != num_columns:
+            raise ValueError(f"Tuple with {count} fields, expected {num_columns}")
+        for _ in range(count):
+            (length,) = unpack_length(data, position)
+            position += 4
+            starts.append(position)
+            lengths.append(length)
+            if length > 0:
+                position += length
+    shape = (-1, num_columns)
+    return np.array(starts, dtype=np.int64).reshape(shape), np.array(lengths, dtype=np.int64).reshape(shape)
+
+def decode_fixed(data, starts, lengths, type_oid):
+    """Fixed width column, NULL becomes NaN (floats), NaT (timestamps) or a float column with NaN (integers)"""
+    valid = lengths >= 0
+    values = gather(data, np.where(valid, starts, 0), FIXED_TYPES[type_oid])
+    return finish_values(values, valid, type_oid)
+
+def finish_values(values, valid, type_oid):
+    """Big endian values to native ones, invalid elements to NaN or NaT"""
+    if type_oid in TIMESTAMP_TYPES:
+        values = (values.astype(np.int64) + POSTGRES_EPOCH_US).view("datetime64[us]")
+        values[~valid] = np.datetime64("NaT")
+        return values
+    values = values.astype(values.dtype.newbyteorder("="))
+    if not valid.all():
+        values = values.astype(np.float64)
+        values[~valid] = np.nan
+    return values
+
+def decode_interval(data, starts, lengths):
+    """interval column as timedelta64[us], months counted as 30 days"""
+    valid = lengths >= 0
+    positions = np.where(valid, starts, 0)
+    microseconds = gather(data, positions, ">i8").astype(np.int64)
+    days = gather(data, positions + 8, ">i4").astype(np.int64) + 30 * gather(data, positions + 12, ">i4").astype(np.int64)
+    values = (microseconds + days * 86400 * 10**6).view("timedelta64[us]")
+    values[~valid] = np.timedelta64("NaT")
+    return values
+
+def decode_text(data, starts, lengths):
+    view = memoryview(data)
+    return np.array([str(view[start:start + length], "utf-8") if length >= 0 else None
+                     for start, length in zip(starts.tolist(), lengths.tolist())], dtype=object)
+
+def decode_bytes(data, starts, lengths):
+    view = memoryview(data)
+    return np.array([bytes(view[start:start + length]) if length >= 0 else None
+                     for start, length in zip(starts.tolist(), lengths.tolist())], dtype=object)
+
+def decode_array(data, starts, lengths, element_oid):
+    """
+    One dimensional array column as a ListColumn. Arrays without NULL elements, the common case, are
+    read vectorized. The element positions of arrays with NULL elements are walked in Python.
+    """
+    valid = lengths >= 0
+    positions = np.where(valid, starts, 0)
+    ndim = np.where(valid, gather(data, positions, ">i4"), 0)
+    if (ndim > 1).any():
+        raise ValueError("Only one dimensional arrays are supported")
+    has_null = valid & (gather(data, positions + 4, ">i4") != 0)
+    counts = np.where(ndim == 1, gather(data, positions + 12, ">i4"), 0).astype(np.int64)
+
+    width = np.dtype(FIXED_TYPES[element_oid]).itemsize
+    # Every element is a 4 byte length and the value, the first one after the 20 byte header
+    element_starts, offsets = element_positions(positions + 24, counts, 4 + width)
+    element_valid = np.ones(len(element_starts), dtype=bool)
+    unpack_length = struct.Struct(">i").unpack_from
+    for row in np.flatnonzero(has_null):
+        position = int(positions[row]) + 20
+        for k in range(offsets[row], offsets[row + 1]):
+            (length,) = unpack_length(data, position)
+            element_starts[k] = position + 4
+            element_valid[k] = length >= 0
+            position += 4 + max(length, 0)
+
+    values = gather(data, np.where(element_valid, element_starts, 0), FIXED_TYPES[element_oid])
+    return ListColumn(finish_values(values, element_valid, element_oid), offsets, valid)
+
+def decode_ewkb(data, starts, lengths):
+    """
+    EWKB column (as PostGIS sends geometry in binary COPY). LINESTRINGs become a ListColumn of
+    (points, dimensions) coordinates, POINTs a (rows, dimensions) array with NaN for NULL.
+    """
+    valid = lengths >= 0
+    positions = np.where(valid, starts, 0)
+    if not (gather(data, positions[valid], "u1") == 1).all():
+        raise ValueError("Only little endian EWKB is supported")
+    types = gather(data, positions + 1, "<u4")
+    kinds = np.unique(types[valid] & 0xFFFF)
+    if len(np.unique(types[valid] & (EWKB_Z | EWKB_M))) > 1 or len(kinds) > 1:
+        raise ValueError("Mixed geometry types in one column")
+    flags = int(types[valid][0]) if valid.any() else 0
+    dimensions = 2 + bool(flags & EWKB_Z) + bool(flags & EWKB_M)
+    body = positions + 5 + np.where(types & EWKB_SRID, 4, 0)
+
+    if len(kinds) and kinds[0] == EWKB_POINT:
+        coordinates, _ = element_positions(body, np.where(valid, dimensions, 0), 8)
+        points = np.full((len(starts), dimensions), np.nan)
+        points[valid] = gather(data, coordinates, "<f8").reshape(-1, dimensions)
+        return points
+    if len(kinds) and kinds[0] != EWKB_LINESTRING:
+        raise ValueError(f"Unsupported geometry type {kinds[0]}")
+
+    counts = np.where(valid, gather(data, body, "<u4"), 0).astype(np.int64)
+    coordinates, offsets = element_positions(body + 4, counts * dimensions, 8)
+    return ListColumn(gather(data, coordinates, "<f8").reshape(-1, dimensions), offsets // dimensions, valid)
+
+def parse_binary_copy(data, names, type_oids, geometry_oid=None):
+    """Columns of a binary COPY stream by name, decoded by type oid, see the module docstring"""
+    starts, lengths = split_fields(data, len(names))
+    columns = {}
+    for j, (name, type_oid) in enumerate(zip(names, type_oids)):
+        column_starts, column_lengths = starts[:, j], lengths[:, j]
+        if type_oid == geometry_oid:
+            columns[name] = decode_ewkb(data, column_starts, column_lengths)
+        elif type_oid in ARRAY_TYPES:
+            columns[name] = decode_array(data, column_starts, column_lengths, ARRAY_TYPES[type_oid])
+        elif type_oid in FIXED_TYPES:
+            columns[name] = decode_fixed(data, column_starts, column_lengths, type_oid)
+        elif type_oid == INTERVAL_TYPE:
+            columns[name] = decode_interval(data, column_starts, column_lengths)
+        elif type_oid in TEXT_TYPES:
+            columns[name] = decode_text(data, column_starts, column_lengths)
+        elif type_oid == BYTEA_TYPE:
+            columns[name] = decode_bytes(data, column_starts, column_lengths)
+        else:
+            raise ValueError(f"Column {name} has type oid {type_oid} without a binary decoder, cast it in the query")
+    return columns
+
+def copy_query(db, query, params=None):
+    """Run a SELECT (psycopg2 %(name)s parameters) as a binary COPY and parse it with parse_binary_copy"""
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regtype('geometry')::oid")
+            geometry_oid = cursor.fetchone()[0]
+            cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0", params)
+            names = [column.name for column in cursor.description]
+            type_oids = [column.type_code for column in cursor.description]
+            sql = cursor.mogrify(query, params).decode()
+            buffer = io.BytesIO()
+            cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT binary)", buffer)
+        connection.commit()
+    finally:
+        connection.close()
+    return parse_binary_copy(buffer.getbuffer(), names, type_oids, geometry_oid)
+
+def copy_table(db, table_name, columns=None, where=None, params=None):
+    """Columns (all by default) of the rows of a monthly table matching the SQL condition where"""
+    from database_schema import POSTGRES_SCHEMA
+    selected = ", ".join(f'"{name}"' for name in columns) if columns else "*"
+    query = f"SELECT {selected} FROM {POSTGRES_SCHEMA}.{table_name}" + (f" WHERE {where}" if where else "")
+    return copy_query(db, query, params)
@@ -0,0 +1,31 @@
+import hashlib, os, pickle, tempfile, zlib
+
+FINGERPRINT_SAMPLE = 1 << 20  # bytes hashed at the start and the end of a file
+# Spilled track files of the checkpoints when no --spill_dir is given, kept across runs for --resume
+SNAPSHOT_ROOT = os.path.join(tempfile.gettempdir(), "clear_ais_checkpoints")
+
+
+def file_fingerprint(file_path, sample_size=FINGERPRINT_SAMPLE):
+    """
+    Content fingerprint of a csv file: its size and a hash of the first and last sample_size bytes.
+    Unlike the modification time it survives copying the data to another disk.
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file_handle:
+        digest.update(file_handle.read(sample_size))
+        if size > sample_size:
+            file_handle.seek(max(sample_size, size - sample_size))
+            digest.update(file_handle.read())
+    return f"{size}:{digest.hexdigest()}"
+
+def dump_state(state):
+    """Compressed pickle of the tracking state for the ingestion manifest"""
+    return zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL), level=1)
+
+def load_state(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+def snapshot_directory(root, file_path):
+    """Directory of the spilled track files referenced by the checkpoint of a csv file"""
+    return os.path.join(root, hashlib.blake2b(file_path.encode(), digest_size=8).hexdigest())
@@ -0,0 +1,110 @@
+import csv, json
+from collections import namedtuple
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pa = pyarrow_csv = None
+
+csv_to_db_mapping = json.load(open("src/csv_to_db_mapping.json",'r'))
+# Database columns the ingestion uses and the dtype they are parsed as, everything else in the files is skipped
+csv_column_dtypes = json.load(open("src/csv_column_dtypes.json",'r'))
+
+PANDAS_DTYPES = {"string": str, "category": "category", "float64": "float64"}
+ARROW_DTYPES = {
+    "string": lambda: pa.string(),
+    "category": lambda: pa.dictionary(pa.int32(), pa.string()),
+    "float64": lambda: pa.float64(),
+}
+READ_BLOCK_SIZE = 4 << 20  # bytes per pyarrow record batch
+DEFAULT_ENGINE = "pyarrow" if pyarrow_csv is not None else "pandas"
+
+# usecols: source columns to load, dtypes: source column -> dtype name, renames: source column -> database column
+ReadPlan = namedtuple("ReadPlan", ["usecols", "dtypes", "renames"])
+read_plans = {}
+
+
+def read_header(file_path):
+    """Column names of the first line of a CSV file"""
+    with open(file_path, newline='', encoding='utf-8-sig') as file_handle:
+        return tuple(next(csv.reader(file_handle), []))
+
+def compile_read_plan(header):
+    """
+    Read plan of a CSV header: the columns mapping to a database column in csv_column_dtypes,
+    their dtypes and renames. Unknown and "Unnamed" columns are not loaded.
+    Plans are cached per header, so every provider layout is compiled once.
+    """
+    plan = read_plans.get(header)
+    if plan is not None:
+        return plan
+
+    usecols, dtypes, renames = [], {}, {}
+    for column in header:
+        db_column = csv_to_db_mapping.get(column, column)
+        # The first source column wins if two map to the same database column
+        if db_column not in csv_column_dtypes or db_column in renames.values():
+            continue
+        usecols.append(column)
+        dtypes[column] = csv_column_dtypes[db_column]
+        renames[column] = db_column
+
+    plan = ReadPlan(usecols, dtypes, renames)
+    read_plans[header] = plan
+    return plan
+
+def read_pandas_chunks(file_handle, plan, chunk_size, skip_rows=0):
+    dtypes = {column: PANDAS_DTYPES[dtype] for column, dtype in plan.dtypes.items()}
+    for chunk in pd.read_csv(file_handle, chunksize=chunk_size, usecols=plan.usecols, dtype=dtypes, float_precision="round_trip",
+                             skiprows=range(1, skip_rows + 1) if skip_rows else None):
+        chunk.index += skip_rows
+        yield chunk.rename(columns=plan.renames)
+
+def read_pyarrow_chunks(file_handle, plan, chunk_size, skip_rows=0):
+    """Stream record batches through the pyarrow CSV reader and cut them into chunk_size row DataFrames"""
+    reader = pyarrow_csv.open_csv(
+        file_handle,
+        read_options=pyarrow_csv.ReadOptions(block_size=READ_BLOCK_SIZE, skip_rows_after_names=skip_rows),
+        convert_options=pyarrow_csv.ConvertOptions(
+            include_columns=plan.usecols,
+            column_types={column: ARROW_DTYPES[dtype]() for column, dtype in plan.dtypes.items()},
+            strings_can_be_null=True,
+        ),
+    )
+
+    def to_frame(table, start):
+        chunk = table.to_pandas().rename(columns=plan.renames)
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        return chunk
+
+    pending, pending_rows, start = [], 0, skip_rows
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_size:
+            table = pa.Table.from_batches(pending)
+            yield to_frame(table.slice(0, chunk_size), start)
+            start += chunk_size
+            rest = table.slice(chunk_size)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+    if pending_rows:
+        yield to_frame(pa.Table.from_batches(pending), start)
+
+def read_csv_chunks(file_path, chunk_size, progress_bar=None, engine=DEFAULT_ENGINE, skip_rows=0):
+    """
+    Read a CSV in chunks in a single pass with the read plan of its header, the chunks have the
+    database column names and are indexed by data row number. Progress is the number of bytes
+    consumed by the reader. skip_rows data rows after the header are skipped (resume).
+    """
+    plan = compile_read_plan(read_header(file_path))
+    read_chunks = read_pyarrow_chunks if engine == "pyarrow" else read_pandas_chunks
+
+    with open(file_path, 'rb') as file_handle:
+        for chunk in read_chunks(file_handle, plan, chunk_size, skip_rows):
+            yield chunk
+
+            # Update progress bar
+            if progress_bar:
+                progress_bar.update(file_handle.tell() - progress_bar.n)
@@ -1,23 +1,33 @@
-import enum, traceback, datetime, os,pathlib, dotenv
-from sqlalchemy import create_engine, exc
+import enum, traceback, datetime, os,pathlib, dotenv, json, hashlib
+from sqlalchemy import create_engine, exc, inspect, select, func, case
 from sqlalchemy.orm.decl_api import declarative_base, DeclarativeBase
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Column, Integer, String, ForeignKey, Date, Enum, Boolean, DateTime, Float, BigInteger, ARRAY, Interval, JSON, Table, MetaData
-from sqlalchemy.dialects.postgresql import insert, JSONB
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, Enum, Boolean, DateTime, Float, BigInteger, ARRAY, Interval, JSON, Table, MetaData, LargeBinary, SmallInteger, Sequence
+from sqlalchemy.dialects.postgresql import insert, JSONB, INTERVAL
 import pandas as pd
 from sqlalchemy.schema import CreateTable
 from sqlalchemy.sql import text
 from sqlalchemy.schema import UniqueConstraint, Index
 from io import StringIO
 from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKTElement, WKBElement
 from geoalchemy2.shape import from_shape
+import numpy as np
+import shapely
+from psycopg2.extensions import register_adapter, AsIs
+import csv
 from dataclasses import dataclass
 from typing import Optional, List, Dict, Any
 import uuid
 import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 from logger import getLogger
 from utils import try_except
+from trajectory_encoding import decode_compact_frame
 
 logger = getLogger(__file__)
 project_folder_path = str(pathlib.Path(__file__).resolve().parents[1]) 
@@ -27,6 +37,10 @@ dotenv.load_dotenv(dotenv_path=env_path)
 
 POSTGRES_SCHEMA = os.getenv("POSTGRES_SCHEMA","public") 
 
+# NumPy integers in array columns (trajectory segments) are sent as plain numbers, floats already are
+for numpy_type in (np.int16, np.int32, np.int64):
+    register_adapter(numpy_type, AsIs)
+
 metadata = MetaData(schema=POSTGRES_SCHEMA)
 Base = declarative_base(metadata=metadata)
 
@@ -69,31 +83,6 @@ class AIS_Data(Base):
     rot = Column(Float, nullable=True, info="rate of turn")
     eot = Column(Float, nullable=True) # NOTE EOT or EAT? not sure check out the definition
 
-class Trajectories(Base):
-    __tablename__ = "trajectories"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    mmsi = Column(String, primary_key=True)
-    route_id = Column(String)
-    start_dt = Column(DateTime)
-    end_dt =  Column(DateTime)
-    origin = Column(Geometry('POINT'), nullable=True)
-    destination = Column(Geometry('POINT'), nullable=True)
-    count = Column(Integer, nullable=True)
-    duration = Column(Interval, nullable=True)
-    coordinates = Column(Geometry('LINESTRING'),nullable=True)
-    timestamps = Column(ARRAY(DateTime),nullable=True)
-    speed_over_ground = Column(ARRAY(Float),nullable=True)
-    navigational_status = Column(ARRAY(Integer),nullable=True)
-    course_over_ground = Column(ARRAY(Float),nullable=True, info="course_over_ground") 
-    heading = Column(ARRAY(Float), nullable=True)
-
-    __table_args__ = (
-        UniqueConstraint('mmsi', 'start_dt', name='uix_mmsi_start_dt'),
-    )
-
-    def __repr__(self):
-        return f"<Trajectory(mmsi={self.mmsi}, start_dt={self.start_dt}, end_dt={self.end_dt}, origin={self.origin}, destination={self.destination}, coordinates={self.coordinates})>"
-
 class Nav_Status(Base):
     """
     Navigational status
@@ -164,6 +153,174 @@ class MissingDataTable(Base):
         Index('idx_missing_data_timestamps', 'timestamps')
     )
 
+class IngestionManifest(Base):
+    """
+    Ingestion progress per csv file, used to resume an interrupted load (ais_data_processor --resume)
+    """
+    __tablename__ = "ingestion_manifest"
+    file_path = Column(String, primary_key=True)
+    fingerprint = Column(String, info="file size and hash of the first and last MB")
+    status = Column(String, info="partial or completed")
+    rows_read = Column(BigInteger, default=0, info="csv rows consumed up to the checkpoint")
+    year_month = Column(String, nullable=True)
+    state = Column(LargeBinary, nullable=True, info="compressed snapshot of the open tracks, route ids and nav statuses")
+    updated_at = Column(DateTime)
+
+class TableVersions(Base):
+    """
+    Counter bumped after every commit of new rows into a monthly table, cached query results
+    (query_cache.py) of a table are dropped when its version moved on. max_duration bounds the
+    months TrajectoryStore has to look at, NULL while unknown (rows written before it was kept).
+    """
+    __tablename__ = "table_versions"
+    table_name = Column(String, primary_key=True)
+    version = Column(BigInteger, default=0)
+    updated_at = Column(DateTime)
+    max_duration = Column(Interval, nullable=True, info="longest end_dt - start_dt of the rows of the table")
+
+# Monthly trajectory tables are created at ingest and kept out of Base.metadata (save_schema)
+monthly_metadata = MetaData(schema=POSTGRES_SCHEMA)
+
+# Process wide registry of the monthly tables and their insert statements,
+# the catalog is only queried the first time a table is seen in this process
+table_registry: Dict[str, Table] = {}
+insert_statements: Dict[str, Any] = {}
+table_registry_lock = threading.Lock()
+# mmsi -> ship type of the ships table for the summary columns of the trajectories
+ship_type_cache: Dict[str, Optional[int]] = {}
+
+# Storage layouts of the monthly tables: linestring keeps the times in a timestamps array next to
+# the LINESTRING, measured stores them as the M coordinate (UTC epoch seconds) of a LINESTRINGM,
+# compact stores them as seconds since start_dt and SOG, COG and heading in tenths as SMALLINT[]
+# (decoders in trajectory_encoding.py and sql/compact_layout.sql)
+TRAJECTORY_LAYOUTS = ("linestring", "measured", "compact")
+
+def trajectory_columns(table_name, layout="linestring"):
+    """
+    Columns of the monthly tables and their partitioned parent, without id. The geometry columns get
+    no spatial index with the table, see trajectory_indexes.
+    """
+    if layout not in TRAJECTORY_LAYOUTS:
+        raise ValueError(f"Unknown trajectory layout: {layout}")
+
+    if layout == "measured":
+        point_columns = [Column('coordinates', Geometry('LINESTRINGM', 4326, dimension=3, spatial_index=False))]
+    else:
+        point_columns = [Column('coordinates', Geometry('LINESTRING', 4326, spatial_index=False))]
+
+    if layout == "compact":
+        point_columns += [
+            Column('time_offsets', ARRAY(Integer), info="seconds since start_dt"),
+            Column('speed_over_ground_q', ARRAY(SmallInteger), nullable=True, info="0.1 knots"),
+            Column('navigational_status', ARRAY(SmallInteger), nullable=True),
+            Column('course_over_ground_q', ARRAY(SmallInteger), nullable=True, info="0.1 degrees"),
+            Column('heading_q', ARRAY(SmallInteger), nullable=True, info="0.1 degrees"),
+        ]
+    else:
+        if layout == "linestring":
+            point_columns.append(Column('timestamps', ARRAY(DateTime)))
+        point_columns += [
+            Column('speed_over_ground', ARRAY(Float),nullable=True),
+            Column('navigational_status', ARRAY(Integer),nullable=True),
+            Column('course_over_ground', ARRAY(Float),nullable=True),
+            Column('heading', ARRAY(Float),nullable=True),
+        ]
+
+    return [
+        Column('mmsi', String),
+        Column('route_id', String),
+        Column('start_dt', DateTime),
+        Column('end_dt', DateTime),
+        Column('origin', Geometry('POINT', 4326, spatial_index=False)),
+        Column('destination', Geometry('POINT', 4326, spatial_index=False)),
+        Column('count', Integer),
+        Column('duration', Interval),
+        Column('missing_data', Boolean),
+        Column('missing_data_info', String,nullable=True),
+        *point_columns,
+        Column('compression_tolerance', Float, nullable=True),
+        # Summaries of the arrays, filtered on instead of unnest (trajectory_segment.segment_summaries)
+        Column('sog_min', Float, nullable=True),
+        Column('sog_max', Float, nullable=True),
+        Column('sog_mean', Float, nullable=True),
+        Column('dominant_nav_status', Integer, nullable=True),
+        Column('path_length_m', Float, nullable=True),
+        Column('ship_type', Integer, nullable=True),
+    ]
+
+# Columns added after the first monthly tables were created, added to older tables when they are used
+ADDED_COLUMNS = {
+    "compression_tolerance": "FLOAT",
+    "sog_min": "FLOAT",
+    "sog_max": "FLOAT",
+    "sog_mean": "FLOAT",
+    "dominant_nav_status": "INTEGER",
+    "path_length_m": "FLOAT",
+    "ship_type": "INTEGER",
+}
+
+def trajectory_indexes(table_name, layout="linestring"):
+    """
+    Non-unique indexes of a monthly table as name -> (method, columns). They are built after the month
+    is loaded (index_builder.py), so the load doesn't maintain them row by row. mmsi lookups use the
+    unique (mmsi, start_dt) constraint.
+    """
+    indexes = {
+        f"idx_{table_name}_coordinates": ("gist", "coordinates"),
+        f"idx_{table_name}_origin": ("gist", "origin"),
+        f"idx_{table_name}_destination": ("gist", "destination"),
+        # start_dt follows the insert order closely, a BRIN index is a few pages per month
+        f"idx_{table_name}_start_dt": ("brin", "start_dt"),
+        f"idx_{table_name}_sog_max": ("btree", "sog_max"),
+        f"idx_{table_name}_sog_min": ("btree", "sog_min"),
+        f"idx_{table_name}_ship_type": ("btree", "ship_type, sog_max"),
+    }
+    if layout == "measured":
+        # n-D index on x, y and time for the bbox + time window functions (sql/get_trajectories_bbox_time.sql)
+        indexes[f"idx_{table_name}_coordinates_nd"] = ("gist", "coordinates gist_geometry_ops_nd")
+    return indexes
+
+def monthly_trajectories_table(year_month, metadata=monthly_metadata, layout="linestring"):
+    """Table definition for trajectories_<year_month>"""
+    table_name = f"trajectories_{year_month}"
+    key = f"{metadata.schema}.{table_name}" if metadata.schema else table_name
+    if key in metadata.tables:
+        return metadata.tables[key]
+
+    return Table(
+        table_name, metadata,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        *trajectory_columns(table_name, layout),
+        UniqueConstraint('mmsi', 'start_dt', name=f'uix_mmsi_start_dt_{year_month}')
+    )
+
+# Parent of the monthly tables when they are partitions (ais_data_processor.py --partitioned,
+# migrate_partitions.py), range partitioned by start_dt, optionally sub-partitioned by mmsi hash
+PARTITIONED_TABLE = "trajectories"
+
+def partitioned_trajectories_table(metadata=monthly_metadata, layout="linestring"):
+    """
+    Table definition of the partitioned parent. There is no primary key, it would have to include
+    start_dt, the monthly tables keep their own id key and (mmsi, start_dt) is unique across them.
+    """
+    key = f"{metadata.schema}.{PARTITIONED_TABLE}" if metadata.schema else PARTITIONED_TABLE
+    if key in metadata.tables:
+        return metadata.tables[key]
+
+    id_sequence = Sequence(f"{PARTITIONED_TABLE}_id_seq", metadata=metadata)
+    return Table(
+        PARTITIONED_TABLE, metadata,
+        Column('id', Integer, id_sequence, server_default=id_sequence.next_value(), nullable=False),
+        *trajectory_columns(PARTITIONED_TABLE, layout),
+        UniqueConstraint('mmsi', 'start_dt', name=f'uix_{PARTITIONED_TABLE}_mmsi_start_dt'),
+        postgresql_partition_by='RANGE (start_dt)'
+    )
+
+def month_bounds(year_month):
+    """Range partition bounds [first day of the month, first day of the next month) of a YYYY_MM"""
+    start = pd.Timestamp(f"{year_month.replace('_', '-')}-01")
+    return start.strftime("%Y-%m-%d"), (start + pd.offsets.MonthBegin(1)).strftime("%Y-%m-%d")
+
 @dataclass
 class MissingData:
     mmsi: str
@@ -182,14 +339,458 @@ class MissingData:
             'filename': self.filename
         }
 
+def staging_columns_ddl(columns, dialect):
+    """Column definitions for a COPY staging table, timestamps are kept with time zone"""
+    ddl = []
+    for col in columns:
+        col_type = str(col.type.compile(dialect=dialect)).replace("WITHOUT TIME ZONE", "WITH TIME ZONE")
+        ddl.append(f'"{col.name}" {col_type}')
+    return ", ".join(ddl)
+
+def rows_max_duration(data):
+    """Longest end_dt - start_dt of insert rows (table_versions.max_duration), None without them"""
+    durations = [row["end_dt"] - row["start_dt"] for row in data
+                 if row.get("start_dt") is not None and row.get("end_dt") is not None]
+    return pd.Timedelta(max(durations)).to_pytimedelta() if durations else None
+
+def copy_timestamps(values):
+    """ISO strings for COPY, tz aware timestamps are written in UTC with an explicit offset"""
+    values = pd.DatetimeIndex(values)
+    if values.tz is not None:
+        return np.char.add(np.datetime_as_string(values.tz_convert("UTC").tz_localize(None).values, unit="us"), "+00")
+    return np.datetime_as_string(values.values, unit="us")
+
+def copy_array(values, integer=False):
+    """PostgreSQL array literal for a list like of numbers or timestamps"""
+    if values is None:
+        return None
+    values = pd.Series(values)
+    missing = values.isna().values
+    if pd.api.types.is_datetime64_any_dtype(values):
+        items = copy_timestamps(values)
+    elif integer:
+        items = values.fillna(0).astype(np.int64).values.astype(str)
+    else:
+        items = values.values.astype(str)
+    if missing.any():
+        items = np.where(missing, "NULL", items)
+    return "{" + ",".join(items) + "}"
+
+def null_missing_elements(row):
+    """
+    Row with the NaN elements of float arrays as None, so bulk_insert writes them as NULL like
+    copy_array does for copy_insert instead of 'NaN'::float. Rows without NaN are returned as is.
+    """
+    missing = {name: value for name, value in row.items()
+               if isinstance(value, np.ndarray) and value.dtype.kind == "f" and np.isnan(value).any()}
+    if not missing:
+        return row
+    row = dict(row)
+    for name, value in missing.items():
+        row[name] = np.where(np.isnan(value), None, value.astype(object))
+    return row
+
+def copy_geometries(values, srid=4326):
+    """
+    Hex EWKB for a column of WKTElement, WKBElement, shapely geometries or WKT strings.
+    A column that is already hex EWKB (segment_rows) is written as is.
+    """
+    if all(isinstance(value, str) and value.startswith(("00", "01")) for value in values):
+        return list(values)
+    geoms = []
+    for value in values:
+        if isinstance(value, WKTElement):
+            value = shapely.from_wkt(value.data)
+        elif isinstance(value, WKBElement):
+            value = shapely.from_wkb(bytes(value.data))
+        elif isinstance(value, str):
+            value = shapely.from_wkt(value) if not value.startswith(("00", "01")) else shapely.from_wkb(value)
+        geoms.append(value)
+    geoms = shapely.set_srid(np.asarray(geoms, dtype=object), srid)
+    return shapely.to_wkb(geoms, hex=True, include_srid=True)
+
+def copy_column_values(values, column_type):
+    """Serialize one column of rows into COPY csv values, None is written as NULL"""
+    if isinstance(column_type, Geometry):
+        return copy_geometries(values, srid=column_type.srid if column_type.srid > 0 else 4326)
+    if isinstance(column_type, ARRAY):
+        integer = isinstance(column_type.item_type, Integer)
+        return [copy_array(value, integer=integer) for value in values]
+    if isinstance(column_type, DateTime):
+        return [None if pd.isna(value) else ts for value, ts in zip(values, copy_timestamps(values))]
+    if isinstance(column_type, (Interval, INTERVAL)):
+        return [None if pd.isna(value) else f"{pd.Timedelta(value).total_seconds()} seconds" for value in values]
+    return [None if value is None else value for value in values]
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each connection checkout waits"""
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start_time
+            if not hasattr(self, "stats"):
+                self.stats = {"checkouts": 0, "total_wait": 0.0, "max_wait": 0.0}
+            self.stats["checkouts"] += 1
+            self.stats["total_wait"] += wait
+            self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+
+# Connection pool settings used by ClearAIS_DB.shared, change them with ClearAIS_DB.configure_pool
+pool_options = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": True,
+    "statement_timeout": None,  # milliseconds
+    "application_name": "clear_ais",
+}
+shared_instances = {}
+shared_instances_lock = threading.Lock()
+
 class ClearAIS_DB():
-    def __init__(self, database_url) -> None:
-        self.engine = create_engine(database_url, echo = False)
+    def __init__(self, database_url, pool_size=5, max_overflow=10, pool_pre_ping=True,
+                 statement_timeout=None, application_name="clear_ais") -> None:
+        connect_args = {"application_name": application_name}
+        if statement_timeout:
+            connect_args["options"] = f"-c statement_timeout={int(statement_timeout)}"
+
+        self.engine = create_engine(database_url, echo = False, poolclass=TimedQueuePool,
+                                    pool_size=pool_size, max_overflow=max_overflow,
+                                    pool_pre_ping=pool_pre_ping, connect_args=connect_args)
         self.Session = sessionmaker(bind=self.engine)
 
+    @classmethod
+    def configure_pool(cls, **options):
+        """Update the pool settings of the shared instances created after this call"""
+        unknown = set(options) - set(pool_options)
+        if unknown:
+            raise ValueError(f"Unknown pool options: {unknown}")
+        pool_options.update({key: value for key, value in options.items() if value is not None})
+
+    @classmethod
+    def shared(cls, database_url):
+        """One pooled ClearAIS_DB per process and database url, reused by ingestion and query code"""
+        key = (os.getpid(), database_url)
+        instance = shared_instances.get(key)
+        if instance is None:
+            with shared_instances_lock:
+                instance = shared_instances.get(key)
+                if instance is None:
+                    instance = cls(database_url, **pool_options)
+                    shared_instances[key] = instance
+        return instance
+
+    def pool_stats(self):
+        """Connection checkout wait times and pool usage, to size the pool for parallel loads"""
+        pool = self.engine.pool
+        stats = dict(getattr(pool, "stats", {"checkouts": 0, "total_wait": 0.0, "max_wait": 0.0}))
+        stats["mean_wait"] = stats["total_wait"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        stats.update({"size": pool.size(), "checked_out": pool.checkedout(), "overflow": pool.overflow()})
+        return stats
+
     def get_session(self):
         return self.Session()
 
+    def create_monthly_table(self, year_month, layout="linestring"):
+        """
+        Create trajectories_<year_month> in the given layout if it doesn't exist, only the first call per
+        process hits the catalog. An existing table is reflected and keeps its layout. When the partitioned
+        trajectories parent exists the table is created as its partition, in the layout of the parent.
+        """
+        table_name = f"trajectories_{year_month}"
+        if table_name in table_registry:
+            return table_name
+
+        with table_registry_lock:
+            if table_name not in table_registry:
+                partitioning = self.partitioning()
+                if inspect(self.engine).has_table(table_name, schema=POSTGRES_SCHEMA):
+                    self.add_missing_columns(table_name)
+                    if partitioning is not None and not self.is_partition(table_name):
+                        logger.warning(f"{table_name} is not a partition of {PARTITIONED_TABLE}, attach it with src/migrate_partitions.py")
+                    monthly_table = Table(table_name, monthly_metadata, autoload_with=self.engine)
+                elif partitioning is not None:
+                    self.create_partition(year_month, partitioning.get("mmsi_partitions", 0))
+                    monthly_table = Table(table_name, monthly_metadata, autoload_with=self.engine)
+                else:
+                    monthly_table = monthly_trajectories_table(year_month, layout=layout)
+                    monthly_table.create(self.engine, checkfirst=True)
+                table_registry[table_name] = monthly_table
+                logger.info(f"Using monthly table {table_name} ({self.table_layout(table_name)} layout)")
+        return table_name
+
+    def add_missing_columns(self, table_name):
+        """
+        Add the ADDED_COLUMNS an older monthly table lacks, to the parent when it is a partition. The
+        summary columns of existing rows stay NULL until backfill_trajectory_summaries (sql/trajectory_summaries.sql).
+        """
+        existing = {column["name"] for column in inspect(self.engine).get_columns(table_name, schema=POSTGRES_SCHEMA)}
+        missing = [name for name in ADDED_COLUMNS if name not in existing]
+        if not missing:
+            return
+        target = PARTITIONED_TABLE if self.is_partition(table_name) else table_name
+        with self.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {POSTGRES_SCHEMA}.{target} " +
+                              ", ".join(f"ADD COLUMN IF NOT EXISTS {name} {ADDED_COLUMNS[name]}" for name in missing)))
+        logger.info(f"Added {', '.join(missing)} to {target}")
+
+    def ship_types(self, mmsis):
+        """mmsi -> type_of_ship_and_cargo from the ships table, cached per process"""
+        missing = [mmsi for mmsi in mmsis if mmsi not in ship_type_cache]
+        if missing:
+            with self.engine.connect() as conn:
+                ship_type_cache.update(conn.execute(
+                    select(Ships.mmsi, Ships.type_of_ship_and_cargo).where(Ships.mmsi.in_(missing))).all())
+        return {mmsi: ship_type_cache.get(mmsi) for mmsi in mmsis}
+
+    def partitioning(self):
+        """
+        Settings of the partitioned trajectories parent ({"mmsi_partitions": n}), None while the monthly
+        tables are standalone. The catalog is read once per process.
+        """
+        if not hasattr(self, "partition_settings"):
+            with self.engine.connect() as conn:
+                row = conn.execute(text("""
+                    SELECT c.relkind, obj_description(c.oid, 'pg_class')
+                    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE n.nspname = :schema AND c.relname = :table_name
+                """), {"schema": POSTGRES_SCHEMA, "table_name": PARTITIONED_TABLE}).first()
+            self.partition_settings = json.loads(row[1] or "{}") if row is not None and row[0] == "p" else None
+        return self.partition_settings
+
+    def create_partitioned_table(self, layout="linestring", mmsi_partitions=0):
+        """
+        Create the trajectories parent, range partitioned by start_dt, new monthly tables are then created
+        as its partitions. With mmsi_partitions > 0 every month is split into that many mmsi hash partitions.
+        An existing parent keeps its layout and settings.
+        """
+        if self.partitioning() is None:
+            partitioned_trajectories_table(layout=layout).create(self.engine, checkfirst=True)
+            with self.engine.begin() as conn:
+                settings = json.dumps({"mmsi_partitions": mmsi_partitions})
+                conn.execute(text(f"COMMENT ON TABLE {POSTGRES_SCHEMA}.{PARTITIONED_TABLE} IS '{settings}'"))
+            del self.partition_settings
+        if self.partitioning() is None:
+            raise RuntimeError(f"{POSTGRES_SCHEMA}.{PARTITIONED_TABLE} exists and is not a partitioned table")
+        logger.info(f"Monthly tables are partitions of {PARTITIONED_TABLE} {self.partitioning()}")
+        return self.partitioning()
+
+    def create_partition(self, year_month, mmsi_partitions=0):
+        """trajectories_<year_month> as the partition of the parent for the start_dt range of the month"""
+        table_name = f"trajectories_{year_month}"
+        start, end = month_bounds(year_month)
+        sub_partitions = " PARTITION BY HASH (mmsi)" if mmsi_partitions else ""
+        with self.engine.begin() as conn:
+            # Writers in other processes may create the same month at the same time
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:table_name))"), {"table_name": table_name})
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {POSTGRES_SCHEMA}.{table_name} PARTITION OF {POSTGRES_SCHEMA}.{PARTITIONED_TABLE}
+                FOR VALUES FROM ('{start}') TO ('{end}'){sub_partitions}
+            """))
+            for remainder in range(mmsi_partitions):
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {POSTGRES_SCHEMA}.{table_name}_p{remainder} PARTITION OF {POSTGRES_SCHEMA}.{table_name}
+                    FOR VALUES WITH (MODULUS {mmsi_partitions}, REMAINDER {remainder})
+                """))
+        return table_name
+
+    def monthly_tables(self):
+        """Names of all trajectories_YYYY_MM tables, partitions or not"""
+        with self.engine.connect() as conn:
+            return conn.execute(text("""
+                SELECT c.relname
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')
+                  AND c.relname ~ '^trajectories_[0-9]{4}_[0-9]{2}$'
+                ORDER BY c.relname
+            """), {"schema": POSTGRES_SCHEMA}).scalars().all()
+
+    def is_partition(self, table_name):
+        with self.engine.connect() as conn:
+            return bool(conn.execute(text("""
+                SELECT c.relispartition
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = :schema AND c.relname = :table_name
+            """), {"schema": POSTGRES_SCHEMA, "table_name": table_name}).scalar())
+
+    def leaf_tables(self, table_name):
+        """Tables holding the rows of a monthly table, its mmsi hash partitions if it has any"""
+        with self.engine.connect() as conn:
+            leaves = conn.execute(text("""
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                JOIN pg_namespace n ON n.oid = p.relnamespace
+                WHERE n.nspname = :schema AND p.relname = :table_name
+                ORDER BY c.relname
+            """), {"schema": POSTGRES_SCHEMA, "table_name": table_name}).scalars().all()
+        return leaves or [table_name]
+
+    def table_indexes(self, table_name):
+        """index name -> valid of the indexes of a table, a failed concurrent build leaves an invalid one"""
+        with self.engine.connect() as conn:
+            return dict(conn.execute(text("""
+                SELECT ic.relname, x.indisvalid
+                FROM pg_index x
+                JOIN pg_class ic ON ic.oid = x.indexrelid
+                JOIN pg_class t ON t.oid = x.indrelid
+                JOIN pg_namespace n ON n.oid = t.relnamespace
+                WHERE n.nspname = :schema AND t.relname = :table_name
+            """), {"schema": POSTGRES_SCHEMA, "table_name": table_name}).all())
+
+    def missing_indexes(self, table_name):
+        """(table, index name, method, columns) of the trajectory_indexes a monthly table doesn't have yet"""
+        if not inspect(self.engine).has_table(table_name, schema=POSTGRES_SCHEMA):
+            return []
+        missing = []
+        for leaf in self.leaf_tables(table_name):
+            existing = self.table_indexes(leaf)
+            for index_name, (method, columns) in trajectory_indexes(leaf, self.table_layout(leaf)).items():
+                if not existing.get(index_name, False):
+                    missing.append((leaf, index_name, method, columns))
+        return missing
+
+    def build_index(self, table_name, index_name, method, columns):
+        """
+        CREATE INDEX CONCURRENTLY, writers keep inserting into the table meanwhile. An invalid index
+        left by a failed build is dropped first. Returns the build seconds and the index bytes.
+        """
+        start = time.perf_counter()
+        with self.engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT")
+            # Builds of big months take longer than the statement_timeout of the pool
+            conn.execute(text("SET statement_timeout = 0"))
+            try:
+                if self.table_indexes(table_name).get(index_name) is False:
+                    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {POSTGRES_SCHEMA}.{index_name}"))
+                conn.execute(text(f"""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name}
+                    ON {POSTGRES_SCHEMA}.{table_name} USING {method} ({columns})
+                """))
+                size = conn.execute(text("SELECT pg_relation_size(to_regclass(:index_name))"),
+                                    {"index_name": f"{POSTGRES_SCHEMA}.{index_name}"}).scalar()
+            finally:
+                conn.execute(text("RESET statement_timeout"))
+        return time.perf_counter() - start, size
+
+    def session_timezone(self):
+        """TimeZone of the connections, tz aware start_dt values are stored as local time in it"""
+        if not hasattr(self, "timezone"):
+            with self.engine.connect() as conn:
+                self.timezone = conn.execute(text("SHOW TimeZone")).scalar()
+        return self.timezone
+
+    def table_layout(self, table_name):
+        """Storage layout of a monthly table, told apart by the column holding the point times"""
+        columns = self.get_table(table_name).c
+        if "timestamps" in columns:
+            return "linestring"
+        return "compact" if "time_offsets" in columns else "measured"
+
+    def get_table(self, table_name):
+        """Registered table, reflected from the database the first time it is used"""
+        dynamic_table = table_registry.get(table_name)
+        if dynamic_table is None:
+            with table_registry_lock:
+                dynamic_table = table_registry.get(table_name)
+                if dynamic_table is None:
+                    dynamic_table = Table(table_name, monthly_metadata, autoload_with=self.engine)
+                    table_registry[table_name] = dynamic_table
+        return dynamic_table
+
+    def get_insert_statement(self, table_name):
+        """Cached INSERT ... ON CONFLICT DO NOTHING statement for a registered table"""
+        stmt = insert_statements.get(table_name)
+        if stmt is None:
+            stmt = insert(self.get_table(table_name)).on_conflict_do_nothing()
+            insert_statements[table_name] = stmt
+        return stmt
+
+    def get_checkpoint(self, file_path):
+        """IngestionManifest row of a file or None"""
+        with self.Session() as session:
+            return session.get(IngestionManifest, file_path)
+
+    def save_checkpoint(self, file_path, **values):
+        """Insert or update the IngestionManifest row of a file"""
+        values["updated_at"] = datetime.datetime.now()
+        stmt = insert(IngestionManifest).values(file_path=file_path, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=["file_path"], set_=values)
+        with self.Session() as session:
+            session.execute(stmt)
+            session.commit()
+
+    def bump_table_version(self, table_name, max_duration=None):
+        """
+        Increment the version of a table after new rows were committed to it. Done in its own short
+        transaction, not in the one of the insert, so parallel writers of a month don't serialize on
+        the counter row. A reader that took the version before its query sees a later version.
+        max_duration of the new rows raises the one of the table, an unknown one stays unknown.
+        """
+        stmt = insert(TableVersions).values(table_name=table_name, version=1, updated_at=datetime.datetime.now(),
+                                            max_duration=max_duration)
+        stmt = stmt.on_conflict_do_update(index_elements=["table_name"], set_={
+            "version": TableVersions.version + 1, "updated_at": stmt.excluded.updated_at,
+            "max_duration": case((TableVersions.max_duration.is_(None), None),
+                                 else_=func.greatest(TableVersions.max_duration, stmt.excluded.max_duration))})
+        try:
+            with self.Session() as session:
+                session.execute(stmt)
+                session.commit()
+        except exc.SQLAlchemyError as e:
+            # Databases created before the table_versions table, nothing caches their results
+            logger.warning(f"Could not bump the version of {table_name}: {str(e)}")
+
+    def table_max_durations(self, table_names):
+        """
+        table name -> longest end_dt - start_dt of its rows. Tables whose rows were written before
+        table_versions kept it are measured once and the result recorded.
+        """
+        try:
+            with self.Session() as session:
+                known = dict(session.execute(select(TableVersions.table_name, TableVersions.max_duration)
+                                             .where(TableVersions.table_name.in_(list(table_names)))).all())
+        except exc.SQLAlchemyError as e:
+            # table_versions of an older database, every table is measured
+            logger.warning(f"Could not read the trajectory durations from table_versions: {str(e)}")
+            known = {}
+
+        durations = {}
+        for table_name in table_names:
+            duration = known.get(table_name)
+            if duration is None:
+                with self.engine.begin() as conn:
+                    duration = conn.execute(text(
+                        f"SELECT max(end_dt - start_dt) FROM {POSTGRES_SCHEMA}.{table_name}")).scalar()
+                duration = duration or datetime.timedelta(0)
+                self.record_max_duration(table_name, duration)
+            durations[table_name] = pd.Timedelta(duration)
+        return durations
+
+    def record_max_duration(self, table_name, max_duration):
+        """Store the measured max_duration of a table, the version stays"""
+        stmt = insert(TableVersions).values(table_name=table_name, version=0, updated_at=datetime.datetime.now(),
+                                            max_duration=max_duration)
+        stmt = stmt.on_conflict_do_update(index_elements=["table_name"], set_={
+            "max_duration": func.greatest(TableVersions.max_duration, stmt.excluded.max_duration)})
+        try:
+            with self.Session() as session:
+                session.execute(stmt)
+                session.commit()
+        except exc.SQLAlchemyError as e:
+            logger.warning(f"Could not record the trajectory duration of {table_name}: {str(e)}")
+
+    def table_versions(self, table_names):
+        """table name -> version, 0 for tables never written since table_versions exists"""
+        with self.Session() as session:
+            rows = session.execute(select(TableVersions.table_name, TableVersions.version)
+                                   .where(TableVersions.table_name.in_(list(table_names)))).all()
+        versions = dict.fromkeys(table_names, 0)
+        versions.update(rows)
+        return versions
+
     @try_except(logger=logger)
     def create_tables(self,drop_existing=True):
         if drop_existing: Base.metadata.drop_all(self.engine) 
@@ -200,8 +801,12 @@ class ClearAIS_DB():
         # Base.metadata.create_all(self.engine)
         Ships.__table__.create(bind=self.engine, checkfirst=True)
         Nav_Status.__table__.create(bind=self.engine, checkfirst=True)
+        IngestionManifest.__table__.create(bind=self.engine, checkfirst=True)
+        TableVersions.__table__.create(bind=self.engine, checkfirst=True)
+        with self.engine.begin() as conn:
+            # table_versions created before max_duration was kept, NULL reads as unknown
+            conn.execute(text(f"ALTER TABLE {POSTGRES_SCHEMA}.table_versions ADD COLUMN IF NOT EXISTS max_duration INTERVAL"))
         # TODO: maybe add complete trajecteries table later, or merged trajectories table
-        # Trajectories.__table__.create(bind=self.engine, checkfirst=True)
         # AIS_Data.__table__.create(bind=self.engine, checkfirst=True)
         # Voyage_Models.__table__.create(bind=self.engine, checkfirst=True)
         # Voyage_Segments.__table__.create(bind=self.engine, checkfirst=True)
@@ -212,7 +817,10 @@ class ClearAIS_DB():
     def save_schema(self,file_path="src/sql/schema.sql"):
         # Collect all the CreateTable statements
         output = StringIO()
-        for table in Base.metadata.sorted_tables:
+        # The trajectories are in the monthly tables, or their partitioned parent with --partitioned. The
+        # parent is rendered on its own MetaData, the one cached in monthly_metadata must get the --layout
+        parent = partitioned_trajectories_table(MetaData(schema=POSTGRES_SCHEMA))
+        for table in Base.metadata.sorted_tables + [parent]:
             output.write(str(CreateTable(table).compile(dialect=self.engine.dialect)))
             output.write(";\n\n")
 
@@ -253,24 +861,24 @@ class ClearAIS_DB():
         retry_delay = 3
 
         for attempt in range(max_retries):
+            committed = False
             try:
                 with self.Session() as session:
                     session.execute(text("SET TRANSACTION ISOLATION LEVEL SERIALIZABLE"))
                     
                     for i in range(0, len(data), batch_size):
-                        batch = data[i:i + batch_size]
+                        batch = [null_missing_elements(row) for row in data[i:i + batch_size]]
                         
                         if isinstance(table, str):
-                            # For dynamic tables, create the table if it doesn't exist
-                            dynamic_table = Table(table, metadata, autoload_with=session.get_bind())
-                            # Use SQLAlchemy's bulk insert with ON CONFLICT DO NOTHING
-                            stmt = insert(dynamic_table).on_conflict_do_nothing()
+                            # For dynamic tables, use the cached table and its ON CONFLICT DO NOTHING insert
+                            stmt = self.get_insert_statement(table)
                             session.execute(stmt, batch)
                         else:
                             # For model classes, use SQLAlchemy's bulk insert
                             session.bulk_insert_mappings(table, batch)
                         
                         session.commit()
+                        committed = True
                     
                     return True
                     
@@ -282,9 +890,64 @@ class ClearAIS_DB():
                 logger.error(f"Error in bulk_insert: {str(e)}")
                 logger.exception("Full traceback:")
                 raise
+            finally:
+                # Also when a later batch failed, the committed ones are in the table
+                if committed and isinstance(table, str):
+                    self.bump_table_version(table, rows_max_duration(data))
                 
         return False
 
+    def copy_insert(self, table, data, conflict_columns=('mmsi', 'start_dt')):
+        """
+        Bulk insert data with COPY into a temporary staging table, then merge it into the table
+        with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+
+        Args:
+            table: Table name (string)
+            data: List of dictionaries containing data to insert, same format as bulk_insert
+            conflict_columns: Unique columns used for the ON CONFLICT clause
+        """
+        if not data:
+            return True
+
+        dynamic_table = self.get_table(table)
+        columns = [col for col in dynamic_table.columns if col.name in data[0]]
+        column_names = ", ".join(f'"{col.name}"' for col in columns)
+        staging_ddl = staging_columns_ddl(columns, self.engine.dialect)
+        # The temp table lives as long as the pooled connection, one per column set so a call with other
+        # columns (added summary columns, another layout) never copies into a staging table of the old ones
+        staging_table = f"_staging_{table}_{hashlib.blake2b(staging_ddl.encode(), digest_size=4).hexdigest()}"
+
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(zip(*[copy_column_values([row.get(col.name) for row in data], col.type) for col in columns]))
+        buffer.seek(0)
+
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                # Timestamps are staged with time zone so they are converted like the insert path does
+                cursor.execute(f"""
+                    CREATE TEMP TABLE IF NOT EXISTS {staging_table} ({staging_ddl})
+                    ON COMMIT DELETE ROWS
+                """)
+                cursor.copy_expert(f"COPY {staging_table} ({column_names}) FROM STDIN WITH (FORMAT csv)", buffer)
+                cursor.execute(f"""
+                    INSERT INTO {POSTGRES_SCHEMA}.{table} ({column_names})
+                    SELECT {column_names} FROM {staging_table}
+                    ON CONFLICT ({", ".join(conflict_columns)}) DO NOTHING
+                """)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error in copy_insert: {str(e)}")
+            logger.exception("Full traceback:")
+            raise
+        finally:
+            conn.close()
+        self.bump_table_version(table, rows_max_duration(data))
+        return True
+
     def excecute(self, query):
         session = self.Session()
         try:
@@ -301,8 +964,8 @@ class ClearAIS_DB():
         return None
 
     def to_df(self,query):
-        conn = self.session.connection()
-        df = pd.read_sql(query, conn)
+        with self.engine.connect() as conn:
+            df = pd.read_sql(text(query) if isinstance(query, str) else query, conn)
         return df
     
     # TODO add bulk insert nav_status
@@ -349,6 +1012,183 @@ class ClearAIS_DB():
                 
         return False
 
+GEOMETRY_COLUMNS = ("coordinates", "origin", "destination")
+
+def wkb_bytes(value):
+    """WKB bytes of a geometry as returned by GeoAlchemy2 (WKBElement) or psycopg2, None stays None"""
+    if value is None:
+        return None
+    data = value.data if isinstance(value, WKBElement) else value
+    return bytes.fromhex(data) if isinstance(data, str) else bytes(data)
+
+def geo_frame(frame):
+    """GeoDataFrame of a frame with WKB geometry columns, coordinates is the active geometry"""
+    import geopandas as gpd
+    geometry_columns = [name for name in GEOMETRY_COLUMNS if name in frame]
+    for name in geometry_columns:
+        frame[name] = gpd.GeoSeries(shapely.from_wkb(frame[name].to_numpy()), index=frame.index, crs=4326)
+    return gpd.GeoDataFrame(frame, geometry=geometry_columns[0] if geometry_columns else None)
+
+class TrajectoryStore:
+    """
+    Read trajectories back from the monthly tables without writing SQL.
+
+    query() only looks at the tables of the months that can hold trajectories overlapping the time
+    range, given the longest trajectory of every table (table_versions.max_duration, trajectories
+    span months when a ship reports rarely), queries them concurrently over the connection pool and streams the rows through server
+    side cursors in batches of batch_size, as GeoDataFrames or Arrow tables. The batches of the
+    months arrive interleaved.
+
+        store = TrajectoryStore(database_url)
+        for frame in store.query((11.7, 57.5, 11.8, 57.6), "2023-02-01", "2023-02-08", min_sog=2.0):
+            ...
+    """
+    def __init__(self, database_url, workers=4, batch_size=10000, max_duration=None):
+        self.db = database_url if isinstance(database_url, ClearAIS_DB) else ClearAIS_DB.shared(database_url)
+        self.workers = workers
+        self.batch_size = batch_size
+        # A fixed bound on the trajectory durations instead of the ones recorded per table, trajectories
+        # longer than it are missed
+        self.max_duration = pd.Timedelta(max_duration) if max_duration is not None else None
+
+    def local_time(self, value):
+        """Naive local time like start_dt and end_dt, tz aware values are converted to the session time zone"""
+        timestamp = pd.Timestamp(value)
+        if timestamp.tz is not None:
+            timestamp = timestamp.tz_convert(self.db.session_timezone()).tz_localize(None)
+        return timestamp.to_pydatetime()
+
+    def tables(self, start, end):
+        """
+        Monthly tables that can hold trajectories overlapping start to end. Partitions hold the
+        trajectories that started in their month, standalone monthly tables the ones that ended
+        while the csv files of their month were read, each month is widened by the longest
+        trajectory of its table.
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        existing = self.db.monthly_tables()
+        if self.max_duration is not None:
+            durations = dict.fromkeys(existing, self.max_duration)
+        else:
+            durations = self.db.table_max_durations(existing)
+        partitioned = self.db.partitioning() is not None
+
+        table_names = []
+        for table_name in existing:
+            month = pd.Period(table_name[-7:].replace("_", "-"), freq="M")
+            month_start, month_end = month.start_time, (month + 1).start_time
+            if partitioned:
+                overlaps = month_start <= end and month_end + durations[table_name] >= start
+            else:
+                overlaps = month_end >= start and month_start - durations[table_name] <= end
+            if overlaps:
+                table_names.append(table_name)
+        return table_names
+
+    def statement(self, table_name, bbox, start, end, mmsi=None, min_sog=None, ship_types=None, columns=None):
+        """SELECT on one monthly table, see query. start or end None leaves that side of the time range open"""
+        table = self.db.get_table(table_name)
+        for name, value in (("sog_max", min_sog), ("ship_type", ship_types)):
+            if value is not None and name not in table.c:
+                raise ValueError(f"{table_name} has no {name} column, see sql/trajectory_summaries.sql")
+
+        if isinstance(bbox, (tuple, list)):
+            area = func.ST_MakeEnvelope(*bbox, 4326)
+        else:
+            area = func.ST_GeomFromText(shapely.to_wkt(bbox), 4326)
+        conditions = [func.ST_Intersects(table.c.coordinates, area)]
+        if end is not None:
+            conditions.append(table.c.start_dt <= end)
+        if start is not None:
+            conditions.append(table.c.end_dt >= start)
+        if mmsi is not None:
+            conditions.append(table.c.mmsi.in_([str(value) for value in np.atleast_1d(mmsi)]))
+        if min_sog is not None:
+            conditions.append(table.c.sog_max >= min_sog)
+        if ship_types is not None:
+            conditions.append(table.c.ship_type.in_([int(value) for value in np.atleast_1d(ship_types)]))
+        selected = [table.c[name] for name in columns if name in table.c] if columns else [table]
+        return select(*selected).where(*conditions)
+
+    def to_frame(self, table_name, keys, rows, output="geopandas"):
+        """GeoDataFrame or Arrow table (geometries as WKB) of a batch of rows, compact rows decoded"""
+        frame = pd.DataFrame.from_records(rows, columns=keys)
+        if self.db.table_layout(table_name) == "compact":
+            # start_dt is local time in the session time zone, the offsets are added in it
+            frame = decode_compact_frame(frame, self.db.session_timezone())
+        geometry_columns = [name for name in GEOMETRY_COLUMNS if name in frame]
+        for name in geometry_columns:
+            frame[name] = [wkb_bytes(value) for value in frame[name]]
+
+        if output == "arrow":
+            import pyarrow as pa
+            return pa.Table.from_pandas(frame, preserve_index=False)
+        return geo_frame(frame)
+
+    def query(self, bbox, start, end, mmsi=None, min_sog=None, ship_types=None, columns=None, output="geopandas"):
+        """
+        Trajectories that intersect bbox and overlap start to end, in batches.
+
+        bbox: (min_lon, min_lat, max_lon, max_lat) or a shapely geometry in EPSG:4326
+        start, end: times, naive ones are local times like start_dt
+        mmsi: one mmsi or a list of them
+        min_sog: only trajectories that reached this speed (sog_max)
+        ship_types: type_of_ship_and_cargo codes
+        columns: column names to select, all by default
+        output: "geopandas" or "arrow"
+        """
+        if output not in ("geopandas", "arrow"):
+            raise ValueError(f"Unknown output: {output}")
+        start, end = self.local_time(start), self.local_time(end)
+        statements = {table_name: self.statement(table_name, bbox, start, end, mmsi, min_sog, ship_types, columns)
+                      for table_name in self.tables(start, end)}
+        for _, frame in self.stream(statements, output):
+            yield frame
+
+    def stream(self, statements, output="geopandas"):
+        """Run {table name: statement} concurrently, yields (table name, batch) as the batches arrive"""
+        # Bounded, so the streams wait for the consumer instead of piling up batches
+        batches = queue.Queue(maxsize=2 * self.workers)
+        stop = threading.Event()
+        finished = object()
+
+        def stream(table_name, statement):
+            try:
+                if stop.is_set():
+                    return
+                with self.db.engine.connect() as conn:
+                    result = conn.execution_options(stream_results=True, max_row_buffer=self.batch_size).execute(statement)
+                    keys = list(result.keys())
+                    for rows in result.partitions(self.batch_size):
+                        if stop.is_set():
+                            break
+                        batches.put((table_name, keys, rows))
+            except Exception as e:
+                batches.put(e)
+            finally:
+                batches.put(finished)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(statements))), thread_name_prefix="trajectory_store")
+        for table_name, statement in statements.items():
+            executor.submit(stream, table_name, statement)
+        remaining = len(statements)
+        try:
+            while remaining:
+                item = batches.get()
+                if item is finished:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item[0], self.to_frame(*item, output=output)
+        finally:
+            # Also when the caller stops early: let the streams see stop and finish
+            stop.set()
+            while remaining:
+                if batches.get() is finished:
+                    remaining -= 1
+            executor.shutdown()
+
 if __name__=='__main__':
     POSTGRES_DB="gis"
     POSTGRES_USER="clear"
@@ -0,0 +1,110 @@
+"""
+External sort of a month of AIS csv files by (mmsi, timestamp).
+
+The files are read in parallel and their rows are hash partitioned by mmsi into Arrow IPC run
+files on local disk (pass 1). Each partition then only holds the rows of its ships and is
+sorted in memory by (mmsi, timestamp), again in parallel (pass 2). Streaming the sorted
+partitions gives every ship's rows of the month contiguously and in time order, so the
+trajectory splitter needs no buffering across files. Memory per process is bounded by the
+partition size, pick more partitions for bigger months.
+"""
+import math, os, shutil, tempfile
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from csv_reader import read_csv_chunks
+from ais_timestamps import parse_ais_timestamps, parse_unix_timestamps
+
+SORT_KEY = "_sort_timestamp"
+PARTITION_BYTES = 256 << 20  # csv bytes per partition when the number of partitions isn't given
+
+
+def partition_of_mmsi(mmsi, num_partitions):
+    """Stable partition index for each mmsi"""
+    return pd.util.hash_array(np.asarray(mmsi, dtype=object)) % num_partitions
+
+def sort_timestamps(chunk):
+    """Time stamps of a chunk as int64 UTC nanoseconds, parsed the way the ingestion parses them"""
+    if 'unix_time_stamp' in chunk.columns and chunk['unix_time_stamp'].notna().all():
+        parsed = parse_unix_timestamps(chunk['unix_time_stamp'])
+    else:
+        parsed = parse_ais_timestamps(chunk['timestamp'])
+    return parsed.to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+def write_table(table, path, max_chunksize=None):
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max_chunksize)
+
+def read_table(path):
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+def write_runs(file_index, file_path, run_dir, num_partitions, chunk_size):
+    """Pass 1: split the rows of a csv file into one run file per partition and chunk"""
+    run_paths = []
+    for chunk_index, chunk in enumerate(read_csv_chunks(file_path, chunk_size)):
+        chunk[SORT_KEY] = sort_timestamps(chunk)
+        partitions = partition_of_mmsi(chunk['mmsi'].values, num_partitions)
+        for partition, part in chunk.groupby(partitions):
+            path = os.path.join(run_dir, f"{partition:05d}_{file_index:05d}_{chunk_index:06d}.arrow")
+            write_table(pa.Table.from_pandas(part, preserve_index=False), path)
+            run_paths.append((int(partition), path))
+    return run_paths
+
+def sort_partition(partition, run_paths, out_path, chunk_size):
+    """
+    Pass 2: concatenate the runs of a partition in file order and sort them by (mmsi, timestamp).
+    The sort is stable, rows of a ship with the same time stamp keep their file order.
+    """
+    table = pa.concat_tables([read_table(path) for path in run_paths], promote_options="permissive")
+    mmsi_codes, _ = pd.factorize(table.column("mmsi").to_numpy(zero_copy_only=False), sort=True)
+    order = np.lexsort((table.column(SORT_KEY).to_numpy(), mmsi_codes))
+    write_table(table.take(order).drop_columns([SORT_KEY]), out_path, max_chunksize=chunk_size)
+    for path in run_paths:
+        os.remove(path)
+    return out_path
+
+def sorted_month_chunks(csv_files, sort_dir=None, processes=None, num_partitions=None, chunk_size=100000):
+    """
+    Chunks of the rows of csv_files sorted by (mmsi, timestamp), with the columns and dtypes of
+    read_csv_chunks. Partitions are sorted in a process pool and streamed as they finish.
+    """
+    if pa is None:
+        raise ImportError("The sort pre-pass needs pyarrow")
+
+    processes = processes or os.cpu_count()
+    if num_partitions is None:
+        total_bytes = sum(os.path.getsize(file_path) for file_path in csv_files)
+        num_partitions = max(processes, math.ceil(total_bytes / PARTITION_BYTES))
+
+    work_dir = tempfile.mkdtemp(prefix="clear_ais_sort_", dir=sort_dir)
+    ctx = mp.get_context("spawn")
+    try:
+        with ctx.Pool(processes) as pool:
+            runs = pool.starmap(write_runs, [(file_index, file_path, work_dir, num_partitions, chunk_size)
+                                             for file_index, file_path in enumerate(csv_files)])
+
+            partition_runs = {}
+            for partition, path in sorted(run for file_runs in runs for run in file_runs):
+                partition_runs.setdefault(partition, []).append(path)
+
+            sorted_paths = pool.imap(_sort_partition, [(partition, paths, os.path.join(work_dir, f"sorted_{partition:05d}.arrow"), chunk_size)
+                                                       for partition, paths in partition_runs.items()])
+            for sorted_path in sorted_paths:
+                with pa.memory_map(sorted_path) as source:
+                    reader = pa.ipc.open_file(source)
+                    for i in range(reader.num_record_batches):
+                        yield reader.get_batch(i).to_pandas()
+                os.remove(sorted_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _sort_partition(args):
+    return sort_partition(*args)
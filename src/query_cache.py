@@ -0,0 +1,164 @@
+"""
+On-disk cache of TrajectoryStore query results, for the bbox and month queries that are repeated
+while iterating in a notebook.
+
+An entry holds the rows of one monthly table in the query bbox widened to a grid of bbox_step
+degrees, with the mmsi, min_sog, ship_types and columns filters of the query, as a Parquet file.
+Queries whose bbox snaps to the same cells reuse it; the rows are then cut to the exact bbox and
+time range. The file name carries the version of the table in table_versions when it was read,
+ingestion bumps it after committing rows to the table (ClearAIS_DB.bump_table_version) and the
+stale entry is read again. The least recently used files are evicted above max_bytes.
+
+    cache = QueryCache(TrajectoryStore(database_url), "~/.cache/clear_ais")
+    frame = cache.query((11.7, 57.5, 11.8, 57.6), "2023-02-01", "2023-02-08", min_sog=2.0)
+"""
+import hashlib, json, math, os, uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from database_schema import TrajectoryStore, geo_frame
+from logger import getLogger
+
+logger = getLogger(__file__)
+
+# Columns the cached rows are cut to the exact query with
+FILTER_COLUMNS = ("coordinates", "start_dt", "end_dt")
+
+
+class QueryCache:
+    """
+    Parquet files of query results per monthly table under cache_dir, at most max_bytes of them.
+    Several processes can share cache_dir, files are written to a temporary name and renamed.
+    """
+    def __init__(self, store:TrajectoryStore, cache_dir, max_bytes=2 * 1024**3, bbox_step=0.01):
+        self.store = store
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.bbox_step = bbox_step
+        self.hits = 0
+        self.misses = 0
+
+    def snap(self, bbox):
+        """(min_lon, min_lat, max_lon, max_lat) of bbox or a geometry widened to the bbox_step grid"""
+        min_lon, min_lat, max_lon, max_lat = bbox if isinstance(bbox, (tuple, list)) else shapely.bounds(bbox)
+        step = self.bbox_step
+        # Rounded so the same cell always gives the same key
+        return (round(math.floor(min_lon / step) * step, 9), round(math.floor(min_lat / step) * step, 9),
+                round(math.ceil(max_lon / step) * step, 9), round(math.ceil(max_lat / step) * step, 9))
+
+    def entry_name(self, table_name, cell, mmsi=None, min_sog=None, ship_types=None, columns=None):
+        """File name prefix of an entry, the normalized query hashed after the table name"""
+        key = {
+            "bbox": cell,
+            "mmsi": sorted(str(value) for value in np.atleast_1d(mmsi)) if mmsi is not None else None,
+            "min_sog": float(min_sog) if min_sog is not None else None,
+            "ship_types": sorted(int(value) for value in np.atleast_1d(ship_types)) if ship_types is not None else None,
+            "columns": sorted(columns) if columns else None,
+        }
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+        return f"{table_name}-{digest}"
+
+    def read(self, name, version):
+        """Arrow table of an entry at version or None, the files of other versions are deleted"""
+        path = self.cache_dir / f"{name}-v{version}.parquet"
+        for stale in self.cache_dir.glob(f"{name}-v*.parquet"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+        try:
+            table = pq.read_table(path)
+        except FileNotFoundError:
+            return None
+        # The modification time orders the files for eviction
+        os.utime(path)
+        return table
+
+    def write(self, name, version, batches):
+        """Store the batches of an entry, an empty result is stored too"""
+        table = pa.concat_tables(batches, promote_options="permissive") if batches else pa.table({})
+        path = self.cache_dir / f"{name}-v{version}.parquet"
+        temporary = self.cache_dir / f".{uuid.uuid4().hex}.tmp"
+        pq.write_table(table, temporary)
+        os.replace(temporary, path)
+        return table, path
+
+    def evict(self, keep=None):
+        """Delete the least recently used files until the cache is under max_bytes, not keep"""
+        files = []
+        for path in self.cache_dir.glob("*.parquet"):
+            try:
+                files.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        total = sum(stat.st_size for stat, _ in files)
+        for stat, path in sorted(files, key=lambda item: item[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def clear(self, table_name=None):
+        """Delete the entries of a table, or all of them"""
+        for path in self.cache_dir.glob(f"{table_name}-*.parquet" if table_name else "*.parquet"):
+            path.unlink(missing_ok=True)
+
+    def query(self, bbox, start, end, mmsi=None, min_sog=None, ship_types=None, columns=None, output="geopandas"):
+        """
+        Like TrajectoryStore.query, but returns the whole result as one GeoDataFrame or Arrow
+        table. The monthly tables missing from the cache are read for the whole snapped bbox.
+        """
+        if output not in ("geopandas", "arrow"):
+            raise ValueError(f"Unknown output: {output}")
+        start, end = self.store.local_time(start), self.store.local_time(end)
+        cell = self.snap(bbox)
+        fetched_columns = sorted(set(columns) | set(FILTER_COLUMNS)) if columns else None
+
+        table_names = self.store.tables(start, end)
+        # Taken before the rows are read: a commit the read misses moves the version past this one
+        versions = self.store.db.table_versions(table_names)
+        names = {table_name: self.entry_name(table_name, cell, mmsi, min_sog, ship_types, fetched_columns)
+                 for table_name in table_names}
+        entries, statements = {}, {}
+        for table_name in table_names:
+            entries[table_name] = self.read(names[table_name], versions[table_name])
+            if entries[table_name] is None:
+                statements[table_name] = self.store.statement(table_name, cell, None, None, mmsi, min_sog, ship_types, fetched_columns)
+        self.hits += len(table_names) - len(statements)
+        self.misses += len(statements)
+
+        batches = {table_name: [] for table_name in statements}
+        for table_name, batch in self.store.stream(statements, output="arrow"):
+            batches[table_name].append(batch)
+        for table_name in statements:
+            entries[table_name], path = self.write(names[table_name], versions[table_name], batches[table_name])
+            self.evict(keep=path)
+        logger.info(f"{len(table_names) - len(statements)} of {len(table_names)} monthly tables from the cache")
+
+        return self.cut(entries.values(), bbox, start, end, columns, output)
+
+    def cut(self, entries, bbox, start, end, columns=None, output="geopandas"):
+        """Rows of the entries intersecting bbox and overlapping start to end"""
+        tables = [table for table in entries if table.num_rows]
+        if not tables:
+            return pa.table({}) if output == "arrow" else geo_frame(pd.DataFrame())
+        table = pa.concat_tables(tables, promote_options="permissive")
+
+        area = shapely.box(*bbox) if isinstance(bbox, (tuple, list)) else bbox
+        geometries = shapely.from_wkb(table["coordinates"].to_numpy(zero_copy_only=False))
+        mask = shapely.intersects(geometries, area)
+        mask &= table["start_dt"].to_numpy(zero_copy_only=False) <= np.datetime64(end)
+        mask &= table["end_dt"].to_numpy(zero_copy_only=False) >= np.datetime64(start)
+        table = table.filter(pa.array(mask))
+        if columns:
+            table = table.select([name for name in columns if name in table.column_names])
+
+        if output == "arrow":
+            return table
+        return geo_frame(table.to_pandas())
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+GAP_THRESHOLD_DAYS = pd.Timedelta('1 day')
+GAP_THRESHOLD_MONTHS = pd.Timedelta(days=27)
+WINDOW = 20  # rows in the middle and end windows
+
+
+def group_offsets(lengths):
+    """Start offsets of consecutive groups with the given lengths, plus the total length at the end"""
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+def window_mean(values, index, mask=None):
+    """Mean of values[index] per row of the (groups, WINDOW) index matrix, skipping NaN like pandas and the positions outside mask"""
+    window = values[index]
+    valid = ~np.isnan(window) if mask is None else ~np.isnan(window) & mask
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(valid, window, 0).sum(axis=1) / valid.sum(axis=1)
+
+def window_mode(values, index, mask=None):
+    """Most frequent value per row of the index matrix, ties go to the smallest value like pandas mode()[0]"""
+    window = values[index]
+    low = window.min()
+    shifted = window - low
+    counts = np.zeros((window.shape[0], int(shifted.max()) + 1), dtype=np.int32)
+    np.add.at(counts, (np.repeat(np.arange(window.shape[0]), window.shape[1]), shifted.ravel()),
+              1 if mask is None else mask.ravel().astype(np.int32))
+    return counts.argmax(axis=1) + low
+
+def window_index(first, stop, lengths_start, lengths_stop):
+    """
+    (groups, WINDOW) index matrix of the rows first to first + WINDOW of every group, clipped to the
+    group (lengths_start to lengths_stop) for groups shorter than WINDOW, and the mask of the rows inside
+    """
+    index = first[:, None] + np.arange(WINDOW)
+    mask = (index >= np.maximum(first, lengths_start)[:, None]) & (index < np.minimum(stop, lengths_stop)[:, None])
+    return np.clip(index, lengths_start[:, None], (lengths_stop - 1)[:, None]), mask
+
+def find_segment_ends(timestamps, speed_over_ground, navigational_status, lengths, is_stationary,
+                      sog_threshold, upper_sog_threshold):
+    """
+    Voyage end and missing data flags for many ships in one pass.
+
+    The tracks of all ships are concatenated (each sorted by time) and described by their lengths.
+    A track ends a voyage when the ship was moving in the middle WINDOW rows (nav status not
+    stationary and mean SOG above upper_sog_threshold) and is stationary in the last WINDOW rows
+    (nav status stationary and mean SOG below sog_threshold).
+
+    Args:
+        timestamps: datetime64 array of all tracks
+        speed_over_ground: float array of all tracks
+        navigational_status: integer nav status codes of all tracks
+        lengths: rows per track, the windows of tracks shorter than WINDOW rows only hold their rows
+        is_stationary: function mapping an array of nav status codes to a boolean array
+
+    Returns:
+        dict with per track arrays voyage_end, gap_days, gap_months and per row arrays
+        large_gaps_days, large_gaps_months (gap to the previous row of the same track)
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = group_offsets(lengths)
+    starts = offsets[:-1]
+
+    # Gaps to the previous row, the first row of every track has no previous row
+    diff = np.zeros(len(timestamps), dtype="timedelta64[ns]")
+    diff[1:] = np.diff(timestamps.astype("datetime64[ns]"))
+    diff[starts] = np.timedelta64(0, "ns")
+    large_gaps_days = diff > GAP_THRESHOLD_DAYS.to_timedelta64()
+    large_gaps_months = diff > GAP_THRESHOLD_MONTHS.to_timedelta64()
+    gap_days = np.add.reduceat(large_gaps_days, starts) > 0 if len(starts) else np.zeros(0, dtype=bool)
+    gap_months = np.add.reduceat(large_gaps_months, starts) > 0 if len(starts) else np.zeros(0, dtype=bool)
+
+    # Middle and last WINDOW rows of every track as (tracks, WINDOW) index matrices, masked to the
+    # rows of the track when it is shorter
+    middle_first = starts + lengths // 2 - WINDOW // 2
+    middle_index, middle_mask = window_index(middle_first, middle_first + WINDOW, starts, offsets[1:])
+    last_index, last_mask = window_index(offsets[1:] - WINDOW, offsets[1:], starts, offsets[1:])
+    if lengths.size and lengths.min() >= WINDOW:
+        middle_mask = last_mask = None
+
+    speed_over_ground = np.asarray(speed_over_ground, dtype=np.float64)
+    middle_avg_speed = window_mean(speed_over_ground, middle_index, middle_mask)
+    mean_speed = window_mean(speed_over_ground, last_index, last_mask)
+    middle_stationary = is_stationary(window_mode(navigational_status, middle_index, middle_mask))
+    last_stationary = is_stationary(window_mode(navigational_status, last_index, last_mask))
+
+    voyage_end = (~middle_stationary & (middle_avg_speed > upper_sog_threshold)
+                  & last_stationary & (mean_speed < sog_threshold))
+
+    return {
+        "voyage_end": voyage_end,
+        "gap_days": gap_days,
+        "gap_months": gap_months,
+        "large_gaps_days": large_gaps_days,
+        "large_gaps_months": large_gaps_months,
+        "offsets": offsets,
+    }
@@ -0,0 +1,327 @@
+import os, shutil, tempfile, uuid
+from collections import OrderedDict
+from itertools import chain
+import numpy as np
+import pandas as pd
+
+# Columns kept per ship while a trajectory segment is open, with their buffer dtype
+TRACK_COLUMNS = {
+    "timestamp": "datetime64[ns]",
+    "latitude": np.float64,
+    "longitude": np.float64,
+    "speed_over_ground": np.float64,
+    "course_over_ground": np.float64,
+    "heading": np.float64,
+    "navigational_status": np.int32,
+}
+MISSING_VALUES = {"navigational_status": -1, "timestamp": np.datetime64("NaT")}
+
+
+def link_file(source, target):
+    """Hard link source as target, a copy across file systems. A target already linked to source is kept"""
+    if os.path.exists(target):
+        if os.path.samefile(source, target):
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def prune_snapshot_files(directory, snapshot=None):
+    """
+    Remove the files of a snapshot directory that snapshot doesn't use, all of them without a
+    snapshot. Called once the checkpoint holding snapshot replaced the one of the older files.
+    """
+    if not os.path.isdir(directory):
+        return
+    keep = {os.path.basename(info[0]) for info in snapshot["spilled"].values()} if snapshot else set()
+    for name in os.listdir(directory):
+        if name not in keep:
+            os.remove(os.path.join(directory, name))
+    if not keep:
+        os.rmdir(directory)
+
+
+def frame_columns(frame):
+    """The TRACK_COLUMNS of a DataFrame as arrays in the buffer dtypes, and the time zone of its timestamps"""
+    columns = {}
+    tz = None
+    for name, dtype in TRACK_COLUMNS.items():
+        if name not in frame:
+            continue
+        values = frame[name]
+        if name == "timestamp":
+            tz = values.dt.tz
+            columns[name] = values.to_numpy(dtype="datetime64[ns]")
+        else:
+            columns[name] = values.to_numpy(dtype=dtype, na_value=MISSING_VALUES.get(name, np.nan))
+    return columns, tz
+
+
+class TrackBuffer:
+    """
+    Open track of one ship as growable NumPy columns.
+
+    Appends copy the rows into preallocated arrays (capacity doubles when full), so adding
+    a chunk costs O(rows appended) instead of re-concatenating the whole buffered DataFrame.
+    Rows are only sorted by timestamp in to_frame, and only if they arrived out of order.
+    """
+    __slots__ = ("size", "columns", "present", "tz", "is_sorted")
+
+    def __init__(self, capacity=64, tz=None):
+        self.size = 0
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in TRACK_COLUMNS.items()}
+        self.present = set()
+        self.tz = tz
+        self.is_sorted = True
+
+    @classmethod
+    def from_frame(cls, frame):
+        buffer = cls(capacity=max(64, 2 * len(frame)))
+        buffer.append(frame)
+        return buffer
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.columns["timestamp"])
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def __getstate__(self):
+        # Only the filled rows are pickled (checkpoints), not the spare capacity
+        columns = {name: column[:self.size].copy() for name, column in self.columns.items()}
+        return self.size, columns, self.present, self.tz, self.is_sorted
+
+    def __setstate__(self, state):
+        self.size, self.columns, self.present, self.tz, self.is_sorted = state
+
+    @classmethod
+    def from_records(cls, records, present=(), tz=None, is_sorted=True):
+        """Buffer holding the rows of a to_records structured array"""
+        buffer = cls(capacity=max(64, 2 * len(records)), tz=tz)
+        for name, column in buffer.columns.items():
+            column[:len(records)] = records[name]
+        buffer.size = len(records)
+        buffer.present = set(present)
+        buffer.is_sorted = is_sorted
+        return buffer
+
+    def to_records(self):
+        """The filled rows as one structured array"""
+        records = np.empty(self.size, dtype=[(name, column.dtype) for name, column in self.columns.items()])
+        for name, column in self.columns.items():
+            records[name] = column[:self.size]
+        return records
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self.capacity)
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def append(self, frame):
+        """Append the rows of a DataFrame with (a subset of) the TRACK_COLUMNS"""
+        columns, tz = frame_columns(frame)
+        self.append_columns(columns, tz)
+
+    def append_columns(self, columns, tz=None):
+        """Append rows given as a dict of arrays already in the buffer dtypes (see frame_columns)"""
+        rows = len(columns["timestamp"])
+        if rows == 0:
+            return
+        if self.size + rows > self.capacity:
+            self._grow(self.size + rows)
+        if self.tz is None:
+            self.tz = tz
+
+        start, end = self.size, self.size + rows
+        for name, column in self.columns.items():
+            if name in columns:
+                column[start:end] = columns[name]
+                self.present.add(name)
+            else:
+                column[start:end] = MISSING_VALUES.get(name, np.nan)
+
+        timestamps = self.columns["timestamp"]
+        if self.is_sorted:
+            new = timestamps[start:end]
+            if (start > 0 and new[0] < timestamps[start - 1]) or np.any(new[1:] < new[:-1]):
+                self.is_sorted = False
+        self.size = end
+
+    def sort(self):
+        """Sort the buffered rows by timestamp (stable, so equal timestamps keep arrival order)"""
+        if self.is_sorted:
+            return
+        order = np.argsort(self.columns["timestamp"][:self.size], kind="stable")
+        for name, column in self.columns.items():
+            column[:self.size] = column[:self.size][order]
+        self.is_sorted = True
+
+    def sorted_column(self, name):
+        """View of one column of the buffered rows sorted by timestamp"""
+        self.sort()
+        return self.columns[name][:self.size]
+
+    def to_frame(self):
+        """Sorted DataFrame of the buffered rows with the columns that were present in the input"""
+        self.sort()
+        data = {}
+        for name, column in self.columns.items():
+            if name not in self.present:
+                continue
+            values = column[:self.size].copy()
+            if name == "timestamp":
+                values = pd.to_datetime(values)
+                if self.tz is not None:
+                    values = values.tz_localize("UTC").tz_convert(self.tz)
+            data[name] = values
+        return pd.DataFrame(data)
+
+
+class TrackStore:
+    """
+    Open TrackBuffers by mmsi, used like a dict.
+
+    With a memory_budget (bytes) enforce_budget spills the least recently used buffers to
+    .npy files in spill_dir until the resident buffers fit, a spilled buffer is read back
+    (memory mapped) the next time its ship is looked up. Without a budget nothing is spilled.
+    """
+    def __init__(self, memory_budget=None, spill_dir=None):
+        self.resident = OrderedDict()
+        self.spilled = {}
+        self.spill_files = 0
+        # In the spill file names, names of other runs never clash in a checkpoint directory
+        self.spill_token = uuid.uuid4().hex[:8]
+        self.spills = 0
+        self.page_ins = 0
+        self.configure(memory_budget, spill_dir)
+
+    def configure(self, memory_budget=None, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.own_spill_dir = False
+
+    def __contains__(self, mmsi):
+        return mmsi in self.resident or mmsi in self.spilled
+
+    def __len__(self):
+        return len(self.resident) + len(self.spilled)
+
+    def __iter__(self):
+        return chain(list(self.resident), list(self.spilled))
+
+    def __getitem__(self, mmsi):
+        buffer = self.resident.get(mmsi)
+        if buffer is None:
+            return self._page_in(mmsi)
+        self.resident.move_to_end(mmsi)
+        return buffer
+
+    def __setitem__(self, mmsi, buffer):
+        if mmsi in self.spilled:
+            self._remove_spilled(mmsi)
+        self.resident[mmsi] = buffer
+        self.resident.move_to_end(mmsi)
+
+    def __delitem__(self, mmsi):
+        if mmsi in self.resident:
+            del self.resident[mmsi]
+        else:
+            self._remove_spilled(mmsi)
+
+    def update(self, buffers):
+        for mmsi, buffer in buffers.items():
+            self[mmsi] = buffer
+
+    def clear(self):
+        for mmsi in list(self.spilled):
+            self._remove_spilled(mmsi)
+        self.resident.clear()
+
+    def resident_bytes(self):
+        return sum(buffer.nbytes for buffer in self.resident.values())
+
+    def enforce_budget(self):
+        """Spill the coldest buffers until the resident ones fit in the memory budget"""
+        if self.memory_budget is None:
+            return
+        used = self.resident_bytes()
+        while used > self.memory_budget and self.resident:
+            mmsi, buffer = self.resident.popitem(last=False)
+            used -= buffer.nbytes
+            self._spill(mmsi, buffer)
+
+    def snapshot(self, directory):
+        """
+        State of all buffers for a checkpoint, without reading the spilled ones back: the resident
+        buffers and the .npy files of the spilled ones, hard linked into directory so they outlive
+        the spill directory and later page ins
+        """
+        spilled = {}
+        if self.spilled:
+            os.makedirs(directory, exist_ok=True)
+        for mmsi, (path, *info) in self.spilled.items():
+            target = os.path.join(directory, os.path.basename(path))
+            link_file(path, target)
+            spilled[mmsi] = (target, *info)
+        return {"resident": dict(self.resident), "spilled": spilled}
+
+    def restore(self, snapshot):
+        """Replace all buffers by a snapshot, its spilled files are linked into the spill directory"""
+        self.clear()
+        self.update(snapshot["resident"])
+        for mmsi, (path, *info) in snapshot["spilled"].items():
+            target = self._spill_path()
+            link_file(path, target)
+            self.spilled[mmsi] = (target, *info)
+
+    def stats(self):
+        return {"resident": len(self.resident), "resident_bytes": self.resident_bytes(), "spilled": len(self.spilled),
+                "spills": self.spills, "page_ins": self.page_ins}
+
+    def close(self):
+        """Drop all buffers and the spill directory if the store created it"""
+        self.clear()
+        if self.own_spill_dir and self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir, self.own_spill_dir = None, False
+
+    def _spill_path(self):
+        if self.spill_dir is None:
+            self.spill_dir, self.own_spill_dir = tempfile.mkdtemp(prefix="clear_ais_spill_"), True
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"{os.getpid()}_{self.spill_token}_{self.spill_files}.npy")
+        self.spill_files += 1
+        return path
+
+    def _spill(self, mmsi, buffer):
+        path = self._spill_path()
+        np.save(path, buffer.to_records())
+        self.spilled[mmsi] = (path, buffer.present, buffer.tz, buffer.is_sorted)
+        self.spills += 1
+
+    def _load(self, mmsi):
+        path, present, tz, is_sorted = self.spilled[mmsi]
+        records = np.load(path, mmap_mode="r")
+        buffer = TrackBuffer.from_records(records, present, tz, is_sorted)
+        del records  # close the memory map before the file is removed
+        return buffer
+
+    def _page_in(self, mmsi):
+        buffer = self._load(mmsi)
+        self._remove_spilled(mmsi)
+        self.resident[mmsi] = buffer
+        self.page_ins += 1
+        return buffer
+
+    def _remove_spilled(self, mmsi):
+        path = self.spilled.pop(mmsi)[0]
+        os.remove(path)
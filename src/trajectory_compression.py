@@ -0,0 +1,130 @@
+"""
+Time aware simplification of trajectory segments before they are written.
+
+Top-down Douglas-Peucker with the synchronized Euclidean distance (SED): a point is compared to
+the position the ship would have had at the same time moving at constant speed along the chord
+between the kept points around it, so dropped points can be recovered by interpolating in time
+within the tolerance. The splitting runs for all intervals of all segments of a batch at once,
+one NumPy pass per level of the recursion.
+"""
+import numpy as np
+
+from segmentation import group_offsets
+from trajectory_segment import TrajectorySegment, POINT_COLUMNS, EARTH_RADIUS
+
+
+def unwrap_longitudes(longitude, offsets):
+    """Longitudes made continuous across the antimeridian within each track"""
+    step = np.zeros(len(longitude))
+    step[1:] = np.diff(longitude)
+    step[offsets[:-1][offsets[:-1] < len(longitude)]] = 0
+    shift = -360.0 * np.round(step / 360.0)
+    shift[np.isnan(shift)] = 0
+    return longitude + np.cumsum(shift)
+
+def sed_distances(times, latitude, longitude, index, first, last):
+    """Synchronized Euclidean distance in metres of the points index to the chords first -> last"""
+    span = (times[last] - times[first]).astype(np.float64)
+    elapsed = (times[index] - times[first]).astype(np.float64)
+    ratio = np.divide(elapsed, span, out=np.zeros_like(elapsed), where=span > 0)
+    expected_lat = latitude[first] + ratio * (latitude[last] - latitude[first])
+    expected_lon = longitude[first] + ratio * (longitude[last] - longitude[first])
+    # Equirectangular approximation, the chords are short compared to the earth radius
+    dy = np.radians(latitude[index] - expected_lat)
+    dx = np.radians(longitude[index] - expected_lon) * np.cos(np.radians((latitude[index] + expected_lat) / 2))
+    distances = EARTH_RADIUS * np.hypot(dx, dy)
+    distances[np.isnan(distances)] = np.inf  # points without a position are kept
+    return distances
+
+def simplify_tracks(timestamps, latitude, longitude, lengths, tolerance, keep=None):
+    """
+    Mask of the points to keep so that no dropped point is more than tolerance metres (SED)
+    away from the time interpolated position between the kept points around it.
+
+    Args:
+        timestamps: datetime64 array of all tracks, each track sorted by time
+        latitude, longitude: float arrays of all tracks
+        lengths: points per track
+        tolerance: error tolerance in metres
+        keep: optional boolean mask of points that must be kept, they split the tracks
+
+    Returns:
+        boolean mask over all points, the first and last point of every track are kept
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = group_offsets(lengths)
+    times = np.asarray(timestamps).astype("datetime64[ns]").view(np.int64)
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = unwrap_longitudes(np.asarray(longitude, dtype=np.float64), offsets)
+
+    keep = np.zeros(len(times), dtype=bool) if keep is None else np.array(keep, dtype=bool)
+    nonempty = lengths > 0
+    keep[offsets[:-1][nonempty]] = True
+    keep[offsets[1:][nonempty] - 1] = True
+
+    # Intervals between consecutive kept points of the same track
+    kept = np.flatnonzero(keep)
+    track = np.searchsorted(offsets, kept, side="right") - 1
+    same_track = track[:-1] == track[1:]
+    first, last = kept[:-1][same_track], kept[1:][same_track]
+
+    while True:
+        inner = last - first > 1
+        first, last = first[inner], last[inner]
+        if len(first) == 0:
+            break
+
+        counts = last - first - 1
+        starts = group_offsets(counts)[:-1]
+        interval = np.repeat(np.arange(len(first)), counts)
+        index = np.arange(counts.sum()) - starts[interval] + first[interval] + 1
+        distances = sed_distances(times, latitude, longitude, index, first[interval], last[interval])
+
+        # Farthest point of every interval, the first one on ties
+        max_distance = np.maximum.reduceat(distances, starts)
+        farthest = np.flatnonzero(distances == max_distance[interval])
+        _, first_farthest = np.unique(interval[farthest], return_index=True)
+        split_at = index[farthest[first_farthest]]
+
+        split = max_distance > tolerance
+        split_at = split_at[split]
+        keep[split_at] = True
+        first, last = np.concatenate([first[split], split_at]), np.concatenate([split_at, last[split]])
+
+    return keep
+
+def compress_segments(segments, tolerance):
+    """
+    Simplified copies of TrajectorySegments, the per point arrays only keep the points selected by
+    simplify_tracks. Points after a time gap (missing_data_info indices) and the points before them
+    are always kept and their indices are renumbered.
+    """
+    if not segments or tolerance is None:
+        return segments
+
+    lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+    offsets = group_offsets(lengths)
+    forced = np.zeros(offsets[-1], dtype=bool)
+    for segment, offset in zip(segments, offsets[:-1]):
+        gaps = np.asarray(segment.missing_data_info.get('indices', []), dtype=np.int64)
+        forced[offset + gaps] = True
+        forced[offset + np.maximum(gaps - 1, 0)] = True
+
+    keep = simplify_tracks(np.concatenate([segment.timestamps for segment in segments]),
+                           np.concatenate([segment.latitude for segment in segments]),
+                           np.concatenate([segment.longitude for segment in segments]),
+                           lengths, tolerance, keep=forced)
+
+    compressed = []
+    for i, segment in enumerate(segments):
+        mask = keep[offsets[i]:offsets[i + 1]]
+        columns = {name: getattr(segment, name)[mask] if getattr(segment, name) is not None else None
+                   for name in POINT_COLUMNS}
+        missing_data_info = segment.missing_data_info
+        if 'indices' in missing_data_info:
+            new_index = np.cumsum(mask) - 1
+            missing_data_info = dict(missing_data_info, indices=new_index[missing_data_info['indices']].tolist())
+        compressed.append(TrajectorySegment(segment.mmsi, segment.route_id, segment.year_month, tz=segment.tz,
+                                            missing_data=segment.missing_data, missing_data_info=missing_data_info,
+                                            compression_tolerance=tolerance, **columns))
+    return compressed
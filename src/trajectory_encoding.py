@@ -0,0 +1,112 @@
+"""
+Compact layout of the monthly tables (ais_data_processor.py --layout compact).
+
+SOG is stored in 0.1 knot and COG and heading in 0.1 degree steps as SMALLINT[], the point times
+as whole seconds since start_dt in an INTEGER[]. The decoders here (and the SQL functions in
+sql/compact_layout.sql) give back the columns of the linestring layout.
+"""
+import numpy as np
+import pandas as pd
+
+# Float array columns of the linestring layout -> SMALLINT[] columns of the compact layout, in tenths
+QUANTIZED_COLUMNS = {
+    "speed_over_ground": "speed_over_ground_q",
+    "course_over_ground": "course_over_ground_q",
+    "heading": "heading_q",
+}
+QUANTIZE_SCALE = 10
+TIME_OFFSETS_COLUMN = "time_offsets"
+
+
+def quantize(values, scale=QUANTIZE_SCALE):
+    """Floats as int16 multiples of 1 / scale, an object array with None for NaN if there are any"""
+    if values is None:
+        return None
+    scaled = np.round(np.asarray(values, dtype=np.float64) * scale)
+    missing = np.isnan(scaled)
+    quantized = np.clip(np.where(missing, 0, scaled), -32768, 32767).astype(np.int16)
+    if missing.any():
+        quantized = quantized.astype(object)
+        quantized[missing] = None
+    return quantized
+
+def dequantize(values, scale=QUANTIZE_SCALE):
+    """Float64 array of a quantized array (or the list the database returns), NULL elements become NaN"""
+    if values is None:
+        return None
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = np.where(pd.isna(values), np.nan, values)
+    return values.astype(np.float64) / scale
+
+def encode_time_offsets(timestamps):
+    """Whole seconds from the first timestamp (start_dt) to each timestamp as int32"""
+    nanoseconds = np.asarray(timestamps).astype("datetime64[ns]").view(np.int64)
+    return np.round((nanoseconds - nanoseconds[0]) / 1e9).astype(np.int32)
+
+def decode_time_offsets(start_dt, offsets, tz):
+    """
+    Point times of a compact row as the naive local times the linestring layout stores. start_dt is
+    naive local time in tz, the session TimeZone of the database (ClearAIS_DB.session_timezone), the
+    offsets are elapsed seconds so they are added in tz (DST aware). tz None adds them to the naive time.
+    """
+    start = pd.Timestamp(start_dt)
+    if tz is not None and start.tz is None:
+        start = start.tz_localize(tz, ambiguous=True, nonexistent="shift_forward")
+    timestamps = start + pd.to_timedelta(np.asarray(offsets, dtype=np.int64), unit="s")
+    return timestamps.tz_convert(tz).tz_localize(None) if tz is not None else timestamps
+
+def decode_compact_row(row, tz):
+    """
+    Dict of a compact layout row (dict or pandas Series) with the timestamps and float arrays of the
+    linestring layout, tz as in decode_time_offsets
+    """
+    decoded = {key: value for key, value in dict(row).items()
+               if key != TIME_OFFSETS_COLUMN and key not in QUANTIZED_COLUMNS.values()}
+    if row.get(TIME_OFFSETS_COLUMN) is not None:
+        decoded["timestamps"] = decode_time_offsets(row["start_dt"], row[TIME_OFFSETS_COLUMN], tz)
+    for name, quantized_name in QUANTIZED_COLUMNS.items():
+        if quantized_name in row:
+            decoded[name] = dequantize(row[quantized_name])
+    return decoded
+
+def split_rows(values, lengths):
+    """Per row arrays of the concatenated values of all rows"""
+    return np.split(values, np.cumsum(lengths)[:-1]) if len(lengths) else []
+
+def array_column(arrays, present, length):
+    """Object array of the per row arrays for the present rows, None for the others"""
+    column = np.full(length, None, dtype=object)
+    # Assigned one by one, numpy would turn arrays of equal length into a 2D block
+    for position, values in zip(np.flatnonzero(present), arrays):
+        column[position] = values
+    return column
+
+def decode_compact_frame(frame, tz):
+    """
+    DataFrame of compact layout rows (e.g. ClearAIS_DB.to_df) decoded like decode_compact_row, for
+    all rows at once: the arrays of the rows are concatenated, decoded and split again
+    """
+    decoded = frame.drop(columns=[TIME_OFFSETS_COLUMN, *QUANTIZED_COLUMNS.values()], errors="ignore")
+    if TIME_OFFSETS_COLUMN in frame:
+        present = (frame[TIME_OFFSETS_COLUMN].notna() & frame["start_dt"].notna()).to_numpy()
+        offsets = frame[TIME_OFFSETS_COLUMN].to_numpy()[present]
+        lengths = np.fromiter((len(value) for value in offsets), dtype=np.int64, count=len(offsets))
+        starts = pd.DatetimeIndex(pd.to_datetime(frame["start_dt"].to_numpy()[present]))
+        if tz is not None and starts.tz is None:
+            starts = starts.tz_localize(tz, ambiguous=np.ones(len(starts), dtype=bool), nonexistent="shift_forward")
+        seconds = np.concatenate(offsets).astype(np.int64) if len(offsets) else np.empty(0, dtype=np.int64)
+        times = pd.DatetimeIndex(np.repeat(starts.as_unit("ns").asi8, lengths) + seconds * 1_000_000_000,
+                                 dtype="datetime64[ns]")
+        if tz is not None:
+            times = times.tz_localize("UTC").tz_convert(tz).tz_localize(None)
+        decoded["timestamps"] = array_column(split_rows(times.to_numpy(), lengths), present, len(frame))
+    for name, quantized_name in QUANTIZED_COLUMNS.items():
+        if quantized_name not in frame:
+            continue
+        present = frame[quantized_name].notna().to_numpy()
+        values = frame[quantized_name].to_numpy()[present]
+        lengths = np.fromiter((len(value) for value in values), dtype=np.int64, count=len(values))
+        flat = dequantize(np.concatenate(values)) if len(values) else np.empty(0)
+        decoded[name] = array_column(split_rows(flat, lengths), present, len(frame))
+    return decoded
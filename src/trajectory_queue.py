@@ -0,0 +1,145 @@
+import queue, threading, time
+import multiprocessing as mp
+
+DEFAULT_QUEUE_SIZE = 1000  # completed segments waiting for a writer
+FLUSH = "flush"  # tells a writer to write its pending batch and wait at the flush barrier
+FLUSH_TIMEOUT = 3600  # seconds a flush may take before the ingest fails
+LIVENESS_INTERVAL = 1.0  # seconds between the writer liveness checks of a blocked put or flush
+
+
+class TrajectoryWriteError(RuntimeError):
+    """A writer failed to write a batch, the segments put before the flush are not all in the database"""
+
+
+class TrajectoryQueue:
+    """
+    Bounded handoff of completed trajectory segments from the reader to the writers.
+
+    put blocks while the queue is full, so a slow database holds the reader back instead of
+    letting the segments pile up in memory, and get blocks while it is empty instead of polling.
+    Every writer stops at its own None sentinel (see close), flush waits until every writer has
+    written what was put before it, and raises TrajectoryWriteError once a writer reported a failed
+    batch (record_failure), so no checkpoint moves past segments that were never written.
+
+    With a multiprocessing context the queue can be shared with writer processes. The stall
+    and depth statistics are kept by the producer side, so are the writer threads or processes
+    (watch): a blocked put or flush raises once one of them is gone instead of waiting forever.
+    """
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, ctx=None, writers=1, flush_timeout=FLUSH_TIMEOUT):
+        self.maxsize = maxsize
+        self.writers = writers
+        self.flush_timeout = flush_timeout
+        self.queue = ctx.Queue(maxsize=maxsize) if ctx is not None else queue.Queue(maxsize=maxsize)
+        self.barrier = (ctx or threading).Barrier(writers + 1)
+        # Batches the writers failed to write, shared with writer processes
+        self.failed_batches = (ctx or mp).Value("i", 0)
+        self.writer_workers = []
+        self.puts = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.max_depth = 0
+
+    def __getstate__(self):
+        # Writer processes get the queue without the handles of the writers
+        state = self.__dict__.copy()
+        state["writer_workers"] = []
+        return state
+
+    def watch(self, writer_workers):
+        """Threads or processes taking items off the queue, checked while a put or flush waits"""
+        self.writer_workers = list(writer_workers)
+
+    def check_writers(self):
+        """Raise if a writer is gone, what it took or would take off the queue is never written"""
+        dead = [worker.name for worker in self.writer_workers if not worker.is_alive()]
+        if dead:
+            raise RuntimeError(f"Trajectory writers stopped unexpectedly: {', '.join(dead)}")
+
+    def _put_blocking(self, item, check):
+        while True:
+            try:
+                self.queue.put(item, timeout=LIVENESS_INTERVAL)
+                return
+            except queue.Full:
+                check()
+
+    def put(self, item):
+        """Hand an item to the writers, waiting for a free slot when the queue is full"""
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start_time = time.perf_counter()
+            self._put_blocking(item, self.check_writers)
+            self.stalls += 1
+            self.stall_time += time.perf_counter() - start_time
+        self.puts += 1
+        self.max_depth = max(self.max_depth, self.depth())
+
+    def get(self):
+        return self.queue.get()
+
+    def close(self):
+        """One sentinel per writer, each writer drains the items before its sentinel and stops"""
+        def check():
+            # Writers leave after their own sentinel, only fail when none is left to drain the queue
+            if self.writer_workers and not any(worker.is_alive() for worker in self.writer_workers):
+                raise RuntimeError("No trajectory writer left to take the stop sentinels")
+        for _ in range(self.writers):
+            self._put_blocking(None, check)
+
+    def flush(self):
+        """
+        Return once every item put so far is written. Each writer takes one FLUSH marker, writes
+        its pending batch and blocks at the barrier, so no writer can take a second marker.
+        Raises when a writer is gone or the writers take longer than flush_timeout, the barrier
+        is then broken so the waiting writers don't hang either, and TrajectoryWriteError when
+        a batch failed to write.
+        """
+        for _ in range(self.writers):
+            self.put(FLUSH)
+        deadline = time.monotonic() + self.flush_timeout
+        try:
+            # A dead writer never arrives at the barrier, wait for the others while checking on it
+            while self.barrier.n_waiting < self.writers:
+                self.check_writers()
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Trajectory writers didn't flush within {self.flush_timeout} s")
+                time.sleep(min(0.05, LIVENESS_INTERVAL))
+            self.barrier.wait(timeout=max(deadline - time.monotonic(), LIVENESS_INTERVAL))
+        except Exception:
+            self.barrier.abort()
+            raise
+        # A lost batch holds every later flush back too, the rows behind it have to be read again
+        if self.failures():
+            raise TrajectoryWriteError(f"{self.failures()} trajectory batches failed to write")
+
+    def record_failure(self):
+        """Called by a writer that dropped a batch it failed to write"""
+        with self.failed_batches.get_lock():
+            self.failed_batches.value += 1
+
+    def failures(self):
+        return self.failed_batches.value
+
+    def flushed(self):
+        """Called by a writer after it has written its batch for a FLUSH marker"""
+        self.barrier.wait(timeout=self.flush_timeout)
+
+    def depth(self):
+        """Items waiting for a writer, -1 where the platform can't tell (multiprocessing on macOS)"""
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "maxsize": self.maxsize,
+            "puts": self.puts,
+            "stalls": self.stalls,
+            "stall_time": round(self.stall_time, 3),
+            "failed_batches": self.failures(),
+        }
+
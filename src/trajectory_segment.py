@@ -0,0 +1,232 @@
+import json, struct
+import numpy as np
+import pandas as pd
+import shapely
+
+from segmentation import group_offsets
+from trajectory_encoding import QUANTIZED_COLUMNS, TIME_OFFSETS_COLUMN, quantize, encode_time_offsets
+
+# Per point columns of a segment, timestamps are datetime64[ns] in UTC
+POINT_COLUMNS = ("timestamps", "latitude", "longitude", "speed_over_ground", "navigational_status",
+                 "course_over_ground", "heading")
+# Columns stored as arrays in the monthly tables, None where the csv didn't have them
+ARRAY_COLUMNS = ("speed_over_ground", "navigational_status", "course_over_ground", "heading")
+# EWKB type of a LINESTRING with M and SRID flags
+EWKB_LINESTRINGM = 2 | 0x40000000 | 0x20000000
+EARTH_RADIUS = 6371008.8  # mean earth radius in metres
+# Scalar columns summarizing each trajectory, indexed for the filters in sql/get_trajectories_bbox_sog_filter.sql
+SUMMARY_COLUMNS = ("sog_min", "sog_max", "sog_mean", "dominant_nav_status", "path_length_m", "ship_type")
+
+
+class TrajectorySegment:
+    """
+    Completed trajectory segment as contiguous NumPy arrays, queued from split_trajectories to the writers.
+
+    Compared to a DataFrame it has no index, block manager or object columns to carry through the
+    queue, and the geometries of many segments are encoded in one go by segment_rows.
+    """
+    __slots__ = ("mmsi", "route_id", "year_month", "missing_data", "missing_data_info", "tz",
+                 "compression_tolerance") + POINT_COLUMNS
+
+    def __init__(self, mmsi, route_id, year_month, timestamps, latitude, longitude, speed_over_ground=None,
+                 navigational_status=None, course_over_ground=None, heading=None, tz=None,
+                 missing_data=False, missing_data_info=None, compression_tolerance=None):
+        self.mmsi = mmsi
+        self.route_id = route_id
+        self.year_month = year_month
+        self.timestamps = timestamps
+        self.latitude = latitude
+        self.longitude = longitude
+        self.speed_over_ground = speed_over_ground
+        self.navigational_status = navigational_status
+        self.course_over_ground = course_over_ground
+        self.heading = heading
+        self.tz = tz
+        self.missing_data = missing_data
+        self.missing_data_info = missing_data_info or {}
+        self.compression_tolerance = compression_tolerance  # metres, None when every fix is kept
+
+    @classmethod
+    def from_buffer(cls, mmsi, buffer, route_id, year_month, missing_data=False, missing_data_info=None):
+        """Segment with copies of the time sorted rows of a TrackBuffer"""
+        def column(name):
+            return buffer.sorted_column(name).copy() if name in buffer.present else None
+
+        return cls(mmsi, route_id, year_month, column("timestamp"), column("latitude"), column("longitude"),
+                   column("speed_over_ground"), column("navigational_status"), column("course_over_ground"),
+                   column("heading"), tz=buffer.tz, missing_data=missing_data, missing_data_info=missing_data_info)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in POINT_COLUMNS if getattr(self, name) is not None)
+
+    def local_timestamps(self):
+        """Timestamps as a DatetimeIndex in the time zone of the input"""
+        timestamps = pd.DatetimeIndex(self.timestamps)
+        return timestamps.tz_localize("UTC").tz_convert(self.tz) if self.tz is not None else timestamps
+
+
+def hex_ewkb(geometries, srid=4326):
+    """Hex EWKB strings of an array of geometries (binary WKB + bytes.hex is faster than the GEOS hex writer)"""
+    return [wkb.hex() for wkb in shapely.to_wkb(shapely.set_srid(geometries, srid), include_srid=True)]
+
+def hex_ewkb_measured(longitude, latitude, measure, offsets, srid=4326):
+    """
+    Hex EWKB LINESTRINGMs of consecutive groups of points (offsets as from group_offsets), written
+    directly as little endian headers and coordinate bytes, shapely can't construct M geometries
+    """
+    coordinates = np.column_stack([longitude, latitude, measure]).astype("<f8")
+    return [(struct.pack("<BIII", 1, EWKB_LINESTRINGM, srid, end - start) + coordinates[start:end].tobytes()).hex()
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+def local_timestamps(segments):
+    """DatetimeIndex of the timestamps of all segments, converted to their time zone in one go when they share it"""
+    tz = segments[0].tz
+    if any(segment.tz != tz for segment in segments):
+        return pd.DatetimeIndex(np.concatenate([segment.local_timestamps() for segment in segments]))
+    timestamps = pd.DatetimeIndex(np.concatenate([segment.timestamps for segment in segments]))
+    return timestamps.tz_localize("UTC").tz_convert(tz) if tz is not None else timestamps
+
+def start_months(segments, tz):
+    """YYYY_MM of the first point of every segment in time zone tz, the partition its start_dt falls in"""
+    starts = pd.DatetimeIndex(np.array([segment.timestamps[0] for segment in segments], dtype="datetime64[ns]"))
+    return starts.tz_localize("UTC").tz_convert(tz).strftime("%Y_%m").tolist()
+
+def path_lengths(latitude, longitude, offsets):
+    """Great circle (haversine) length in metres of every group of points, NaN positions count as 0"""
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    step = np.zeros(len(lat))
+    step[1:] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(
+        np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2))
+    step[offsets[:-1]] = 0
+    return np.add.reduceat(np.nan_to_num(step), offsets[:-1])
+
+def dominant_values(values, groups, num_groups):
+    """Most frequent non NaN value of every group (the lowest one on ties), NaN for groups without any"""
+    valid = ~np.isnan(values)
+    dominant = np.full(num_groups, np.nan)
+    if valid.any():
+        # Group and value rank in one int64 key, a 1-D unique instead of unique rows of (group, value)
+        uniques, ranks = np.unique(values[valid], return_inverse=True)
+        keys, counts = np.unique(groups[valid].astype(np.int64) * len(uniques) + ranks, return_counts=True)
+        key_groups = keys // len(uniques)
+        # Keys are sorted by value within a group, the stable sort keeps the lowest value first on ties
+        order = np.lexsort((-counts, key_groups))
+        first = order[np.r_[True, key_groups[order][1:] != key_groups[order][:-1]]]
+        dominant[key_groups[first]] = uniques[keys[first] % len(uniques)]
+    return dominant
+
+def segment_summaries(segments, ship_types=None):
+    """
+    Values of the SUMMARY_COLUMNS for every segment, computed for all segments at once: SOG min, max
+    and mean (NaN ignored), the most frequent navigational status, the path length in metres and the
+    ship type (type_of_ship_and_cargo) from ship_types, a dict of mmsi -> type. None where unknown.
+    Computed before compress_segments, so they describe all the fixes.
+    """
+    if not segments:
+        return []
+
+    lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+    offsets = group_offsets(lengths)
+    groups = np.repeat(np.arange(len(segments)), lengths)
+
+    def column(name):
+        return np.concatenate([getattr(segment, name).astype(np.float64) if getattr(segment, name) is not None
+                               else np.full(len(segment), np.nan) for segment in segments])
+
+    sog = column("speed_over_ground")
+    valid = ~np.isnan(sog)
+    counts = np.add.reduceat(valid, offsets[:-1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sog_mean = np.add.reduceat(np.where(valid, sog, 0), offsets[:-1]) / counts
+    sog_min = np.fmin.reduceat(sog, offsets[:-1])
+    sog_max = np.fmax.reduceat(sog, offsets[:-1])
+    nav_status = dominant_values(column("navigational_status"), groups, len(segments))
+    lengths_m = path_lengths(np.concatenate([segment.latitude for segment in segments]),
+                             np.concatenate([segment.longitude for segment in segments]), offsets)
+
+    def scalar(value, cast=float):
+        return None if np.isnan(value) else cast(value)
+
+    ship_types = ship_types or {}
+    return [{
+        "sog_min": scalar(sog_min[i]),
+        "sog_max": scalar(sog_max[i]),
+        "sog_mean": scalar(sog_mean[i]),
+        "dominant_nav_status": scalar(nav_status[i], int),
+        "path_length_m": float(lengths_m[i]),
+        "ship_type": ship_types.get(segment.mmsi),
+    } for i, segment in enumerate(segments)]
+
+def segment_rows(segments, srid=4326, layout="linestring", summaries=None):
+    """
+    Rows for the monthly tables from a list of segments. Coordinates, origin and destination are
+    hex EWKB strings, built for all segments with one call each of the shapely 2 array functions,
+    the per point columns stay NumPy arrays.
+
+    With the measured layout coordinates is a LINESTRINGM with the UTC epoch seconds of every point
+    as M and there is no timestamps column. With the compact layout the times are seconds since
+    start_dt and SOG, COG and heading are quantized to tenths (see trajectory_encoding).
+
+    summaries are the segment_summaries of the segments, computed here (without ship type) if not given.
+    """
+    if not segments:
+        return []
+
+    lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+    offsets = group_offsets(lengths)
+    first, last = offsets[:-1], offsets[1:] - 1
+    longitude = np.concatenate([segment.longitude for segment in segments])
+    latitude = np.concatenate([segment.latitude for segment in segments])
+
+    if layout == "measured":
+        epoch_seconds = np.concatenate([segment.timestamps for segment in segments]).astype("datetime64[ns]").view(np.int64) / 1e9
+        coordinates = hex_ewkb_measured(longitude, latitude, epoch_seconds, offsets, srid)
+    else:
+        lines = shapely.linestrings(np.column_stack([longitude, latitude]), indices=np.repeat(np.arange(len(segments)), lengths))
+        coordinates = hex_ewkb(lines, srid)
+    origins = hex_ewkb(shapely.points(longitude[first], latitude[first]), srid)
+    destinations = hex_ewkb(shapely.points(longitude[last], latitude[last]), srid)
+
+    timestamps = local_timestamps(segments)
+    start_dts, end_dts = timestamps[first], timestamps[last]
+    durations = end_dts - start_dts
+
+    if summaries is None:
+        summaries = segment_summaries(segments)
+
+    rows = []
+    for i, segment in enumerate(segments):
+        row = {
+            "mmsi": segment.mmsi,
+            "route_id": segment.route_id,
+            "start_dt": start_dts[i],
+            "end_dt": end_dts[i],
+            "origin": origins[i],
+            "destination": destinations[i],
+            "count": int(lengths[i]),
+            "duration": durations[i],
+            "missing_data": segment.missing_data,
+            "missing_data_info": json.dumps(segment.missing_data_info),
+            "coordinates": coordinates[i],
+            "compression_tolerance": segment.compression_tolerance,
+            **summaries[i],
+        }
+        if layout == "compact":
+            row[TIME_OFFSETS_COLUMN] = encode_time_offsets(segment.timestamps)
+            for name in ARRAY_COLUMNS:
+                values = getattr(segment, name)
+                if name in QUANTIZED_COLUMNS:
+                    row[QUANTIZED_COLUMNS[name]] = quantize(values)
+                else:
+                    row[name] = values.astype(np.int16) if values is not None else None
+        else:
+            if layout == "linestring":
+                row["timestamps"] = timestamps[offsets[i]:offsets[i + 1]]
+            for name in ARRAY_COLUMNS:
+                row[name] = getattr(segment, name)
+        rows.append(row)
+    return rows
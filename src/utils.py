@@ -1,4 +1,4 @@
-import os, functools, time
+import os, functools, time, threading
 
 def find_files_in_folder(folder, extension):
     if os.path.exists(folder):
@@ -56,3 +56,39 @@ def try_except(logger=None):
                 return False
         return wrapper
     return decorator_try_except
+
+
+class FilePrefetcher:
+    """
+    Read the next file in a background thread while the current one is processed,
+    so it is in the page cache (also for NAS mounts) when the csv reader gets to it.
+    """
+    def __init__(self, block_size=8 * 1024 * 1024):
+        self.block_size = block_size
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                while not self.stop_event.is_set() and f.read(self.block_size):
+                    pass
+        except OSError:
+            pass
+
+    def prefetch(self, path):
+        """Start reading path, a prefetch that is still running is stopped first"""
+        self.stop()
+        if path is None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._read, args=(path,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
@@ -2,12 +2,14 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
+import shapely
 from shapely.geometry import Point
 
 # Constants
 SAMPLE_SIZE = 1000  # Number of AIS records
 TIME_INTERVAL = 1  # Minutes between records
 SPEED_THRESHOLD = 0.1  # Speed threshold to consider the ship as moving
+MOVING_STATUSES = ['Underway Using Engine', 'Sailing']
 LONG_SEGMENT_PROBABILITY = 0.8  # Probability of continuing the same status
 
 # Generate random AIS data with longer continuous segments
@@ -75,6 +77,66 @@ def identify_voyages(df):
     
     return voyages
 
+# Vectorised version of identify_voyages for many ships at once, identify_voyages is kept as the reference
+def identify_voyages_vectorized(df, ship_column='ship_id'):
+    """
+    Same start and end rules as identify_voyages, evaluated on whole arrays.
+
+    A voyage starts on a row where the nav status switches to moving or the speed rises above
+    SPEED_THRESHOLD, and ends on the first row (possibly the same one) where the nav status is not
+    moving or the speed is at most SPEED_THRESHOLD. Rows are processed in order per ship; each ship
+    starts like identify_voyages does (no previous status, previous speed 0). Voyages still open at
+    the last row of a ship are dropped.
+
+    Returns a DataFrame with ship_column, start_dt, end_dt, origin and destination (shapely Points).
+    """
+    n = len(df)
+    columns = [ship_column, 'start_dt', 'end_dt', 'origin', 'destination']
+    if n == 0:
+        return pd.DataFrame(columns=columns)
+
+    ships = df[ship_column].to_numpy() if ship_column in df else np.zeros(n, dtype=np.int64)
+    moving = df['nav_status'].isin(MOVING_STATUSES).to_numpy()
+    speed = df['speed'].to_numpy(dtype=np.float64)
+    fast = speed > SPEED_THRESHOLD
+    slow = speed <= SPEED_THRESHOLD
+
+    # Previous row values, reset at the first row of every ship
+    first_row = np.ones(n, dtype=bool)
+    first_row[1:] = ships[1:] != ships[:-1]
+    prev_moving = np.concatenate([[False], moving[:-1]]) & ~first_row
+    prev_slow = np.concatenate([[True], slow[:-1]]) | first_row
+
+    starts = (moving & ~prev_moving) | (fast & prev_slow)
+    ends = ~moving | slow
+
+    # Rows that don't end a voyage form runs; the voyage is open during a run if its first row starts one
+    run_start = ~ends & (first_row | np.concatenate([[True], ends[:-1]]))
+    run_id = np.cumsum(run_start) - 1
+    run_first_row = np.flatnonzero(run_start)
+    open_after = np.zeros(n, dtype=bool)
+    in_run = ~ends
+    open_after[in_run] = starts[run_first_row[run_id[in_run]]]
+
+    # A voyage ends on an ending row if it was open after the previous row of the same ship,
+    # or if the voyage starts and ends on the same row
+    open_before = np.concatenate([[False], open_after[:-1]]) & ~first_row
+    end_rows = np.flatnonzero(ends & (open_before | starts))
+    start_rows = end_rows.copy()
+    continued = open_before[end_rows]
+    start_rows[continued] = run_first_row[run_id[end_rows[continued] - 1]]
+
+    timestamps = df['timestamp'].to_numpy()
+    lon = df['lon'].to_numpy(dtype=np.float64)
+    lat = df['lat'].to_numpy(dtype=np.float64)
+    return pd.DataFrame({
+        ship_column: ships[end_rows],
+        'start_dt': timestamps[start_rows],
+        'end_dt': timestamps[end_rows],
+        'origin': shapely.points(lon[start_rows], lat[start_rows]),
+        'destination': shapely.points(lon[end_rows], lat[end_rows]),
+    }, columns=columns)
+
 # Main function
 def main():
     # Generate sample AIS data with longer continuous segments
@@ -0,0 +1,6 @@
+import os, sys
+
+# The modules in src import each other by name and read their config relative to the repo root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.chdir(ROOT)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ais_timestamps import parse_ais_timestamps, parse_unix_timestamps
+
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+SWEDISH_MONTHS = {5: "maj", 10: "okt"}
+
+
+def reference_timestamps(values):
+    """The regex and pd.to_datetime parsing parse_ais_timestamps replaced"""
+    ts = pd.Series(values).str.replace(r'\.\d{1,6}|\s+[A-Za-z]+$', '', regex=True)
+    month_map = {
+        r'\bmaj\b': 'May', r'\bokt\b': 'Oct',
+        r'\bMaj\b': 'May', r'\bOkt\b': 'Oct'
+    }
+    ts = ts.replace(month_map, regex=True)
+    return pd.to_datetime(ts, format='%d %b %Y %H:%M:%S').dt.tz_localize(
+        'Europe/Berlin', ambiguous=False, nonexistent='shift_forward')
+
+
+def random_seconds(rng, rows):
+    """UNIX seconds around the DST switches of 2018 to 2024 and at random"""
+    switches = pd.to_datetime([f"{year}-{month}-{day} 01:00:00" for year in range(2018, 2025)
+                               for month, day in ((3, 25), (3, 31), (10, 28), (10, 29))]).as_unit("s").asi8
+    near_switch = rng.choice(switches, rows) + rng.integers(-3 * 3600, 3 * 3600, rows)
+    anywhere = rng.integers(pd.Timestamp("2018-01-01").value // 10**9, pd.Timestamp("2025-01-01").value // 10**9, rows)
+    return np.where(rng.random(rows) < 0.5, near_switch, anywhere)
+
+
+def base_station_strings(rng, seconds):
+    """'01 jan 2018 00:00:00.000 UTC' strings with Swedish and capitalized months, optional fractions and zone"""
+    times = pd.to_datetime(seconds, unit="s")
+    strings = []
+    for time in times:
+        month = SWEDISH_MONTHS[time.month] if time.month in SWEDISH_MONTHS and rng.random() < 0.5 else MONTHS[time.month - 1]
+        month = month.capitalize() if rng.random() < 0.3 else month
+        day = f"{time.day}" if rng.random() < 0.05 else f"{time.day:02d}"
+        fraction = rng.choice(["", ".0", ".123", ".123456"])
+        zone = rng.choice(["", " UTC"])
+        strings.append(f"{day} {month} {time.year} {time:%H:%M:%S}{fraction}{zone}")
+    return strings
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_times_as_regex_parsing(seed):
+    rng = np.random.default_rng(seed)
+    seconds = random_seconds(rng, 2000)
+    # Repeated strings go through the unique value cache
+    values = pd.Series(base_station_strings(rng, seconds) * 2)
+    pd.testing.assert_series_equal(parse_ais_timestamps(values), reference_timestamps(values),
+                                   check_names=False, check_dtype=False)
+
+
+def test_unix_column_gives_the_text_column_times():
+    rng = np.random.default_rng(0)
+    seconds = pd.Series(random_seconds(rng, 2000))
+    strings = pd.to_datetime(seconds, unit="s").dt.strftime("%d %b %Y %H:%M:%S.000 UTC")
+    pd.testing.assert_series_equal(parse_unix_timestamps(seconds), parse_ais_timestamps(strings), check_names=False)
+
+
+def test_invalid_dates_are_rejected():
+    with pytest.raises(ValueError):
+        parse_ais_timestamps(pd.Series(["31 feb 2018 00:00:00.000 UTC"]))
@@ -0,0 +1,163 @@
+import struct
+
+import numpy as np
+import pytest
+import shapely
+
+import binary_copy
+from binary_copy import parse_binary_copy, PGCOPY_SIGNATURE, POSTGRES_EPOCH_US, EWKB_M, EWKB_SRID, EWKB_LINESTRING
+
+GEOMETRY_OID = 99999
+NAMES = ["id", "mmsi", "sog", "ts", "q", "line", "pt", "dur", "f"]
+TYPE_OIDS = [23, 1043, 1022, 1115, 1005, GEOMETRY_OID, GEOMETRY_OID, 1186, 701]
+
+
+def field(value):
+    """A field of a tuple, None is NULL"""
+    return struct.pack(">i", -1) if value is None else struct.pack(">i", len(value)) + value
+
+
+def array(values, element_oid, fmt):
+    """One dimensional array in the binary format, None elements are NULL"""
+    if values is None:
+        return None
+    if len(values) == 0:
+        return struct.pack(">iii", 0, 0, element_oid)
+    encoded = struct.pack(">iiiii", 1, int(any(value is None for value in values)), element_oid, len(values), 1)
+    for value in values:
+        encoded += struct.pack(">i", -1) if value is None else struct.pack(">i", struct.calcsize(fmt)) + struct.pack(fmt, value)
+    return encoded
+
+
+def copy_stream(tuples):
+    """Binary COPY stream of tuples of encoded fields"""
+    data = bytearray(PGCOPY_SIGNATURE + struct.pack(">iI", 0, 0))
+    for fields in tuples:
+        data += struct.pack(">h", len(fields))
+        for value in fields:
+            data += field(value)
+    data += struct.pack(">h", -1)
+    return bytes(data)
+
+
+def random_rows(rng, count=300):
+    rows = []
+    for i in range(count):
+        n = int(rng.integers(0, 30))
+        sog = list(rng.uniform(0, 20, n))
+        if i % 17 == 0 and n:
+            sog[0] = None
+        q = [int(value) for value in rng.integers(-300, 300, n)]
+        if i % 5 == 0 and n:
+            q[-1] = None
+        line = shapely.set_srid(shapely.LineString(rng.uniform(0, 10, (max(n, 2), 2))), 4326)
+        rows.append({
+            "id": i,
+            "mmsi": None if i % 29 == 0 else f"2190{i}",
+            "sog": None if i % 31 == 0 else sog,
+            "ts": [int(value) for value in rng.integers(0, 10**15, n)],
+            "q": q,
+            "line": shapely.to_wkb(line, include_srid=True) if i % 13 else None,
+            "pt": shapely.to_wkb(shapely.set_srid(shapely.Point(i, -i), 4326), include_srid=True),
+            "dur": (i * 1000, i % 3, i % 2),
+            "f": float(i) / 3 if i % 7 else None,
+        })
+    return rows
+
+
+def encode_rows(rows):
+    return copy_stream([(
+        struct.pack(">i", row["id"]),
+        row["mmsi"].encode() if row["mmsi"] else None,
+        array(row["sog"], 701, ">d"),
+        array(row["ts"], 1114, ">q"),
+        array(row["q"], 21, ">h"),
+        row["line"],
+        row["pt"],
+        struct.pack(">qii", *row["dur"]),
+        None if row["f"] is None else struct.pack(">d", row["f"]),
+    ) for row in rows])
+
+
+def with_nan(values):
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def test_hand_encoded_stream():
+    rows = random_rows(np.random.default_rng(0))
+    columns = parse_binary_copy(memoryview(encode_rows(rows)), NAMES, TYPE_OIDS, GEOMETRY_OID)
+    for i, row in enumerate(rows):
+        assert columns["id"][i] == row["id"]
+        assert columns["mmsi"][i] == row["mmsi"]
+        if row["sog"] is None:
+            assert columns["sog"][i] is None
+        else:
+            np.testing.assert_array_equal(columns["sog"][i], with_nan(row["sog"]))
+        np.testing.assert_array_equal(columns["ts"][i].astype(np.int64), np.array(row["ts"], dtype=np.int64) + POSTGRES_EPOCH_US)
+        np.testing.assert_array_equal(columns["q"][i], with_nan(row["q"]))
+        if row["line"] is None:
+            assert columns["line"][i] is None
+        else:
+            np.testing.assert_array_equal(columns["line"][i], shapely.get_coordinates(shapely.from_wkb(row["line"])))
+        assert tuple(columns["pt"][i]) == (i, -i)
+        microseconds, days, months = row["dur"]
+        assert columns["dur"][i].astype(np.int64) == microseconds + (days + 30 * months) * 86400 * 10**6
+        if row["f"] is None:
+            assert np.isnan(columns["f"][i])
+        else:
+            assert columns["f"][i] == row["f"]
+
+
+def test_null_elements_and_null_rows():
+    data = copy_stream([
+        (array([1, 2, 3], 21, ">h"), array([1.5, 2.5], 701, ">d"), struct.pack(">i", 7)),
+        (array([], 21, ">h"), None, None),
+        (array([None, 4], 21, ">h"), array([None], 701, ">d"), struct.pack(">i", 8)),
+    ])
+    columns = parse_binary_copy(memoryview(data), ["q", "sog", "id"], [1005, 1022, 23])
+    # A column with NULL elements becomes float with NaN, so do integer columns with NULL rows
+    assert columns["q"].values.dtype == np.float64
+    np.testing.assert_array_equal(columns["q"][0], [1, 2, 3])
+    assert len(columns["q"][1]) == 0
+    np.testing.assert_array_equal(columns["q"][2], [np.nan, 4])
+    assert columns["sog"][1] is None
+    np.testing.assert_array_equal(columns["sog"][2], [np.nan])
+    np.testing.assert_array_equal(columns["id"], [7, np.nan, 8])
+
+    arrow = columns["sog"].to_arrow()
+    assert arrow.null_count == 1
+    assert arrow.to_pylist()[0] == [1.5, 2.5]
+
+
+def test_arrays_without_nulls_keep_their_type():
+    data = copy_stream([(array([1, 2], 23, ">i"), struct.pack(">q", 5))])
+    columns = parse_binary_copy(memoryview(data), ["n", "big"], [1007, 20])
+    assert columns["n"].values.dtype == np.dtype("int32")
+    assert columns["big"].dtype == np.dtype("int64")
+
+
+def test_linestring_m():
+    points = [(11.7, 57.5, 1.6e9), (11.8, 57.6, 1.6e9 + 60), (11.9, 57.7, 1.6e9 + 120)]
+    ewkb = struct.pack("<BII", 1, EWKB_LINESTRING | EWKB_M | EWKB_SRID, 4326) + struct.pack("<I", len(points))
+    ewkb += b"".join(struct.pack("<ddd", *point) for point in points)
+    columns = parse_binary_copy(memoryview(copy_stream([(ewkb,), (None,)])), ["line"], [GEOMETRY_OID], GEOMETRY_OID)
+    np.testing.assert_array_equal(columns["line"][0], points)
+    assert columns["line"][1] is None
+
+
+def test_invalid_streams():
+    with pytest.raises(ValueError, match="Not a binary COPY stream"):
+        parse_binary_copy(memoryview(b"PGCOPY\n\xff\r\n\x01" + bytes(8)), ["id"], [23])
+    with pytest.raises(ValueError, match="expected 2"):
+        parse_binary_copy(memoryview(copy_stream([(struct.pack(">i", 1),)])), ["id", "mmsi"], [23, 1043])
+    two_dimensional = struct.pack(">iiiiiii", 2, 0, 23, 1, 1, 1, 1) + struct.pack(">ii", 4, 1)
+    with pytest.raises(ValueError, match="one dimensional"):
+        parse_binary_copy(memoryview(copy_stream([(two_dimensional,)])), ["a"], [1007])
+    with pytest.raises(ValueError, match="without a binary decoder"):
+        parse_binary_copy(memoryview(copy_stream([(b"{}",)])), ["j"], [3802])
+
+
+def test_gather_unaligned_positions():
+    data = bytes(3) + np.arange(10, dtype=">f8").tobytes()
+    positions = 3 + 8 * np.array([9, 0, 4])
+    np.testing.assert_array_equal(binary_copy.gather(data, positions, ">f8"), [9, 0, 4])
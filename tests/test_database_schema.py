@@ -0,0 +1,105 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from psycopg2.extensions import adapt
+from sqlalchemy import create_engine
+
+from database_schema import (ClearAIS_DB, TRAJECTORY_LAYOUTS, TrajectoryStore, copy_array, monthly_metadata, monthly_trajectories_table,
+                             null_missing_elements, partitioned_trajectories_table, rows_max_duration, trajectory_columns)
+
+SHARED_COLUMNS = {"mmsi", "route_id", "start_dt", "end_dt", "origin", "destination", "count", "duration",
+                  "missing_data", "missing_data_info", "coordinates", "compression_tolerance", "sog_min",
+                  "sog_max", "sog_mean", "dominant_nav_status", "path_length_m", "ship_type"}
+LAYOUT_COLUMNS = {
+    "linestring": {"timestamps", "speed_over_ground", "navigational_status", "course_over_ground", "heading"},
+    "measured": {"speed_over_ground", "navigational_status", "course_over_ground", "heading"},
+    "compact": {"time_offsets", "speed_over_ground_q", "navigational_status", "course_over_ground_q", "heading_q"},
+}
+
+
+@pytest.fixture
+def clean_metadata():
+    yield
+    monthly_metadata.clear()
+
+
+@pytest.mark.parametrize("layout", TRAJECTORY_LAYOUTS)
+def test_columns_of_each_layout(layout, clean_metadata):
+    assert {column.name for column in trajectory_columns("trajectories_2023_01", layout)} == SHARED_COLUMNS | LAYOUT_COLUMNS[layout]
+    month = monthly_trajectories_table("2023_01", layout=layout)
+    assert set(month.columns.keys()) == {"id"} | SHARED_COLUMNS | LAYOUT_COLUMNS[layout]
+    parent = partitioned_trajectories_table(layout=layout)
+    assert set(parent.columns.keys()) == {"id"} | SHARED_COLUMNS | LAYOUT_COLUMNS[layout]
+
+
+@pytest.mark.parametrize("layout", TRAJECTORY_LAYOUTS)
+def test_save_schema_leaves_the_parent_layout(layout, tmp_path, clean_metadata):
+    db = ClearAIS_DB.__new__(ClearAIS_DB)
+    db.engine = create_engine("postgresql+psycopg2://")
+    db.save_schema(file_path=str(tmp_path / "schema.sql"))
+    assert "PARTITION BY RANGE (start_dt)" in (tmp_path / "schema.sql").read_text()
+    parent = partitioned_trajectories_table(layout=layout)
+    assert set(parent.columns.keys()) == {"id"} | SHARED_COLUMNS | LAYOUT_COLUMNS[layout]
+
+
+class MonthlyTables(ClearAIS_DB):
+    """ClearAIS_DB stand-in with the catalog and the table_versions durations TrajectoryStore.tables reads"""
+    def __init__(self, durations, partitioned):
+        self.durations = durations
+        self.partitioned = partitioned
+
+    def monthly_tables(self):
+        return sorted(self.durations)
+
+    def table_max_durations(self, table_names):
+        return {table_name: pd.Timedelta(self.durations[table_name]) for table_name in table_names}
+
+    def partitioning(self):
+        return {"mmsi_partitions": 0} if self.partitioned else None
+
+
+@pytest.mark.parametrize("partitioned", [True, False])
+def test_tables_are_widened_by_their_longest_trajectory(partitioned):
+    durations = {f"trajectories_2023_{month:02d}": "1 day" for month in range(1, 13)}
+    # A ship reporting every few weeks, a trajectory of 70 days
+    durations["trajectories_2023_01" if partitioned else "trajectories_2023_06"] = "70 days"
+    store = TrajectoryStore(MonthlyTables(durations, partitioned))
+    tables = store.tables(datetime.datetime(2023, 3, 20), datetime.datetime(2023, 3, 25))
+    if partitioned:
+        assert tables == ["trajectories_2023_01", "trajectories_2023_03"]
+    else:
+        assert tables == ["trajectories_2023_03", "trajectories_2023_06"]
+
+
+def test_fixed_max_duration():
+    durations = {f"trajectories_2023_{month:02d}": "70 days" for month in range(1, 13)}
+    store = TrajectoryStore(MonthlyTables(durations, True), max_duration=pd.Timedelta(days=1))
+    assert store.tables(datetime.datetime(2023, 3, 1, 12), datetime.datetime(2023, 3, 25)) == ["trajectories_2023_02", "trajectories_2023_03"]
+
+
+def test_rows_max_duration():
+    rows = [{"start_dt": pd.Timestamp("2023-01-01"), "end_dt": pd.Timestamp("2023-01-03")},
+            {"start_dt": pd.Timestamp("2023-01-01"), "end_dt": pd.Timestamp("2023-03-01")},
+            {"start_dt": None, "end_dt": pd.Timestamp("2023-01-02")}]
+    assert rows_max_duration(rows) == datetime.timedelta(days=59)
+    assert rows_max_duration([{"mmsi": "1"}]) is None
+
+
+def test_both_writers_store_nan_elements_as_null(clean_metadata):
+    row = {"mmsi": "219000001", "speed_over_ground": np.array([1.5, np.nan, 3.0]),
+           "navigational_status": np.array([0, 5], dtype=np.int16), "heading": np.array([90.0, 91.0])}
+    bound = null_missing_elements(row)
+    assert bound["heading"] is row["heading"] and bound["navigational_status"] is row["navigational_status"]
+    assert np.isnan(row["speed_over_ground"][1])
+
+    # bulk_insert: the values psycopg2 sends through the ARRAY bind processor of the monthly table
+    dialect = create_engine("postgresql+psycopg2://").dialect
+    column = monthly_trajectories_table("2023_01").columns["speed_over_ground"]
+    processor = column.type.dialect_impl(dialect).bind_processor(dialect)
+    bound_values = processor(bound["speed_over_ground"]) if processor else list(bound["speed_over_ground"])
+    assert adapt(bound_values).getquoted() == b"ARRAY[1.5,NULL,3.0]"
+    # copy_insert: the array literal of the COPY csv
+    assert copy_array(row["speed_over_ground"]) == "{1.5,NULL,3.0}"
+    assert null_missing_elements({"heading": np.array([90.0])})["heading"].dtype == np.float64
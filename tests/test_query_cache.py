@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+import shapely
+
+from query_cache import QueryCache
+
+
+def trajectory_table(rows):
+    """Arrow table like a stream batch: (mmsi, line coordinates, start_dt, end_dt) rows"""
+    return pa.table({
+        "mmsi": [mmsi for mmsi, _, _, _ in rows],
+        "coordinates": [shapely.to_wkb(shapely.LineString(line)) for _, line, _, _ in rows],
+        "start_dt": pa.array(pd.to_datetime([start for _, _, start, _ in rows]).to_numpy(), pa.timestamp("us")),
+        "end_dt": pa.array(pd.to_datetime([end for _, _, _, end in rows]).to_numpy(), pa.timestamp("us")),
+    })
+
+
+ROWS = [
+    ("219000001", [(11.70, 57.50), (11.75, 57.55)], "2023-02-01 10:00", "2023-02-01 12:00"),
+    ("219000002", [(11.90, 57.90), (11.95, 57.95)], "2023-02-01 10:00", "2023-02-01 12:00"),
+    ("219000003", [(11.71, 57.51), (11.72, 57.52)], "2023-02-10 10:00", "2023-02-10 12:00"),
+    ("219000004", [(11.60, 57.52), (11.80, 57.52)], "2023-01-31 22:00", "2023-02-02 01:00"),
+]
+
+
+class StubStore:
+    """The parts of TrajectoryStore QueryCache uses, one monthly table read from ROWS"""
+    def __init__(self):
+        self.version = 1
+        self.statements = []
+        self.db = self
+
+    def local_time(self, value):
+        return pd.Timestamp(value)
+
+    def tables(self, start, end):
+        return ["ais_data_2023_02"]
+
+    def table_versions(self, table_names):
+        return {table_name: self.version for table_name in table_names}
+
+    def statement(self, table_name, *args):
+        self.statements.append((table_name, *args))
+        return table_name
+
+    def stream(self, statements, output):
+        for table_name in statements:
+            yield table_name, trajectory_table(ROWS)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return QueryCache(StubStore(), tmp_path)
+
+
+def test_snap(cache):
+    assert cache.snap((11.703, 57.5, 11.7501, 57.551)) == (11.7, 57.5, 11.76, 57.56)
+    assert cache.snap((-0.005, -10.0, 0.005, 10.0)) == (-0.01, -10.0, 0.01, 10.0)
+    assert cache.snap(shapely.box(11.703, 57.5, 11.7501, 57.551)) == (11.7, 57.5, 11.76, 57.56)
+    # Boxes in the same cells share the key, floating point noise included
+    assert cache.snap((0.1 + 0.2, 0.7, 0.31, 0.71)) == cache.snap((0.3, 0.7, 0.309, 0.709))
+
+
+def test_cut_by_bbox_and_time(cache):
+    table = trajectory_table(ROWS)
+    cut = cache.cut([table], (11.69, 57.49, 11.76, 57.56), pd.Timestamp("2023-02-01"), pd.Timestamp("2023-02-02"), output="arrow")
+    assert cut["mmsi"].to_pylist() == ["219000001", "219000004"]
+    cut = cache.cut([table], shapely.box(11.69, 57.49, 11.76, 57.56), pd.Timestamp("2023-02-05"),
+                    pd.Timestamp("2023-02-28"), columns=["mmsi", "unknown"], output="arrow")
+    assert cut.column_names == ["mmsi"] and cut["mmsi"].to_pylist() == ["219000003"]
+
+
+def test_cut_empty_entries(cache):
+    empty = pa.table({})
+    assert cache.cut([empty], (0, 0, 1, 1), pd.Timestamp("2023-02-01"), pd.Timestamp("2023-02-02"), output="arrow").num_rows == 0
+    assert len(cache.cut([], (0, 0, 1, 1), pd.Timestamp("2023-02-01"), pd.Timestamp("2023-02-02"))) == 0
+
+
+def test_cut_geopandas(cache):
+    frame = cache.cut([trajectory_table(ROWS)], (11.69, 57.49, 11.76, 57.56), pd.Timestamp("2023-02-01"),
+                      pd.Timestamp("2023-02-02"))
+    assert frame.geometry.name == "coordinates"
+    assert frame["mmsi"].tolist() == ["219000001", "219000004"]
+
+
+def test_query_reuses_entries_until_the_version_changes(cache):
+    bbox = (11.69, 57.49, 11.76, 57.56)
+    first = cache.query(bbox, "2023-02-01", "2023-02-02", output="arrow")
+    # Another bbox in the same cells is cut from the same entry
+    second = cache.query((11.691, 57.491, 11.759, 57.559), "2023-02-01", "2023-02-02", output="arrow")
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache.store.statements) == 1
+    assert first["mmsi"].to_pylist() == ["219000001", "219000004"]
+    assert second["mmsi"].to_pylist() == ["219000001", "219000004"]
+    # The cell is read, not the exact bbox, and without the time range
+    assert cache.store.statements[0][1] == cache.snap(bbox)
+
+    cache.store.version = 2
+    cache.query(bbox, "2023-02-01", "2023-02-02", output="arrow")
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert [path.name.rsplit("-", 1)[1] for path in cache.cache_dir.glob("*.parquet")] == ["v2.parquet"]
+
+
+def test_query_columns_keep_filter_columns(cache):
+    cut = cache.query((11.69, 57.49, 11.76, 57.56), "2023-02-01", "2023-02-02", columns=["mmsi"], output="arrow")
+    assert cut.column_names == ["mmsi"]
+    assert cache.store.statements[0][-1] == ["coordinates", "end_dt", "mmsi", "start_dt"]
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from segmentation import find_segment_ends, GAP_THRESHOLD_DAYS, GAP_THRESHOLD_MONTHS, WINDOW
+
+NAV_STATUSES = {0: "Engine", 1: "Anchor", 2: "No command", 5: "Moored", 8: "Sailing"}
+STATIONARY = ["Moored", "Anchor"]
+SOG_THRESHOLD, UPPER_SOG_THRESHOLD = 0.5, 3.0
+
+
+def is_stationary(codes):
+    return np.array([NAV_STATUSES[code] in STATIONARY for code in np.asarray(codes).tolist()], dtype=bool)
+
+
+def random_track(rng, rows):
+    """Sorted track switching between moving and moored, with gaps at and just over the thresholds"""
+    steps = rng.choice([
+        pd.Timedelta(minutes=1), GAP_THRESHOLD_DAYS, GAP_THRESHOLD_DAYS + pd.Timedelta(seconds=1),
+        GAP_THRESHOLD_MONTHS, GAP_THRESHOLD_MONTHS + pd.Timedelta(seconds=1),
+    ], p=[0.96, 0.01, 0.01, 0.01, 0.01], size=rows)
+    moving = np.arange(rows) < rng.integers(0, rows + 1)
+    speed = np.where(moving, rng.uniform(2, 15, rows), rng.uniform(0, 1, rows))
+    speed[rng.random(rows) < 0.05] = np.nan
+    status = np.where(moving, rng.choice([0, 2, 8], rows), rng.choice([1, 5, 2], rows))
+    return pd.DataFrame({
+        "timestamp": (pd.Timestamp("2023-01-01") + pd.to_timedelta(np.cumsum(steps))).as_unit("ns"),
+        "speed_over_ground": speed,
+        "navigational_status": status,
+    })
+
+
+def reference_segment_end(track):
+    """Per ship tests of split_trajectories before find_segment_ends, windows clipped to short tracks"""
+    diff = track["timestamp"].diff()
+    large_gaps_days = diff > GAP_THRESHOLD_DAYS
+    large_gaps_months = diff > GAP_THRESHOLD_MONTHS
+
+    middle_index = len(track) // 2
+    middle_df = track.iloc[max(0, middle_index - WINDOW // 2):middle_index + WINDOW // 2]
+    last_rows = track.tail(WINDOW)
+    voyage_end = False
+    if NAV_STATUSES[middle_df["navigational_status"].mode()[0]] not in STATIONARY \
+            and middle_df["speed_over_ground"].mean() > UPPER_SOG_THRESHOLD:
+        if NAV_STATUSES[last_rows["navigational_status"].mode()[0]] in STATIONARY \
+                and last_rows["speed_over_ground"].mean() < SOG_THRESHOLD:
+            voyage_end = True
+    return voyage_end, large_gaps_days.to_numpy(), large_gaps_months.to_numpy()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_same_segment_ends_as_per_ship_tests(seed):
+    rng = np.random.default_rng(seed)
+    lengths = np.concatenate([rng.integers(1, WINDOW, 10), rng.integers(WINDOW, 600, 30)])
+    tracks = [random_track(rng, rows) for rows in lengths]
+    frame = pd.concat(tracks, ignore_index=True)
+
+    ends = find_segment_ends(frame["timestamp"].to_numpy(), frame["speed_over_ground"].to_numpy(),
+                             frame["navigational_status"].to_numpy(), lengths, is_stationary,
+                             SOG_THRESHOLD, UPPER_SOG_THRESHOLD)
+
+    offsets = ends["offsets"]
+    for i, track in enumerate(tracks):
+        voyage_end, large_gaps_days, large_gaps_months = reference_segment_end(track)
+        assert ends["voyage_end"][i] == voyage_end
+        assert ends["gap_days"][i] == large_gaps_days.any()
+        assert ends["gap_months"][i] == large_gaps_months.any()
+        np.testing.assert_array_equal(ends["large_gaps_days"][offsets[i]:offsets[i + 1]], large_gaps_days)
+        np.testing.assert_array_equal(ends["large_gaps_months"][offsets[i]:offsets[i + 1]], large_gaps_months)
+    assert ends["voyage_end"].any() and not ends["voyage_end"].all()
+
+
+def test_gap_at_the_threshold_is_not_large():
+    track = pd.DataFrame({
+        "timestamp": pd.to_datetime(["2023-01-01 00:00:00", "2023-01-02 00:00:00", "2023-01-03 00:00:01"]).as_unit("ns"),
+        "speed_over_ground": [5.0, 5.0, 5.0],
+        "navigational_status": [0, 0, 0],
+    })
+    ends = find_segment_ends(track["timestamp"].to_numpy(), track["speed_over_ground"].to_numpy(),
+                             track["navigational_status"].to_numpy(), [3], is_stationary,
+                             SOG_THRESHOLD, UPPER_SOG_THRESHOLD)
+    assert ends["large_gaps_days"].tolist() == [False, False, True]
+    assert not ends["gap_months"][0]
@@ -0,0 +1,36 @@
+import queue
+import threading
+
+import pandas as pd
+import pytest
+
+import ais_data_processor as processor
+
+
+@pytest.fixture
+def dead_worker():
+    worker = threading.Thread(target=lambda: None, name="trajectory_worker_0")
+    worker.start()
+    worker.join()
+    processor.shard_workers[:] = [worker]
+    processor.shard_nav_statuses[:] = [{}]
+    yield worker
+    processor.shard_workers.clear()
+    processor.shard_nav_statuses.clear()
+
+
+def test_dispatch_to_a_dead_worker_raises(dead_worker):
+    shard_queue = queue.Queue(maxsize=1)
+    chunk = pd.DataFrame({"mmsi": ["1", "2"]})
+    processor.dispatch_to_shards(chunk, "2023_01", "a.csv", [shard_queue])
+    with pytest.raises(RuntimeError, match="trajectory_worker_0"):
+        processor.dispatch_to_shards(chunk, "2023_01", "a.csv", [shard_queue])
+    with pytest.raises(RuntimeError, match="trajectory_worker_0"):
+        processor.check_trajectory_workers()
+
+
+def test_stop_skips_a_dead_worker(dead_worker):
+    shard_queue = queue.Queue(maxsize=1)
+    shard_queue.put("pending chunk")
+    processor.stop_trajectory_workers([shard_queue], [dead_worker])
+    assert processor.shard_workers == []
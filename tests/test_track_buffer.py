@@ -0,0 +1,82 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from track_buffer import TrackBuffer, TrackStore, TRACK_COLUMNS
+
+
+def random_chunks(rng, chunks=8, tz="Europe/Berlin"):
+    """Chunks of one ship's rows arriving out of order, with distinct time stamps"""
+    rows = int(rng.integers(chunks, 400))
+    seconds = rng.choice(10 * rows, size=rows, replace=False)
+    frame = pd.DataFrame({
+        "timestamp": (pd.Timestamp("2023-03-26", tz=tz) + pd.to_timedelta(seconds, unit="s")).as_unit("ns"),
+        "latitude": rng.uniform(-90, 90, rows),
+        "longitude": rng.uniform(-180, 180, rows),
+        "speed_over_ground": rng.uniform(0, 20, rows),
+        "course_over_ground": rng.uniform(0, 360, rows),
+        "heading": np.where(rng.random(rows) < 0.2, np.nan, rng.uniform(0, 360, rows)),
+        "navigational_status": rng.integers(0, 16, rows),
+    })
+    bounds = [0, *np.sort(rng.choice(np.arange(1, rows), size=chunks - 1, replace=False)), rows]
+    return [frame.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def concat_reference(chunks):
+    """The pd.concat path TrackBuffer replaced: concatenate and re-sort after every chunk"""
+    track = chunks[0]
+    for chunk in chunks[1:]:
+        track = pd.concat([track, chunk], ignore_index=True).sort_values(['timestamp'], ascending=[True])
+    return track.reset_index(drop=True)
+
+
+def buffered(chunks):
+    buffer = TrackBuffer.from_frame(chunks[0])
+    for chunk in chunks[1:]:
+        buffer.append(chunk)
+    return buffer
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_same_track_as_concat(seed):
+    chunks = random_chunks(np.random.default_rng(seed))
+    pd.testing.assert_frame_equal(buffered(chunks).to_frame(), concat_reference(chunks), check_dtype=False)
+
+
+def test_missing_columns_are_left_out():
+    chunks = [chunk.drop(columns=["heading", "course_over_ground"]) for chunk in random_chunks(np.random.default_rng(0))]
+    pd.testing.assert_frame_equal(buffered(chunks).to_frame(), concat_reference(chunks), check_dtype=False)
+
+
+def test_equal_timestamps_keep_arrival_order():
+    chunks = random_chunks(np.random.default_rng(1), chunks=2)
+    chunks[1] = chunks[1].assign(timestamp=chunks[0]["timestamp"].iloc[0])
+    frame = buffered(chunks).to_frame()
+    first = chunks[0]["timestamp"].iloc[0]
+    ties = frame[frame["timestamp"] == first]
+    assert list(ties["latitude"]) == [chunks[0]["latitude"].iloc[0]] + list(chunks[1]["latitude"])
+
+
+def test_pickle_and_spill_keep_the_rows(tmp_path):
+    chunks = random_chunks(np.random.default_rng(2))
+    expected = concat_reference(chunks)
+    restored = pickle.loads(pickle.dumps(buffered(chunks)))
+    pd.testing.assert_frame_equal(restored.to_frame(), expected, check_dtype=False)
+
+    store = TrackStore(memory_budget=1, spill_dir=str(tmp_path))
+    store["1"] = TrackBuffer.from_frame(chunks[0])
+    store.enforce_budget()
+    for chunk in chunks[1:]:
+        store["1"].append(chunk)
+        store.enforce_budget()
+    assert store.stats()["spills"] > 0
+    pd.testing.assert_frame_equal(store["1"].to_frame(), expected, check_dtype=False)
+    store.close()
+
+
+def test_buffer_dtypes():
+    buffer = buffered(random_chunks(np.random.default_rng(3)))
+    assert {name: column.dtype for name, column in buffer.columns.items()} == {name: np.dtype(dtype) for name, dtype in TRACK_COLUMNS.items()}
+    assert len(buffer) <= buffer.capacity
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from trajectory_compression import simplify_tracks, compress_segments, sed_distances, unwrap_longitudes
+from trajectory_segment import TrajectorySegment
+
+
+def reference_simplify(times, latitude, longitude, tolerance, keep):
+    """Recursive Douglas-Peucker with the SED on one track, one interval at a time"""
+    keep = keep.copy()
+    keep[0] = keep[-1] = True
+    kept = np.flatnonzero(keep)
+    stack = list(zip(kept[:-1], kept[1:]))
+    while stack:
+        first, last = stack.pop()
+        if last - first <= 1:
+            continue
+        index = np.arange(first + 1, last)
+        distances = sed_distances(times, latitude, longitude, index, np.full(len(index), first), np.full(len(index), last))
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            keep[index[farthest]] = True
+            stack += [(first, index[farthest]), (index[farthest], last)]
+    return keep
+
+
+def random_track(rng, n):
+    """Ship like track: a random walk of about 10 m/s with headings that drift, one point a minute"""
+    seconds = np.cumsum(rng.integers(10, 120, n))
+    heading = np.cumsum(rng.normal(0, 0.2, n))
+    step = 10 * np.diff(seconds, prepend=0)
+    latitude = 57.5 + np.cumsum(step * np.cos(heading)) / 111_000
+    longitude = 11.7 + np.cumsum(step * np.sin(heading)) / (111_000 * np.cos(np.radians(57.5)))
+    timestamps = np.datetime64("2023-06-01T00:00:00", "ns") + seconds.astype("timedelta64[s]")
+    return timestamps, latitude, longitude
+
+
+def max_interpolation_error(times, latitude, longitude, keep):
+    """Largest SED of a dropped point to the kept points around it"""
+    kept = np.flatnonzero(keep)
+    index = np.flatnonzero(~keep)
+    if len(index) == 0:
+        return 0.0
+    after = np.searchsorted(kept, index)
+    return sed_distances(times, latitude, longitude, index, kept[after - 1], kept[after]).max()
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("tolerance", [1.0, 25.0, 500.0])
+def test_matches_reference(seed, tolerance):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(0, 200, 8)
+    tracks = [random_track(rng, n) for n in lengths]
+    timestamps, latitude, longitude = (np.concatenate(columns) for columns in zip(*tracks))
+    forced = rng.random(len(timestamps)) < 0.02
+
+    keep = simplify_tracks(timestamps, latitude, longitude, lengths, tolerance, keep=forced)
+
+    offsets = np.r_[0, np.cumsum(lengths)]
+    times = timestamps.view(np.int64)
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        if stop == start:
+            continue
+        track = slice(start, stop)
+        expected = reference_simplify(times[track], latitude[track], longitude[track], tolerance, forced[track])
+        np.testing.assert_array_equal(keep[track], expected)
+        assert max_interpolation_error(times[track], latitude[track], longitude[track], keep[track]) <= tolerance
+    assert keep[forced].all()
+
+
+def test_straight_constant_speed_track_keeps_the_ends():
+    timestamps = np.datetime64("2023-06-01", "ns") + np.arange(50).astype("timedelta64[m]")
+    latitude = np.linspace(57.0, 57.5, 50)
+    longitude = np.linspace(11.0, 11.5, 50)
+    keep = simplify_tracks(timestamps, latitude, longitude, [50], 1.0)
+    assert np.flatnonzero(keep).tolist() == [0, 49]
+
+
+def test_stop_is_kept_although_it_is_on_the_line():
+    # The ship waits half way, a plain Douglas-Peucker on the positions would drop the stop
+    minutes = np.r_[np.arange(10), np.arange(10) + 60]
+    timestamps = np.datetime64("2023-06-01", "ns") + minutes.astype("timedelta64[m]")
+    latitude = np.r_[np.linspace(57.0, 57.1, 10), np.linspace(57.1, 57.2, 10)]
+    longitude = np.full(20, 11.0)
+    keep = simplify_tracks(timestamps, latitude, longitude, [20], 10.0)
+    assert keep[9] and keep[10]
+
+
+def test_antimeridian():
+    longitude = np.array([179.8, 179.9, -180.0, -179.9, -179.8])
+    np.testing.assert_allclose(unwrap_longitudes(longitude, np.array([0, 5])), [179.8, 179.9, 180.0, 180.1, 180.2])
+    timestamps = np.datetime64("2023-06-01", "ns") + np.arange(5).astype("timedelta64[m]")
+    keep = simplify_tracks(timestamps, np.full(5, 60.0), longitude, [5], 1.0)
+    assert np.flatnonzero(keep).tolist() == [0, 4]
+
+
+def test_compress_segments_keeps_gaps():
+    rng = np.random.default_rng(0)
+    timestamps, latitude, longitude = random_track(rng, 100)
+    segment = TrajectorySegment(219000001, 0, "2023-06", timestamps, latitude, longitude,
+                                speed_over_ground=rng.uniform(0, 20, 100), missing_data=True,
+                                missing_data_info={"indices": [40, 70]})
+    compressed, = compress_segments([segment], 1000.0)
+    assert compressed.compression_tolerance == 1000.0
+    assert len(compressed) < len(segment)
+    indices = compressed.missing_data_info["indices"]
+    np.testing.assert_array_equal(compressed.timestamps[indices], timestamps[[40, 70]])
+    np.testing.assert_array_equal(compressed.timestamps[np.subtract(indices, 1)], timestamps[[39, 69]])
+    assert compressed.course_over_ground is None
+    assert len(compressed.speed_over_ground) == len(compressed)
+    assert segment.missing_data_info == {"indices": [40, 70]}
+    assert compress_segments([segment], None) == [segment]
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from trajectory_encoding import (quantize, dequantize, encode_time_offsets, decode_time_offsets,
+                                 decode_compact_row, decode_compact_frame, QUANTIZED_COLUMNS, TIME_OFFSETS_COLUMN)
+
+TZ = "Europe/Stockholm"
+
+
+def random_compact_rows(rng, count=50):
+    """Compact rows as the database returns them, some with NULL arrays and NULL elements"""
+    rows = []
+    # Around the DST changes of 2023 so the offsets cross them
+    starts = pd.to_datetime(["2023-03-26 01:30", "2023-10-29 01:30", "2023-10-29 02:30", "2023-06-01 12:00"])
+    for i in range(count):
+        n = int(rng.integers(1, 40))
+        row = {"id": i, "start_dt": starts[i % len(starts)],
+               TIME_OFFSETS_COLUMN: list(np.cumsum(rng.integers(0, 600, n)).astype(int))}
+        for quantized_name in QUANTIZED_COLUMNS.values():
+            values = [int(value) for value in rng.integers(0, 3600, n)]
+            if i % 3 == 0:
+                values[0] = None
+            row[quantized_name] = None if i % 7 == 0 else values
+        if i % 11 == 0:
+            row[TIME_OFFSETS_COLUMN] = None
+        rows.append(row)
+    return rows
+
+
+def test_quantize_roundtrip():
+    values = np.array([0.0, 12.34, 359.95, np.nan, 3276.7])
+    quantized = quantize(values)
+    assert quantized.dtype == object and quantized[3] is None
+    decoded = dequantize(list(quantized))
+    np.testing.assert_allclose(decoded, values, atol=0.05)
+    assert quantize(np.array([1.26])).dtype == np.int16
+    assert quantize(None) is None and dequantize(None) is None
+
+
+@pytest.mark.parametrize("start", ["2023-03-26 01:30", "2023-10-29 01:30", "2023-06-01 12:00"])
+def test_time_offsets_roundtrip(start):
+    aware = pd.date_range(pd.Timestamp(start).tz_localize(TZ, ambiguous=True), periods=20, freq="7min")
+    naive = aware.tz_localize(None)
+    offsets = encode_time_offsets(aware.tz_convert("UTC").tz_localize(None))
+    np.testing.assert_array_equal(offsets, np.arange(20) * 420)
+    np.testing.assert_array_equal(decode_time_offsets(naive[0], offsets, TZ), naive)
+
+
+def test_time_offsets_without_tz():
+    offsets = np.array([0, 60, 3600])
+    decoded = decode_time_offsets(pd.Timestamp("2023-03-26 01:30"), offsets, None)
+    np.testing.assert_array_equal(decoded, pd.to_datetime(["2023-03-26 01:30", "2023-03-26 01:31", "2023-03-26 02:30"]))
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("tz", [TZ, None])
+def test_frame_matches_rows(seed, tz):
+    rows = random_compact_rows(np.random.default_rng(seed))
+    decoded = decode_compact_frame(pd.DataFrame(rows), tz)
+    assert TIME_OFFSETS_COLUMN not in decoded
+    assert not set(QUANTIZED_COLUMNS.values()) & set(decoded.columns)
+    for i, row in enumerate(rows):
+        expected = decode_compact_row(row, tz)
+        if row[TIME_OFFSETS_COLUMN] is None:
+            assert decoded["timestamps"][i] is None
+        else:
+            np.testing.assert_array_equal(pd.DatetimeIndex(decoded["timestamps"][i]), pd.DatetimeIndex(expected["timestamps"]))
+        for name in QUANTIZED_COLUMNS:
+            if expected[name] is None:
+                assert decoded[name][i] is None
+            else:
+                np.testing.assert_array_equal(decoded[name][i], expected[name])
+
+
+def test_empty_frame():
+    frame = pd.DataFrame({"start_dt": pd.Series([], dtype="datetime64[ns]"), TIME_OFFSETS_COLUMN: [],
+                          **{name: [] for name in QUANTIZED_COLUMNS.values()}})
+    decoded = decode_compact_frame(frame, TZ)
+    assert len(decoded) == 0 and "timestamps" in decoded
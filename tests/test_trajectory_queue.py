@@ -0,0 +1,65 @@
+import multiprocessing as mp
+import threading
+
+import pytest
+
+import ais_data_processor as processor
+from trajectory_queue import TrajectoryQueue, TrajectoryWriteError, FLUSH
+
+
+def failing_writer(trajectory_queue):
+    """Writer that fails to write the batches holding a "bad" item"""
+    while True:
+        item = trajectory_queue.get()
+        if item is None:
+            return
+        if item == FLUSH:
+            trajectory_queue.flushed()
+        elif item == "bad":
+            trajectory_queue.record_failure()
+
+
+def start_writers(trajectory_queue, ctx=None):
+    writers = [(ctx.Process if ctx else threading.Thread)(target=failing_writer, args=(trajectory_queue,), name=f"w{i}")
+               for i in range(trajectory_queue.writers)]
+    for writer in writers:
+        writer.start()
+    trajectory_queue.watch(writers)
+    return writers
+
+
+@pytest.mark.parametrize("kind", ["thread", "process"])
+def test_flush_raises_after_a_failed_batch(kind):
+    ctx = mp.get_context("spawn") if kind == "process" else None
+    trajectory_queue = TrajectoryQueue(4, ctx=ctx, writers=2)
+    writers = start_writers(trajectory_queue, ctx)
+    trajectory_queue.put("good")
+    trajectory_queue.flush()
+
+    trajectory_queue.put("bad")
+    with pytest.raises(TrajectoryWriteError):
+        trajectory_queue.flush()
+    # Later flushes stay failed, the lost batch is before them
+    trajectory_queue.put("good")
+    with pytest.raises(TrajectoryWriteError):
+        trajectory_queue.flush()
+    assert trajectory_queue.stats()["failed_batches"] == 1
+
+    trajectory_queue.close()
+    for writer in writers:
+        writer.join()
+
+
+def test_checkpoint_is_not_saved_after_a_failed_batch(monkeypatch):
+    trajectory_queue = TrajectoryQueue(4, writers=1)
+    writers = start_writers(trajectory_queue)
+    trajectory_queue.put("bad")
+
+    def shared(database_url):
+        raise AssertionError("the checkpoint must not be saved")
+    monkeypatch.setattr(processor.ClearAIS_DB, "shared", shared)
+    assert processor.save_checkpoint("a.csv", "fingerprint", "partial", 1000, "2023_01", trajectory_queue) is False
+
+    trajectory_queue.close()
+    for writer in writers:
+        writer.join()
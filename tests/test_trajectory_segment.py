@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from trajectory_segment import dominant_values
+
+
+def reference_dominant(values, groups, num_groups):
+    """pandas mode of every group, the lowest value on ties, NaN for groups without values"""
+    frame = pd.DataFrame({"group": groups, "value": values}).dropna()
+    modes = frame.groupby("group")["value"].agg(lambda group: group.mode().iloc[0])
+    return modes.reindex(range(num_groups)).to_numpy(dtype=np.float64)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_dominant_values_like_mode(seed):
+    rng = np.random.default_rng(seed)
+    num_groups = int(rng.integers(1, 40))
+    groups = np.repeat(np.arange(num_groups), rng.integers(0, 30, num_groups))
+    # Few distinct values so there are ties, -1 is the missing nav status code
+    values = rng.integers(-1, rng.integers(1, 16), len(groups)).astype(np.float64)
+    values[rng.random(len(groups)) < 0.2] = np.nan
+    np.testing.assert_array_equal(dominant_values(values, groups, num_groups), reference_dominant(values, groups, num_groups))
+
+
+def test_dominant_values_without_values():
+    assert np.isnan(dominant_values(np.full(3, np.nan), np.array([0, 0, 1]), 2)).all()
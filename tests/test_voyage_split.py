@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from voyage_split import identify_voyages, identify_voyages_vectorized, SPEED_THRESHOLD, MOVING_STATUSES
+
+NAV_STATUSES = MOVING_STATUSES + ['At Anchor', 'Moored', 'Not Under Command', 'Unknown']
+
+
+def random_tracks(rng, ships=20, max_rows=60):
+    """AIS rows of several ships, with speeds at the threshold and single row ships"""
+    frames = []
+    for ship in range(ships):
+        rows = 1 if ship % 7 == 0 else int(rng.integers(2, max_rows))
+        speed = rng.choice([0.0, SPEED_THRESHOLD, np.nextafter(SPEED_THRESHOLD, 1), 5.0], size=rows)
+        frames.append(pd.DataFrame({
+            'ship_id': ship,
+            'timestamp': pd.Timestamp("2023-01-01") + pd.to_timedelta(np.arange(rows), unit="min"),
+            'lat': rng.uniform(-90, 90, rows),
+            'lon': rng.uniform(-180, 180, rows),
+            'nav_status': rng.choice(NAV_STATUSES, size=rows),
+            'speed': speed,
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def reference_voyages(df):
+    """identify_voyages per ship, as rows of the vectorized output"""
+    rows = []
+    for ship, track in df.groupby('ship_id', sort=False):
+        for voyage in identify_voyages(track):
+            rows.append((ship, voyage['start_dt'], voyage['end_dt'], voyage['origin'].wkt, voyage['destination'].wkt))
+    return rows
+
+
+def vectorized_voyages(df):
+    voyages = identify_voyages_vectorized(df)
+    return [(row.ship_id, row.start_dt, row.end_dt, row.origin.wkt, row.destination.wkt) for row in voyages.itertuples()]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_same_voyages_as_identify_voyages(seed):
+    df = random_tracks(np.random.default_rng(seed))
+    assert vectorized_voyages(df) == reference_voyages(df)
+
+
+def test_single_row_voyages():
+    # Starts and ends on the same row: moving status at low speed, fast with a stationary status
+    df = pd.DataFrame({
+        'ship_id': [1, 1, 1, 2],
+        'timestamp': pd.date_range("2023-01-01", periods=4, freq="min"),
+        'lat': [1.0, 2.0, 3.0, 4.0],
+        'lon': [5.0, 6.0, 7.0, 8.0],
+        'nav_status': ['Sailing', 'Moored', 'Sailing', 'Moored'],
+        'speed': [SPEED_THRESHOLD, 5.0, 0.0, 5.0],
+    })
+    voyages = vectorized_voyages(df)
+    assert voyages == reference_voyages(df)
+    assert len(voyages) == 4
+    assert all(start_dt == end_dt for _, start_dt, end_dt, _, _ in voyages)
+
+
+def test_empty_frame():
+    df = random_tracks(np.random.default_rng(0)).iloc[:0]
+    assert identify_voyages_vectorized(df).empty